@@ -0,0 +1,152 @@
+"""
+
+Benchmark of a full engine run on synthetic datasets of growing size.
+Every scale is generated by synthetic.py into its own database and run in
+a fresh process, one stage after another, so that times, peak memory and
+database round trips can be told apart for every stage. Results are saved
+as JSON, --compare prints how much faster or slower every stage got since
+an older result.
+
+Usage: python benchmark.py --scale 1000 --scale 10000 [--output FILE] [--compare OLD]
+
+"""
+
+from mongokit import Connection
+from datetime import datetime
+import multiprocessing
+import traceback
+import argparse
+import json
+import time
+
+import instrument
+import synthetic
+
+# recipes per user of generated datasets
+ITEM_RATIO = 0.1
+
+# scales run when none is given
+SCALES = [1000, 10000]
+
+
+def run_scale(users, items, database, workers, seed):
+    """
+    Generate dataset and run all stages of the engine on it, in a process of its own.
+
+    :return: dictionary with sizes of dataset and measurements of stages
+    """
+    mconnection = Connection()
+    started = time.time()
+    dataset = synthetic.generate(mconnection, database, users, items, seed)
+    dataset['generate_seconds'] = time.time() - started
+
+    # imported here, so the engine starts in this process and not in the parent
+    import engine
+    import stages
+    engine.connect(database)
+    engine.use_generation(engine.generations.new_generation(mconnection, database))
+    meter = instrument.Instrument(mconnection)
+    started = time.time()
+    stages.execute(engine.STAGES, stages.plan(engine.STAGES), engine.Run(None, workers),
+                   concurrent=False, runner=meter)
+    engine.generations.publish(mconnection, engine.G_GENERATION, engine.RETIRED_SECONDS, database)
+    dataset['seconds'] = time.time() - started
+    dataset['stages'] = meter.records
+    return dataset
+
+
+def _run_scale(queue, *args):
+    try:
+        queue.put(run_scale(*args))
+    except Exception:
+        queue.put(traceback.format_exc())
+
+
+def benchmark(scales, database, workers, seed=0, item_ratio=ITEM_RATIO):
+    """
+    Run the benchmark for every scale in a separate process.
+
+    :param scales: list of numbers of users
+    :param database: name of database replaced by synthetic datasets
+    :param workers: number of worker processes of the engine
+    :param seed: seed of synthetic datasets
+    :param item_ratio: recipes per user
+    :return: list of results of run_scale
+    """
+    results = []
+    for users in scales:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_scale,
+                                          args=(queue, users, max(1, int(users * item_ratio)), database, workers, seed))
+        process.start()
+        result = queue.get()
+        process.join()
+        if not isinstance(result, dict):
+            raise RuntimeError('benchmark of scale %d failed:\n%s' % (users, result))
+        report(result)
+        results.append(result)
+    return results
+
+
+def report(result):
+    print "%d users, %d recipes, %d ratings: generated in %.1f s, engine %.1f s" % (
+        result['users'], result['items'], result['ratings'], result['generate_seconds'], result['seconds'])
+    for stage in result['stages']:
+        print "  %-25s %9.2f s %9.1f MB %9d round trips" % (
+            stage['stage'], stage['seconds'], stage['peak_rss_mb'], stage.get('round_trips', 0))
+
+
+def compare(old, new):
+    """
+    Print ratios of times of stages of new results to old results of the same scales.
+
+    :param old: list of results of an older benchmark
+    :param new: list of results of this benchmark
+    """
+    older = dict(((result['users'], result['items']), result) for result in old)
+    for result in new:
+        before = older.get((result['users'], result['items']))
+        if before is None:
+            print "%d users, %d recipes: no older result" % (result['users'], result['items'])
+            continue
+        print "%d users, %d recipes: %.2fx time of older run" % (
+            result['users'], result['items'], ratio(result['seconds'], before['seconds']))
+        seconds = dict((stage['stage'], stage['seconds']) for stage in before['stages'])
+        for stage in result['stages']:
+            if stage['stage'] in seconds:
+                print "  %-25s %9.2f s -> %9.2f s %7.2fx" % (
+                    stage['stage'], seconds[stage['stage']], stage['seconds'],
+                    ratio(stage['seconds'], seconds[stage['stage']]))
+
+
+def ratio(new, old):
+    return new / old if old > 0 else float('inf')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the engine on synthetic datasets.')
+    parser.add_argument('--scale', type=int, action='append', dest='scales', metavar='USERS',
+                        help='number of users of a dataset, can be repeated (default %s)' % SCALES)
+    parser.add_argument('--item-ratio', type=float, default=ITEM_RATIO,
+                        help='recipes per user (default %(default)s)')
+    parser.add_argument('--database', default='recsys_benchmark',
+                        help='database replaced by datasets (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes of the engine (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--compare', metavar='OLD', help='compare with results saved in this JSON file')
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.scales or SCALES, args.database, args.workers, args.seed, args.item_ratio)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': datetime.now(), 'workers': args.workers, 'results': results},
+                      f, indent=2, default=datetime.isoformat)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['results'], results)
+
+
+if __name__ == '__main__':
+    main()
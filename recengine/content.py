@@ -0,0 +1,445 @@
+"""
+
+Content vectors of recipes for the recommender engine.
+Ingredients are kept in a sparse L2-normalised recipe x ingredient TF-IDF
+matrix, so cosine similarities are plain dot products of its rows.
+Tags are kept as packed bitsets over the tag dictionary from NonPersonal.
+
+"""
+
+from array import array
+from scipy import sparse
+from ratings import BLOCK_CELLS
+from topk import top_k_indices
+import numpy as np
+
+
+# number of set bits of every byte
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+
+# bits of every byte, the highest first as np.packbits packs them
+BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.float64)
+
+
+def normalize_rows(matrix):
+    """
+    Scale every row of sparse matrix to unit length, zero rows stay zero.
+
+    :param matrix: sparse matrix
+    :return: csr matrix with L2-normalised rows
+    """
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    inverse = np.zeros_like(norms)
+    inverse[norms > 0] = 1.0 / norms[norms > 0]
+    return sparse.diags(inverse).dot(matrix).tocsr()
+
+
+def packed_dot(weights, bits):
+    """
+    Dot products of rows of weights with rows of packed bits, the bits are
+    not unpacked. Sums of weights for all 256 values of one byte of bits are
+    tabulated first, then every row looks its byte up in the table.
+
+    :param weights: array n x tags of weights of bits
+    :param bits: uint8 array m x ceil(tags / 8) of packed bits
+    :return: array n x m
+    """
+    padded = np.zeros((weights.shape[0], bits.shape[1] * 8))
+    padded[:, :weights.shape[1]] = weights
+    # m x n, so that every lookup copies a whole row of the table
+    result = np.zeros((bits.shape[0], weights.shape[0]))
+    looked_up = np.empty_like(result)
+    for byte in range(bits.shape[1]):
+        table = BYTE_BITS.dot(padded[:, byte * 8:(byte + 1) * 8].T)
+        np.take(table, bits[:, byte], axis=0, out=looked_up)
+        result += looked_up
+    return result.T
+
+
+def row_neighbours(row, i, k, item_ids, skip=None):
+    """
+    Top k most similar recipes from one row of similarities.
+
+    :param row: similarities of recipe on row i with all recipes
+    :param i: row index of recipe, it is never its own neighbour
+    :param k: number of similar recipes
+    :param item_ids: recipe ids of columns
+    :param skip: ids of recipes which can not be neighbours
+    :return: list of (recipe id, similarity)
+    """
+    skip = skip or ()
+    # ask for a few more to have k left after skipping
+    candidates = top_k_indices(row, k + len(skip) + 1)
+    similar = [(item_ids[j], float(row[j])) for j in candidates if j != i and item_ids[j] not in skip]
+    return similar[:k]
+
+
+class IngredientMatrix(object):
+    """
+    TF-IDF vectors of recipes by ingredients, one L2-normalised row per recipe.
+    """
+
+    def __init__(self, item_ids, ingredients, matrix, presence, idf, occurrences=None):
+        """
+        :param item_ids: list of recipe ids, position is the row index
+        :param ingredients: list of ingredient names, position is the column index
+        :param matrix: csr matrix recipes x ingredients of tf-idf
+        :param presence: csr matrix recipes x ingredients, 1 when recipe has ingredient
+        :param idf: dictionary ingredient -> idf
+        :param occurrences: csr matrix recipes x ingredients, how many times recipe lists ingredient
+        """
+        self.item_ids = list(item_ids)
+        self.item_index = dict((itemid, i) for i, itemid in enumerate(self.item_ids))
+        self.ingredients = list(ingredients)
+        self.ingredient_index = dict((name, i) for i, name in enumerate(self.ingredients))
+        self.matrix = matrix
+        self.presence = presence
+        self.idf = idf
+        self.idf_vector = np.array([idf.get(name, 0.0) for name in self.ingredients])
+        self.occurrences = occurrences
+
+    @classmethod
+    def build(cls, recipes, idf):
+        """
+        Build the matrix from ingredients of recipes and idf from compute_idf().
+        Term frequency of ingredient is 1 / number of ingredients of recipe.
+
+        :param recipes: list of (recipe id, list of ingredient names)
+        :param idf: dictionary ingredient -> idf
+        :return: new IngredientMatrix
+        """
+        item_ids, ingredients, occurrences = cls.count(recipes)
+        return cls.from_occurrences(item_ids, ingredients, occurrences, idf)
+
+    @classmethod
+    def count(cls, recipes, base=None):
+        """
+        Count ingredients of recipes.
+
+        :param recipes: list of (recipe id, list of ingredient names)
+        :param base: IngredientMatrix whose counts are kept for recipes which are not in recipes,
+                     recipes which are not in it yet get new rows at the end
+        :return: (recipe ids, ingredient names, csr matrix recipes x ingredients of occurrences)
+        """
+        item_ids = list(base.item_ids) if base is not None else []
+        item_index = dict(base.item_index) if base is not None else {}
+        ingredients = list(base.ingredients) if base is not None else []
+        ingredient_index = dict(base.ingredient_index) if base is not None else {}
+        replaced = []
+        rows, cols, values = array('i'), array('i'), array('d')
+        for itemid, names in recipes:
+            row = item_index.get(itemid)
+            if row is None:
+                row = item_index[itemid] = len(item_ids)
+                item_ids.append(itemid)
+            else:
+                replaced.append(row)
+            counts = {}
+            for name in names:
+                col = ingredient_index.get(name)
+                if col is None:
+                    col = ingredient_index[name] = len(ingredients)
+                    ingredients.append(name)
+                counts[col] = counts.get(col, 0) + 1
+            for col in sorted(counts):
+                rows.append(row)
+                cols.append(col)
+                values.append(counts[col])
+
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        values = np.asarray(values, dtype=np.float64)
+        if base is not None:
+            old = base.occurrences.tocoo()
+            keep = ~np.in1d(old.row, replaced)
+            rows = np.concatenate([old.row[keep].astype(np.int32), rows])
+            cols = np.concatenate([old.col[keep].astype(np.int32), cols])
+            values = np.concatenate([old.data[keep], values])
+        shape = (len(item_ids), len(ingredients))
+        return item_ids, ingredients, sparse.csr_matrix((values, (rows, cols)), shape=shape)
+
+    @classmethod
+    def from_occurrences(cls, item_ids, ingredients, occurrences, idf):
+        """
+        Build the matrix from counts of ingredients of recipes.
+
+        :param item_ids: list of recipe ids, position is the row index
+        :param ingredients: list of ingredient names, position is the column index
+        :param occurrences: csr matrix recipes x ingredients of occurrences, see count()
+        :param idf: dictionary ingredient -> idf
+        :return: new IngredientMatrix
+        """
+        occurrences.sort_indices()
+        # number of ingredients of every recipe, an ingredient listed twice counts twice
+        lengths = np.asarray(occurrences.sum(axis=1)).ravel()
+        rows = np.repeat(np.arange(len(item_ids)), np.diff(occurrences.indptr))
+        idf_vector = np.array([idf.get(name, 0.0) for name in ingredients])
+        shape = occurrences.shape
+        matrix = sparse.csr_matrix((idf_vector[occurrences.indices] / lengths[rows],
+                                    occurrences.indices, occurrences.indptr), shape=shape)
+        presence = sparse.csr_matrix((np.ones(len(occurrences.indices)), occurrences.indices, occurrences.indptr),
+                                     shape=shape)
+        return cls(item_ids, ingredients, normalize_rows(matrix), presence, idf, occurrences)
+
+    @classmethod
+    def from_arrays(cls, item_ids, ingredients, arrays):
+        """
+        Matrix from arrays of arrays(), e.g. memory mapped from a snapshot.
+
+        :param item_ids: list of recipe ids, position is the row index
+        :param ingredients: list of ingredient names, position is the column index
+        :param arrays: dictionary name -> array
+        :return: new IngredientMatrix
+        """
+        shape = (len(item_ids), len(ingredients))
+        matrix = sparse.csr_matrix((arrays['tfidf_data'], arrays['tfidf_indices'], arrays['tfidf_indptr']),
+                                   shape=shape)
+        occurrences = sparse.csr_matrix((arrays['occurrences_data'], arrays['occurrences_indices'],
+                                         arrays['occurrences_indptr']), shape=shape)
+        presence = sparse.csr_matrix((np.ones(len(occurrences.indices)), occurrences.indices, occurrences.indptr),
+                                     shape=shape)
+        idf = dict(zip(ingredients, arrays['idf'].tolist()))
+        return cls(item_ids, ingredients, matrix, presence, idf, occurrences)
+
+    def arrays(self):
+        """
+        All arrays of the matrix, from_arrays() builds it from them again.
+
+        :return: dictionary name -> array
+        """
+        return {'tfidf_data': self.matrix.data, 'tfidf_indices': self.matrix.indices,
+                'tfidf_indptr': self.matrix.indptr, 'occurrences_data': self.occurrences.data,
+                'occurrences_indices': self.occurrences.indices, 'occurrences_indptr': self.occurrences.indptr,
+                'idf': self.idf_vector}
+
+    def rows(self, ids):
+        """
+        Row indexes of recipes with ids, None stays None (all recipes).
+        """
+        if ids is None: return None
+        return [self.item_index[itemid] for itemid in ids if itemid in self.item_index]
+
+    def cosine(self, i, j):
+        """
+        Cosine similarity of recipes on rows i and j.
+        """
+        return float(self.matrix[i].dot(self.matrix[j].T).sum())
+
+    def similar_blocks(self, rows=None, block_size=None):
+        """
+        Cosine similarities of recipes against all recipes, one sparse
+        matrix product for a block of rows at once.
+
+        :param rows: row indexes of recipes to compute, all recipes by default
+        :param block_size: number of recipes in one block, by default it fits BLOCK_CELLS
+        :return: generator of (row indexes, similarities block x all recipes)
+        """
+        count = len(self.item_ids)
+        if rows is None:
+            rows = np.arange(count)
+        rows = np.asarray(rows, dtype=np.int64)
+        if block_size is None:
+            block_size = max(1, BLOCK_CELLS // max(count, 1))
+        transposed = self.matrix.T.tocsr()
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            yield block, self.matrix[block].dot(transposed).toarray()
+
+    def neighbours(self, k, rows=None):
+        """
+        Top k most similar recipes for recipes, recipe itself excluded.
+
+        :param k: number of similar recipes
+        :param rows: row indexes of recipes to compute, all recipes by default
+        :return: generator of (recipe id, [(recipe id, similarity)])
+        """
+        for block, sims in self.similar_blocks(rows):
+            for i, row in zip(block, sims):
+                row[i] = -np.inf
+                yield self.item_ids[i], row_neighbours(row, i, k, self.item_ids)
+
+    def profiles(self, liked):
+        """
+        Ingredient profiles of users, how many liked recipes have the ingredient.
+
+        :param liked: list of row indexes of liked recipes for every user
+        :return: array users x ingredients
+        """
+        counts = np.zeros((len(liked), len(self.ingredients)))
+        for n, rows in enumerate(liked):
+            if len(rows):
+                counts[n] = np.asarray(self.presence[rows].sum(axis=0)).ravel()
+        return counts
+
+    def profile_scores(self, profiles):
+        """
+        Cosine similarities of user profiles by tf-idf of ingredients with every recipe.
+
+        :param profiles: array users x ingredients of ingredient counts in liked recipes
+        :return: array users x recipes in order of rows
+        """
+        totals = profiles.sum(axis=1)
+        totals[totals == 0] = 1.0
+        weights = (profiles / totals[:, np.newaxis]) * self.idf_vector
+        norms = np.sqrt((weights * weights).sum(axis=1))
+        norms[norms == 0] = np.inf
+        return self.matrix.dot(weights.T).T / norms[:, np.newaxis]
+
+
+class TagBitsets(object):
+    """
+    Tags of recipes as rows of packed bits, bit t is set when recipe has
+    tag number t of the tag dictionary. Binary cosine of two recipes is
+    popcount(a & b) / sqrt(popcount(a) * popcount(b)).
+    """
+
+    def __init__(self, tags, item_ids, bits):
+        """
+        :param tags: tag dictionary, position is the bit number
+        :param item_ids: list of recipe ids, position is the row index
+        :param bits: uint8 array recipes x ceil(tags / 8) of packed bits
+        """
+        self.tags = list(tags)
+        self.tag_index = dict((tag, t) for t, tag in enumerate(self.tags))
+        self.item_ids = list(item_ids)
+        self.item_index = dict((itemid, i) for i, itemid in enumerate(self.item_ids))
+        self.bits = bits
+        self.counts = POPCOUNT[bits].sum(axis=1)
+
+    @classmethod
+    def build(cls, tags, recipes):
+        """
+        Encode tags of recipes, tags which are not in dictionary are ignored.
+
+        :param tags: tag dictionary, NonPersonal.tags
+        :param recipes: list of (recipe id, list of tags)
+        :return: new TagBitsets
+        """
+        tag_index = dict((tag, t) for t, tag in enumerate(tags))
+        item_ids = []
+        dense = np.zeros((len(recipes), len(tags)), dtype=np.uint8)
+        for row, (itemid, recipetags) in enumerate(recipes):
+            item_ids.append(itemid)
+            for tag in recipetags:
+                t = tag_index.get(tag)
+                if t is not None:
+                    dense[row, t] = 1
+        return cls(tags, item_ids, np.packbits(dense, axis=1))
+
+    def updated(self, tags, recipes):
+        """
+        New bitsets with tags of some recipes encoded again, the others are kept.
+        Recipes which are not in the bitsets yet get new rows at the end.
+
+        :param tags: tag dictionary, the old one with new tags at the end
+        :param recipes: list of (recipe id, list of tags)
+        :return: new TagBitsets
+        """
+        if list(tags[:len(self.tags)]) != self.tags:
+            raise ValueError('tags of bitsets are not the beginning of the tag dictionary')
+        item_ids = list(self.item_ids)
+        item_index = dict(self.item_index)
+        rows = []
+        for itemid, recipetags in recipes:
+            if itemid not in item_index:
+                item_index[itemid] = len(item_ids)
+                item_ids.append(itemid)
+            rows.append(item_index[itemid])
+        # bits of new tags are zero, the same as padding of packed rows
+        bits = np.zeros((len(item_ids), (len(tags) + 7) // 8), dtype=np.uint8)
+        bits[:len(self.item_ids), :self.bits.shape[1]] = self.bits
+        if rows:
+            bits[rows] = TagBitsets.build(tags, recipes).bits
+        return TagBitsets(tags, item_ids, bits)
+
+    def rows(self, ids):
+        """
+        Row indexes of recipes with ids, None stays None (all recipes).
+        """
+        if ids is None: return None
+        return [self.item_index[itemid] for itemid in ids if itemid in self.item_index]
+
+    def dense(self, rows=None):
+        """
+        Unpacked 0/1 vectors of recipes.
+
+        :param rows: row indexes, all recipes by default
+        :return: array rows x tags
+        """
+        bits = self.bits if rows is None else self.bits[rows]
+        return np.unpackbits(bits, axis=1)[:, :len(self.tags)]
+
+    def cosine(self, i, j):
+        """
+        Binary cosine similarity of recipes on rows i and j.
+        """
+        den = self.counts[i] * self.counts[j]
+        if den == 0:
+            return 0.0
+        common = POPCOUNT[np.bitwise_and(self.bits[i], self.bits[j])].sum()
+        return float(common / np.sqrt(den))
+
+    def similar_blocks(self, rows=None, block_size=None):
+        """
+        Binary cosine similarities of recipes against all recipes, popcounts
+        of intersections for a whole block are read from the packed bits of
+        all recipes one byte at a time, see packed_dot.
+
+        :param rows: row indexes of recipes to compute, all recipes by default
+        :param block_size: number of recipes in one block, by default it fits BLOCK_CELLS
+        :return: generator of (row indexes, similarities block x all recipes)
+        """
+        count = len(self.item_ids)
+        if rows is None:
+            rows = np.arange(count)
+        rows = np.asarray(rows, dtype=np.int64)
+        if block_size is None:
+            block_size = max(1, BLOCK_CELLS // max(count, 1))
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            common = packed_dot(self.dense(block), self.bits)
+            den = np.sqrt(np.outer(self.counts[block], self.counts).astype(np.float64))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                yield block, np.where(den > 0, common / den, 0.0)
+
+    def neighbours(self, k, rows=None, skip=None):
+        """
+        Top k most similar recipes by tags for recipes, recipe itself excluded.
+
+        :param k: number of similar recipes
+        :param rows: row indexes of recipes to compute, all recipes by default
+        :param skip: dictionary recipe id -> ids of recipes which can not be its neighbours
+        :return: generator of (recipe id, [(recipe id, similarity)])
+        """
+        skip = skip or {}
+        for block, sims in self.similar_blocks(rows):
+            for i, row in zip(block, sims):
+                row[i] = -np.inf
+                itemid = self.item_ids[i]
+                yield itemid, row_neighbours(row, i, k, self.item_ids, skip.get(itemid))
+
+    def profiles(self, liked):
+        """
+        Tag profiles of users, average of tag vectors of liked recipes.
+
+        :param liked: list of row indexes of liked recipes for every user
+        :return: array users x tags
+        """
+        profiles = np.zeros((len(liked), len(self.tags)))
+        for n, rows in enumerate(liked):
+            if len(rows):
+                profiles[n] = self.dense(rows).mean(axis=0)
+        return profiles
+
+    def profile_scores(self, profiles):
+        """
+        Cosine similarities of user profiles by tags with every recipe.
+
+        :param profiles: array users x tags of tag weights
+        :return: array users x recipes in order of rows
+        """
+        norms = np.sqrt((profiles * profiles).sum(axis=1))
+        den = np.outer(norms, np.sqrt(self.counts))
+        common = packed_dot(profiles, self.bits)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(den > 0, common / den, 0.0)
@@ -6,43 +6,194 @@ Authors: Michal Lukac, Boris Valentovic
 """
 
 from operator import itemgetter
+from itertools import islice
 from mongokit import Connection
 import sys
 import math
+import random
+import time
+import argparse
 
 # i need to add this because of imports
 sys.path.append('../')
 
 from sqlalchemy import and_
-from webapp.models import recommender
+from webapp.models import recommender, changelog, cache, textindex, schema, generations
+from webapp.config import Config
 from datetime import datetime
 from math import sqrt
+from ratings import RatingMatrix, BLOCK_CELLS, check_pearson
+from topk import top_k, top_k_indices
+from writer import BulkWriter
+from content import IngredientMatrix, TagBitsets
+from stages import Stage
+import instrument
+import lease
+import parallel
+import snapshot
+import stages
+import numpy as np
 
-# create our mongodb connection and register models
-# this is our recommender computing database
-mconnection = Connection()
-mconnection.register([recommender.User])
-mconnection.register([recommender.Recipe])
-mconnection.register([recommender.NonPersonal])
 
-userscol = mconnection['recsys'].users
-recipecol = mconnection['recsys'].recipes
-nonpcol = mconnection['recsys'].nonpersonal
+# database with users, recipes and results, benchmarks use another one
+DATABASE = 'recsys'
 
-# get unique tags
-G_TAGS = nonpcol.NonPersonal.find_one({'_id': 1}).get('tags')
+# generation of results written by this run, see use_generation()
+G_GENERATION = None
+
+# seconds a replaced generation is kept, for webapps which cache the pointer
+RETIRED_SECONDS = generations.retention(Config.RESULTS_CACHE_TTL)
+
+
+def connect(database=None):
+    """
+    Create our mongodb connection and register models.
+    Every worker process calls it again to have its own connection.
+
+    :param database: name of database to work with, the last one by default
+    """
+    global mconnection, userscol, recipecol, nonpcol, DATABASE
+    if database is not None:
+        DATABASE = database
+    # this is our recommender computing database
+    mconnection = Connection()
+    mconnection.register([recommender.User])
+    mconnection.register([recommender.Recipe])
+    mconnection.register([recommender.NonPersonal])
+
+    userscol = mconnection[DATABASE].users
+    recipecol = mconnection[DATABASE].recipes
+    nonpcol = mconnection[DATABASE].nonpersonal
+    if G_GENERATION is not None:
+        use_generation(G_GENERATION)
+
+
+def use_generation(generation):
+    """
+    Write results of stages to collections of generation.
+
+    :param generation: number of generation, see webapp.models.generations
+    """
+    global G_GENERATION, resultuserscol, resultrecipecol, resulttopcol
+    G_GENERATION = generation
+    resultuserscol = generations.results(mconnection, generation, generations.USERS, DATABASE)
+    resultrecipecol = generations.results(mconnection, generation, generations.RECIPES, DATABASE)
+    resulttopcol = generations.results(mconnection, generation, generations.TOP, DATABASE)
+
+connect()
+
+# get unique tags, compute_tag_vectors() reads them again
+G_TAGS = (nonpcol.find_one({'_id': 1}, {'tags': 1}) or {}).get('tags', [])
 
 # ingredients with IDF only, not TFIDF
 G_INGREDIENTS = {}
 
+# recipes x ingredients TF-IDF matrix built by compute_idf()
+G_TFIDF = None
+
+# tags of recipes as bitsets over G_TAGS built by compute_tag_vectors()
+G_TAGBITS = None
+
+# all ratings of users, loaded once per run by load_ratings()
+G_RATINGS = None
+
+# number of computed documents written to database in one bulk operation
+BULK_BATCH_SIZE = 1000
+
+
+def load_ratings(base=None, changes=None):
+    """
+    Load all ratings from database to sparse user x item matrix G_RATINGS.
+    With a snapshot only ratings of changed users and users missing in it are read.
+
+    :param base: snapshot.Snapshot up to date with the last run, None reads everything
+    :param changes: changelog.Changes since the snapshot
+    """
+    global G_RATINGS
+    if base is None:
+        G_RATINGS = RatingMatrix.load(userscol, recipecol)
+        return
+    users = list(set().union(*changes.users.values()))
+    users += missing_ids(userscol, base.ratings.user_index, users)
+    recipes = list(changes.items[changelog.RECIPE])
+    recipes += missing_ids(recipecol, set(base.ratings.item_ids[:base.ratings.recipes]), recipes)
+    if not users and not recipes:
+        G_RATINGS = base.ratings
+        return
+    ratings = [(user['_id'], user.get('ratings', []))
+               for user in userscol.find(only(users), {'ratings.itemid': 1, 'ratings.value': 1})]
+    G_RATINGS = base.ratings.updated(ratings, recipes)
+
+
+def missing_ids(collection, known, changed=()):
+    """
+    Ids of documents which are neither known nor changed, e.g. users who signed up
+    after the snapshot was taken. All ids are read only when the collection has
+    another number of documents than known and changed together.
+
+    :param collection: users or recipes
+    :param known: ids of documents in snapshot, dictionary or set
+    :param changed: ids of changed documents
+    :return: list of ids
+    """
+    new = set(docid for docid in changed if docid not in known)
+    if collection.count() == len(known) + len(new): return []
+    return [doc['_id'] for doc in collection.find({}, {'_id': 1}) if doc['_id'] not in known and doc['_id'] not in new]
+
 
-def precompute_avg_userratings():
+def only(ids):
     """
-    Precompute for every user his average rating and store to db.
+    Query for documents with id in ids.
+
+    :param ids: collection of ids, None means all documents
+    :return: query specification
+    """
+    if ids is None: return {}
+    return {'_id': {'$in': list(ids)}}
+
+
+def precompute_avg_userratings(users=None):
     """
-    for user in userscol.User.find():
-        user['avgrating'] = average_rating_user(user)
-        user.save()
+    Check average ratings and rating aggregates of users kept by webapp
+    against all their ratings and fix the wrong ones.
+
+    :param users: ids of users to check, all users by default
+    :return: number of fixed users
+    """
+    return check_aggregates(userscol, users, G_RATINGS.user_index, G_RATINGS.user_sums,
+                            G_RATINGS.user_counts, G_RATINGS.user_sumsq, 0.0)
+
+
+def check_aggregates(collection, ids, index, sums, counts, sumsq, empty):
+    """
+    Compare stored ratingsum, ratingcount, ratingsumsq and avgrating of documents
+    with values from G_RATINGS and write the right ones where they differ.
+
+    :param collection: users or recipes
+    :param ids: ids of documents to check, None for all
+    :param index: dictionary id -> index in sums, counts and sumsq
+    :param empty: average of document without ratings
+    :return: number of fixed documents
+    """
+    fields = {'ratingsum': 1, 'ratingcount': 1, 'ratingsumsq': 1, 'avgrating': 1}
+    with BulkWriter(collection, BULK_BATCH_SIZE) as writer:
+        for doc in collection.find(only(ids), fields):
+            i = index.get(doc['_id'])
+            if i is None:
+                right = {'ratingsum': 0.0, 'ratingcount': 0, 'ratingsumsq': 0.0, 'avgrating': empty}
+            else:
+                count = int(counts[i])
+                right = {'ratingsum': float(sums[i]), 'ratingcount': count, 'ratingsumsq': float(sumsq[i]),
+                         'avgrating': float(sums[i] / count) if count else empty}
+            if any(not same_value(doc.get(field), value) for field, value in right.items()):
+                writer.set(doc['_id'], right)
+    return writer.written
+
+
+def same_value(stored, right):
+    if stored is None or right is None:
+        return stored is right
+    return abs(stored - right) <= 1e-9 * max(1.0, abs(right))
 
 
 def average_rating_user(user):
@@ -52,64 +203,39 @@ def average_rating_user(user):
     :param user: unique user
     :return: average rating.
     """
-    average = 0.0
-    if len(user['ratings']) != 0:
-        for item in user['ratings']:
-            average += (item['value'])
-        average /= len(user['ratings'])
-    return average
+    u = G_RATINGS.user_index.get(user['_id'])
+    if u is None: return 0.0
+    return G_RATINGS.user_mean(u)
 
 
 def most_favorite():
     """
     Computing simple most favorite items as number of favorites
-    and then save it to nonpcol document to 'topfavorites'
-    """
-    fav = []
-    for item in recipecol.Recipe.find():
-        # fav[item.get('_id')] = len(item.get('favorites'))
-        fav.append((item.get('_id'), len(item.get('favorites'))))
-    fav_sorted = sorted(fav, key=lambda tup: tup[1])
-    fav_sorted.reverse()
-    fav_sorted = fav_sorted[:10]
-    # alebo fav_sorted = fav_sorted.reverse()[:5]??
-    for item in fav_sorted:
-        recipe = nonpcol.NonPersonal.find_one({'_id': 1})
-        recipe['topfavorites'].append(int(item[0]))
-        recipe.save()
-
-
-def average_ratings_recipes():
-    """
-    Computing average ratings for every recipe
-    and then save it to sql database to recipe
-    this function precomputes average ratings for bestrated function
-    """
-    for item in recipecol.Recipe.find():
-        idrecipe = item.get('_id')
-        sum = 0.0;
-        count = 0
-        # compute average for specified item
-        for item1 in userscol.User.find({'ratings': {'$elemMatch': {'itemid': idrecipe}}}, {'ratings.$': 1}):
-            sum = sum + item1.get('ratings')[0]['value']
-            count = count + 1
-        try:
-            item['avgrating'] = float(sum / float(count))
-            item.save()
-        except:
-            # if it is exception division by zero, just skip it
-            pass
+    and then save it to top lists of generation as 'topfavorites'
+    """
+    fav = ((item.get('_id'), len(item.get('favorites'))) for item in recipecol.find({}, {'favorites': 1}))
+    fav_sorted = top_k(fav, 10, key=itemgetter(1))
+    resulttopcol.update({'_id': 1}, {'$set': {'topfavorites': [item[0] for item in fav_sorted]}}, upsert=True)
+
+
+def average_ratings_recipes(items=None):
+    """
+    Check average ratings and rating aggregates of recipes kept by webapp
+    against all ratings and fix the wrong ones, best_rated reads them.
+
+    :param items: ids of recipes to check, all recipes by default
+    :return: number of fixed recipes
+    """
+    return check_aggregates(recipecol, items, G_RATINGS.item_index, G_RATINGS.item_sums,
+                            G_RATINGS.item_counts, G_RATINGS.item_sumsq, None)
 
 
 def best_rated():
     """
-    Get best items from sql and save it to our document database.
+    Get best items by average rating kept by webapp and save it to top lists of generation.
     """
-    recipes = recipecol.Recipe.find().sort('avgrating', 1).limit(15)
-    for item in recipes:
-        recipe = nonpcol.NonPersonal.find_one({'_id': 1})
-        recipe['toprated'].append(int(item['_id']))
-        recipe.save()
+    recipes = recipecol.find({}, {'_id': 1}).sort('avgrating', -1).limit(15)
+    resulttopcol.update({'_id': 1}, {'$set': {'toprated': [item['_id'] for item in recipes]}}, upsert=True)
 
 
 def hackernews_interesting():
@@ -117,19 +243,24 @@ def hackernews_interesting():
     Hackernews like interested, #http://amix.dk/blog/post/19574
     compute interesting items right now by votes/favorites
     """
-    interest = []
-    for item in recipecol.Recipe.find():
+    with BulkWriter(recipecol, BULK_BATCH_SIZE) as writer:
+        interest_sorted = top_k(interesting_scores(writer), 10, key=itemgetter(1))
+    resulttopcol.update({'_id': 1}, {'$set': {'topinteresting': [item[0] for item in interest_sorted]}},
+                        upsert=True)
+
+
+def interesting_scores(writer):
+    """
+    Compute hackernews score for every recipe and write it through writer.
+
+    :param writer: BulkWriter of recipes
+    :return: generator of (recipe id, score)
+    """
+    for item in recipecol.find({}, {'favorites': 1, 'date_creation': 1}):
         hours = abs(datetime.now() - item.get('date_creation')).total_seconds() / 3600.0
-        item['interesting'] = hackernews_score(len(item.get('favorites')), hours)
-        item.save()
-        interest.append((item.get('_id'), item['interesting']))
-    interest_sorted = sorted(interest, key=lambda tup: tup[1])
-    interest_sorted.reverse()
-    interest_sorted = interest_sorted[:10]
-    for item in interest_sorted:
-        recipe = nonpcol.NonPersonal.find_one({'_id': 1})
-        recipe['topinteresting'].append(int(item[0]))
-        recipe.save()
+        interesting = hackernews_score(len(item.get('favorites')), hours)
+        writer.set(item['_id'], {'interesting': interesting})
+        yield item['_id'], interesting
 
 
 def hackernews_score(votes, item_hour_age, gravity=1.8):
@@ -139,265 +270,288 @@ def hackernews_score(votes, item_hour_age, gravity=1.8):
     return (votes + 1) / pow((item_hour_age + 2), gravity)
 
 
-def collaborative_filtering():
+def collaborative_filtering(users=None, candidates=True):
     """
     This is our user based collaborative filtering algorithm.
-    """
-    for u in userscol.User.find():
-        pred = []
 
-        for r in recipecol.Recipe.find():
-            if u.getRating(r['_id']) is None:
-                numerator = 0
-                denominator = 0
-
-                for b in u['similar_users']:
-                    user_b = userscol.User.find_one({'_id': b['userid']})
-                    rating = user_b.getRating(r['_id'])
-                    if rating is None: continue
+    :param users: ids of users to recommend for, all users by default
+    :param candidates: score only recipes rated by similar users, otherwise
+                       predict rating of every recipe with predict_ratings
+    """
+    means = G_RATINGS.user_means()
+    similar = dict((u['_id'], u.get('similar_users', []))
+                   for u in resultuserscol.find(only(users), {'similar_users': 1}))
+    with BulkWriter(resultuserscol, BULK_BATCH_SIZE, upsert=True) as writer:
+        for userid in (G_RATINGS.user_ids if users is None else users):
+            uidx = G_RATINGS.user_index.get(userid)
+            if uidx is None: continue
+            neighbours = neighbour_rows(similar.get(userid, []))
+
+            if candidates:
+                newlist = predict_candidates(uidx, neighbours, means, 10)
+            else:
+                newlist = top_k(predict_ratings(uidx, neighbours, means), 10, key=itemgetter('value'))
+            writer.set(userid, {'predicted': newlist})
 
-                    numerator += (b['value'] * (rating - user_b['avgrating']))
-                    denominator += b['value']
 
-                # if user rate everything equally, pearson similarity will be 0, so we recommend user's average
-                if denominator == 0:
-                    predicted_rating = u['avgrating']
-                    pred.append({'itemid': r['_id'], 'value': predicted_rating})
-                else:
-                    predicted_rating = u['avgrating'] + (numerator / denominator)
-                    pred.append({'itemid': r['_id'], 'value': predicted_rating})
+def neighbour_rows(similar_users):
+    """
+    Similar users as (row index, similarity), users without ratings are left out.
 
-        newlist = sorted(pred, key=itemgetter('value'), reverse=True)
-        u['predicted'] = newlist[:10]
-        u.save()
+    :param similar_users: similar_users of user from results
+    """
+    return [(G_RATINGS.user_index[b['userid']], b['value']) for b in similar_users
+            if b['userid'] in G_RATINGS.user_index]
 
 
-def pearson_sim_user(user1, user2):
+def check_predictions(users=None, k=10, tolerance=1e-9):
     """
-    Computes pearson correlation between two users based on ratings.
+    Compare predict_candidates with predict_ratings, which predicts every
+    recipe, for users and their similar users from results. A regression
+    check that both give the same top k predictions.
+
+    :param users: ids of users to check, all users by default
+    :param k: number of predictions
+    :param tolerance: largest allowed difference of predicted values
+    :return: list of (user id, predictions from predict_candidates, from predict_ratings) which differ
+    """
+    means = G_RATINGS.user_means()
+    similar = dict((u['_id'], u.get('similar_users', []))
+                   for u in resultuserscol.find(only(users), {'similar_users': 1}))
+    differ = []
+    for userid in (G_RATINGS.user_ids if users is None else users):
+        uidx = G_RATINGS.user_index.get(userid)
+        if uidx is None: continue
+        neighbours = neighbour_rows(similar.get(userid, []))
+        fast = predict_candidates(uidx, neighbours, means, k)
+        slow = top_k(predict_ratings(uidx, neighbours, means), k, key=itemgetter('value'))
+        if len(fast) != len(slow) or any(a['itemid'] != b['itemid'] or abs(a['value'] - b['value']) > tolerance
+                                         for a, b in zip(fast, slow)):
+            differ.append((userid, fast, slow))
+    return differ
+
+
+def check(users=100):
+    """
+    Check the batch algorithms against their pairwise versions on ratings in
+    database and similar users of the published generation, for a random
+    sample of users: pearson_blocks against pearson and predict_candidates
+    against predict_ratings.
 
-    :param user1: unique user
-    :param user2: unique user
-    :return: similarity between two users.
+    :param users: number of users checked
+    :return: True when all results are the same
     """
-    if len(user1['ratings']) == 0 or len(user2['ratings']) == 0: return 0.0
+    load_ratings()
+    use_generation(generations.published_generation(mconnection, DATABASE))
+    rows = sorted(random.sample(xrange(len(G_RATINGS.user_ids)), min(users, len(G_RATINGS.user_ids))))
+    pearson = check_pearson(G_RATINGS, rows)
+    for u, v, block, pairwise in pearson[:20]:
+        print "pearson of %s and %s: pearson_blocks %r, pearson %r" % (
+            G_RATINGS.user_ids[u], G_RATINGS.user_ids[v], block, pairwise)
+    predictions = check_predictions([G_RATINGS.user_ids[u] for u in rows])
+    for userid, fast, slow in predictions[:20]:
+        print "predictions of %s: predict_candidates %r, predict_ratings %r" % (userid, fast, slow)
+    print "%d users checked, %d pearson and %d prediction differences" % (len(rows), len(pearson), len(predictions))
+    return not pearson and not predictions
+
+
+def predict_candidates(uidx, neighbours, means, k):
+    """
+    Top k predicted ratings of user, the same as from predict_ratings.
+    Only recipes rated by at least one similar user are scored, from rating
+    rows of similar users at once. Every other recipe user did not rate is
+    predicted as his average, these are only taken in order of recipes
+    while some of k places are left for them.
+
+    :param uidx: row index of user
+    :param neighbours: list of (row index, similarity) of similar users
+    :param means: average ratings of all users
+    :param k: number of predictions
+    :return: list of predictions {'itemid', 'value'}
+    """
+    mean = float(means[uidx])
+    rated = G_RATINGS.user_ratings(uidx)[0]
+
+    # ratings of all similar users in one array of columns, numerators and similarities
+    cols, weighted, weights = [], [], []
+    for b, similarity in neighbours:
+        indices, values = G_RATINGS.user_ratings(b)
+        cols.append(indices)
+        weighted.append(similarity * (values - means[b]))
+        weights.append(np.repeat(float(similarity), len(indices)))
+
+    scored = []
+    if cols:
+        cols = np.concatenate(cols)
+        keep = (cols < G_RATINGS.recipes) & ~np.in1d(cols, rated)
+        items, inverse = np.unique(cols[keep], return_inverse=True)
+        numerator = np.bincount(inverse, weights=np.concatenate(weighted)[keep], minlength=len(items))
+        denominator = np.bincount(inverse, weights=np.concatenate(weights)[keep], minlength=len(items))
+        # if user rate everything equally, pearson similarity will be 0, so we recommend user's average
+        safe = np.where(denominator == 0, 1.0, denominator)
+        values = np.where(denominator == 0, mean, mean + numerator / safe)
+        scored = [(float(values[n]), items[n]) for n in top_k_indices(values, k)]
+    else:
+        items = np.zeros(0, dtype=np.int64)
 
-    # list of mutual ratings
-    mratings = []
-    for item1 in user1['ratings']:
-        for item2 in user2['ratings']:
-            if item1['itemid'] == item2['itemid']:
-                mratings.append({'itemid': item1['itemid'], 'value1': item1['value'], 'value2': item2['value']})
+    # recipes predicted as user's average, earlier recipes win ties like in predict_ratings
+    skip = set(items.tolist()) | set(rated.tolist())
+    fallback = islice((i for i in xrange(G_RATINGS.recipes) if i not in skip), k)
+    best = top_k(scored + [(mean, i) for i in fallback], k, key=lambda pair: (pair[0], -pair[1]))
+    return [{'itemid': G_RATINGS.item_ids[i], 'value': value} for value, i in best]
 
-    # if are no common ratings
-    if len(mratings) == 0: return 0.0
 
-    n = float(len(mratings))
-    sum1 = sum([it['value1'] for it in mratings])
-    sum2 = sum([it['value2'] for it in mratings])
+def predict_ratings(uidx, neighbours, means):
+    """
+    Predict ratings of user for all recipes he did not rate.
 
-    sum1sq = sum([pow(it['value1'], 2) for it in mratings])
-    sum2sq = sum([pow(it['value2'], 2) for it in mratings])
+    :param uidx: row index of user
+    :param neighbours: list of (row index, similarity) of similar users
+    :param means: average ratings of all users
+    :return: generator of predictions {'itemid', 'value'}
+    """
+    for r in recipecol.find({}, {'_id': 1}):
+        ridx = G_RATINGS.item_index.get(r['_id'])
+        if ridx is None: continue
+        if G_RATINGS.rating(uidx, ridx) is None:
+            numerator = 0
+            denominator = 0
+
+            for b, similarity in neighbours:
+                rating = G_RATINGS.rating(b, ridx)
+                if rating is None: continue
+
+                numerator += (similarity * (rating - means[b]))
+                denominator += similarity
+
+            # if user rate everything equally, pearson similarity will be 0, so we recommend user's average
+            if denominator == 0:
+                predicted_rating = float(means[uidx])
+            else:
+                predicted_rating = float(means[uidx] + (numerator / denominator))
+            yield {'itemid': r['_id'], 'value': predicted_rating}
 
-    pSum = sum([it['value2'] * it['value1'] for it in mratings])
 
-    num = pSum - (sum1 * sum2 / n)
-    den = math.sqrt((sum1sq - pow(sum1, 2) / n) * (sum2sq - pow(sum2, 2) / n))
+def pearson_sim_user(user1, user2):
+    """
+    Computes pearson correlation between two users based on ratings.
 
-    if den == 0.0:
-        return 0.0
-    return num / den  # TODO: * 1/min(common items, threshold) OR just put constant in denominator
+    :param user1: unique user
+    :param user2: unique user
+    :return: similarity between two users.
+    """
+    u = G_RATINGS.user_index.get(user1['_id'])
+    v = G_RATINGS.user_index.get(user2['_id'])
+    if u is None or v is None: return 0.0
+    return G_RATINGS.pearson(u, v)  # TODO: * 1/min(common items, threshold) OR just put constant in denominator
 
-def content_based():
+def content_based(users=None):
     """
     Our content based recomender.
-    """
-    global G_TAGS, G_INGREDIENTS
-    # 1. build user profiles
-    for user in userscol.User.find():
-        # 2. get favorited items and items which user ranked 4 or five
-        gooditems = list(set(user['favorites'] + user.getHighlyRatedItems()))
-        if len(gooditems) == 0: continue
-
-        uservectortag = [0] * len(G_TAGS)
-        useringredient = {}
-        for recipeid in gooditems:
-            # get the recipe
-            recipe = recipecol.Recipe.find_one({'_id': recipeid})
-
-            # compute user profile by tags
-            vectortag = get_recipe_tagvector(recipe)
-            uservectortag = sum_vectors(uservectortag, vectortag)
-
-            # compute user profile by ingredients with tfidf
-            for ingredient in recipe['ingredients']:
-                if useringredient.get(ingredient['ingredient']):
-                    useringredient[ingredient['ingredient']] += 1  # G_INGREDIENTS[ingredient['ingredient']]
-                else:
-                    useringredient[ingredient['ingredient']] = 1  # G_INGREDIENTS[ingredient['ingredient']]
-
-        # final two user profiles by tags and ingredients
-        userprofiletag = [value / float(len(gooditems)) for value in uservectortag]
-        userprofileingredient = [{'key': key, 'value': useringredient[key]} for key in useringredient]
-
-        # print userprofiletag
-        # print userprofileingredient
-
-        # 5. predicting items, cos(user,item), we can use hybrid
-        sim_array = []
-        for recipe in recipecol.Recipe.find():
-            # if it is not already rated or faved
-            if recipe['_id'] not in gooditems:
-                scoretag = cossim_tag_recipe_user(userprofiletag, get_recipe_tagvector(recipe))
-                scoreing = cossim_ingred_recipe_user(userprofileingredient, recipe)
-                score = scoretag + scoreing
-                # print 'score = ', scoretag, '+', scoreing, ' =', score
-                sim_array.append({'itemid': recipe['_id'], 'value': score})
-        newlist = sorted(sim_array, key=itemgetter('value'), reverse=True)
-
-        i = 0
-        for item in newlist:
-            user['predicted'].append({'itemid': item['itemid'], 'value': item['value']})
-            user.save()
-            i += 1
-            if i == 7: return
-
-
-def cossim_ingred_recipe_user(item1, item2):
-    """
-    Cosine similarity between user and recipe based on TFIDF of ingredients.
-    :param item1: unique user
-    :param item2: unique recipe
-    :return: cosine similarity
-    """
-    global G_INGREDIENTS
-
-    # creating two vectors
-    finalvector = []
-    ivector1 = []
-    ivector2 = []
-
-    counting1 = 0
-
-    for ingredient in item1:
-        ivector1.append(ingredient['key'])
-        counting1 += ingredient['value']
-        if ingredient['key'] not in finalvector:
-            finalvector.append(ingredient['key'])
-
-    for ingredient in item2['ingredients']:
-        ivector2.append(ingredient['ingredient'])
-        if ingredient['ingredient'] not in finalvector:
-            finalvector.append(ingredient['ingredient'])
-
-    # compute tf-idf
-    vector1 = []
-    vector2 = []
-
-    for ingredient in finalvector:
-        if ingredient in ivector1:
-            vector1.append(
-                (float(get_ingredient_value(item1, ingredient)) / float(counting1)) * G_INGREDIENTS[ingredient])
-        else:
-            vector1.append(0.0)
-        if ingredient in ivector2:
-            vector2.append((1.0 / len(ivector2)) * G_INGREDIENTS[ingredient])
-        else:
-            vector2.append(0.0)
-
-    # and now compute cosine similarity
-    numerator, pow1, pow2 = 0.0, 0.0, 0.0
-    for i in range(0, len(finalvector)):
-        numerator = numerator + (vector1[i] * vector2[i])
-        pow1 = pow1 + (vector1[i] * vector1[i])
-        pow2 = pow2 + (vector2[i] * vector2[i])
-
-    denumerator = math.sqrt(pow1) * math.sqrt(pow2)
-    if denumerator == 0.0:
-        return 0.0
-    else:
-        return numerator / denumerator
-
-
-def get_ingredient_value(item1, key):
-    for ingredient in item1:
-        if ingredient['key'] == key:
-            return ingredient['value']
-    else:
-        return 0.
+    User profiles are scored against all recipes for a block of users at once.
+    Recommendations are stored as content, next to predicted of collaborative filtering.
 
-def cossim_tag_recipe_user(item1, item2):
+    :param users: ids of users to recommend for, all users by default
     """
-    Similarity between recipe and user based on tags.
-    :param item1: user
-    :param item2: recipe
-    :return: similarity
+    # rows of G_TFIDF in order of rows of G_TAGBITS, -1 if recipe is missing
+    ingredientrows = np.array([G_TFIDF.item_index.get(itemid, -1) for itemid in G_TAGBITS.item_ids], dtype=np.int64)
+    block_size = max(1, BLOCK_CELLS // max(len(G_TAGBITS.item_ids), 1))
+
+    with BulkWriter(resultuserscol, BULK_BATCH_SIZE, upsert=True) as writer:
+        block = []
+        for user in userscol.find(only(users), {'favorites': 1}):
+            # get favorited items and items which user ranked 4 or five
+            gooditems = set(user.get('favorites', []) + highly_rated_items(user['_id']))
+            if len(gooditems) == 0:
+                writer.set(user['_id'], {'content': []})
+                continue
+            block.append((user['_id'], gooditems))
+            if len(block) == block_size:
+                content_based_block(block, ingredientrows, writer)
+                block = []
+        if block:
+            content_based_block(block, ingredientrows, writer)
+
+
+def highly_rated_items(userid):
     """
-    global G_TAGS
-    if len(item1) == 0 or len(item2) == 0: return 0.0
+    Ids of recipes which user rated 4 or five.
 
-    numerator, pow1, pow2 = 0.0, 0.0, 0.0
-
-    for i in range(0, len(G_TAGS)):
-        numerator = numerator + (item1[i] * item2[i])
-        pow1 = pow1 + (item1[i] * item1[i])
-        pow2 = pow2 + (item2[i] * item2[i])
-
-    denumerator = math.sqrt(pow1) * math.sqrt(pow2)
-    if denumerator == 0.0:
-        return 0.0
-    else:
-        return numerator / denumerator
+    :param userid: unique user id
+    :return: list of recipe ids
+    """
+    u = G_RATINGS.user_index.get(userid)
+    if u is None: return []
+    indices, values = G_RATINGS.user_ratings(u)
+    return [G_RATINGS.item_ids[i] for i in indices[values >= 4]]
 
 
-def sum_vectors(vector1, vector2):
+def content_based_block(block, ingredientrows, writer):
     """
-    Sum two vectors and return new.
-    :param vector1: list of numbers
-    :param vector2: list of numbers
-    :return: vector1 + vector2
+    Content based recommendations for block of users.
+
+    :param block: list of (user id, set of ids of liked recipes)
+    :param ingredientrows: rows of G_TFIDF for rows of G_TAGBITS
+    :param writer: BulkWriter of results of users
     """
-    for i in range(0, len(vector1)):
-        vector2[i] += vector1[i]
-    return vector2
+    # build user profiles by tags and ingredients
+    tagprofiles = G_TAGBITS.profiles([G_TAGBITS.rows(gooditems) for userid, gooditems in block])
+    ingredientprofiles = G_TFIDF.profiles([G_TFIDF.rows(gooditems) for userid, gooditems in block])
 
+    # predicting items, cos(user,item), we can use hybrid
+    scores = G_TAGBITS.profile_scores(tagprofiles)
+    ingredientscores = G_TFIDF.profile_scores(ingredientprofiles)
+    present = ingredientrows >= 0
+    scores[:, present] += ingredientscores[:, ingredientrows[present]]
 
-def get_recipe_tagvector(recipe):
-    global G_TAGS
-    vector = []
-    for tag in G_TAGS:
-        if tag in recipe['tags']:
-            vector.append(1.0)
-        else:
-            vector.append(0.0)
-    return vector
+    for (userid, gooditems), row in zip(block, scores):
+        # if it is not already rated or faved
+        row[G_TAGBITS.rows(gooditems)] = -np.inf
+        newlist = [{'itemid': G_TAGBITS.item_ids[i], 'value': float(row[i])}
+                   for i in top_k_indices(row, 7) if row[i] > -np.inf]
+        writer.set(userid, {'content': newlist})
 
 
-def similar_people():
+def similar_people(users=None, batched=True):
     """
     Find similar persons for each user.
+
+    :param users: ids of users to compute, all users by default
+    :param batched: compute pearson similarities for blocks of users at once
+                    over the rating matrix, otherwise user by user with sim_person
     """
-    for user in userscol.User.find():
-        sim_person(user)
+    with BulkWriter(resultuserscol, BULK_BATCH_SIZE, upsert=True) as writer:
+        if not batched:
+            for user in userscol.User.find(only(users)):
+                user['similar_users'] = []
+                sim_person(user)
+                writer.set(user['_id'], {'similar_users': user['similar_users']})
+            return
+
+        selected = None
+        if users is not None:
+            selected = [G_RATINGS.user_index[userid] for userid in users if userid in G_RATINGS.user_index]
+        for rows, sims in G_RATINGS.pearson_blocks(selected):
+            instrument.count('pairs', sims.size)
+            # user is not similar to himself
+            sims[np.arange(len(rows)), rows] = -np.inf
+            for u, row in zip(rows, sims):
+                similar = [{'userid': G_RATINGS.user_ids[v], 'value': float(row[v])}
+                           for v in top_k_indices(row, 7) if v != u]
+                writer.set(G_RATINGS.user_ids[u], {'similar_users': similar})
 
 
 def sim_person(user1):
     """
-    Find top 7 similar users by pearson similarity for specific user.
+    Find top 7 similar users by pearson similarity for specific user
+    and add them to his similar users.
     :param user1: unique user
     """
-    sim_array = []
-    for user2 in userscol.User.find():
-        if user1['_id'] == user2['_id']: continue
-        sim_array.append({'userid': user2['_id'], 'value': pearson_sim_user(user1, user2)})
-    newlist = sorted(sim_array, key=itemgetter('value'), reverse=True)
-    print newlist
-    i = 0
-    for item in newlist:
-        user1['similar_users'].append({'userid': item['userid'], 'value': item['value']})
-        user1.save()
-        i += 1
-        if i == 7: return
+    sim_array = ((user2['_id'], pearson_sim_user(user1, user2))
+                 for user2 in userscol.find({}, {'_id': 1}) if user1['_id'] != user2['_id'])
+    newlist = top_k(sim_array, 7, key=itemgetter(1))
+    for userid, value in newlist:
+        user1['similar_users'].append({'userid': userid, 'value': value})
 
 
 def euclid_sim_user(user1, user2):
@@ -423,51 +577,30 @@ def euclid_sim_user(user1, user2):
     sum_of_squares = sum([pow(user1.getRating(itemid) - user2.getRating(itemid), 2) for itemid in mratings])
     return 1.0 / (1.0 + math.sqrt(sum_of_squares))
 
-def similar_items():
+def similar_items(items=None):
     """
     Find similar recipes for every recipe based on tags and ingredients.
+    Best 2 by ingredients are taken first and then best 2 from the others by tags.
+    An incremental run computes only recipes from affected_items. A changed
+    recipe also changes idf of its ingredients and of all ingredients a little,
+    so similarities of other recipes move and their order can drift from
+    a full run until the next engine.py --full, cron runs it every night
+    at 3:30 (see crontab.txt).
+
+    :param items: ids of recipes to compute, all recipes by default
     """
-    for item1 in recipecol.Recipe.find():
-        sim_item_ingredients(item1)
-        sim_item_tags(item1)
-
-def sim_item_tags(item1):
-    """
-    Compute cosine similarity between recipes. Save best 2 for selected recipe.
-    """
-    sim_array = []
-    for item2 in recipecol.Recipe.find():
-        if item2['_id'] == item1['_id']: continue
-        sim_array.append({'itemid': item2['_id'], 'value': cos_sim_recipes_tags(item1, item2)})
-    newlist = sorted(sim_array, key=itemgetter('value'), reverse=True)
+    # top 2 for all recipes at once, from blocks of the tf-idf matrix and tag bitsets
+    rows = G_TFIDF.rows(items)
+    instrument.count('pairs', 2 * len(G_TFIDF.item_ids) * (len(G_TFIDF.item_ids) if rows is None else len(rows)))
+    ingredients = dict(G_TFIDF.neighbours(2, rows))
+    skip = dict((itemid, set(simid for simid, value in similar)) for itemid, similar in ingredients.items())
+    tags = dict(G_TAGBITS.neighbours(2, G_TAGBITS.rows(items), skip))
 
-    i = 0
-    for item in newlist:
-        if not filter(lambda simitem: simitem['itemid'] == item['itemid'], item1['similar_items']):
-            item1['similar_items'].append({'itemid': item['itemid'], 'value': item['value'], 'type': 1})
-            item1.save()
-            i += 1
-        if i == 2: return
-
-
-def sim_item_ingredients(item1):
-    """
-    Compute similiar items for item through the tf-idf with ingredients
-    """
-    sim_array = []
-    for item2 in recipecol.Recipe.find():
-        if item2['_id'] == item1['_id']: continue
-        sim_array.append({'itemid': item2['_id'], 'value': cos_sim_recipes_ingredients(item1, item2)})
-    newlist = sorted(sim_array, key=itemgetter('value'), reverse=True)
-
-    i = 0
-    for item in newlist:
-        # if the item was not previously added through tag similarity
-        if not filter(lambda simitem: simitem['itemid'] == item['itemid'], item1['similar_items']):
-            item1['similar_items'].append({'itemid': item['itemid'], 'value': item['value'], 'type': 2})
-            item1.save()
-            i += 1
-        if i == 2: return
+    with BulkWriter(resultrecipecol, BULK_BATCH_SIZE, upsert=True) as writer:
+        for itemid in set(ingredients) | set(tags):
+            similar = [{'itemid': simid, 'value': value, 'type': 2} for simid, value in ingredients.get(itemid, [])]
+            similar += [{'itemid': simid, 'value': value, 'type': 1} for simid, value in tags.get(itemid, [])]
+            writer.set(itemid, {'similar_items': similar})
 
 
 def cos_sim_recipes_ingredients(item1, item2):
@@ -478,47 +611,11 @@ def cos_sim_recipes_ingredients(item1, item2):
      cos  = ---------
              |x|.|y|
     """
-    global G_INGREDIENTS
     if item1['_id'] == item2['_id']: return 0.0
-    # creating two vectors
-    finalvector = []
-    ivector1 = []
-    ivector2 = []
-    for ingredient in item1['ingredients']:
-        ivector1.append(ingredient['ingredient'])
-        if ingredient['ingredient'] not in finalvector:
-            finalvector.append(ingredient['ingredient'])
-
-    for ingredient in item2['ingredients']:
-        ivector2.append(ingredient['ingredient'])
-        if ingredient['ingredient'] not in finalvector:
-            finalvector.append(ingredient['ingredient'])
-
-    # compute tf-idf
-    vector1 = []
-    vector2 = []
-    for ingredient in finalvector:
-        if ingredient in ivector1:
-            vector1.append((1.0 / len(ivector1)) * G_INGREDIENTS[ingredient])
-        else:
-            vector1.append(0.0)
-        if ingredient in ivector2:
-            vector2.append((1.0 / len(ivector2)) * G_INGREDIENTS[ingredient])
-        else:
-            vector2.append(0.0)
-
-    # and now compute cosine similarity
-    numerator, pow1, pow2 = 0.0, 0.0, 0.0
-    for i in range(0, len(finalvector)):
-        numerator = numerator + (vector1[i] * vector2[i])
-        pow1 = pow1 + (vector1[i] * vector1[i])
-        pow2 = pow2 + (vector2[i] * vector2[i])
-
-    denumerator = math.sqrt(pow1) * math.sqrt(pow2)
-    if denumerator == 0.0:
-        return 0.0
-    else:
-        return numerator / denumerator
+    i = G_TFIDF.item_index.get(item1['_id'])
+    j = G_TFIDF.item_index.get(item2['_id'])
+    if i is None or j is None: return 0.0
+    return G_TFIDF.cosine(i, j)
 
 
 def cos_sim_recipes_tags(item1, item2):
@@ -528,90 +625,400 @@ def cos_sim_recipes_tags(item1, item2):
       cos  = ---------
               |x|.|y|
     """
-    global G_TAGS
     if item1['_id'] == item2['_id']: return 0.0
-    if len(item1['tags']) == 0 or len(item2['tags']) == 0: return 0.0
-
-    vector1 = []
-    vector2 = []
-
-    for tag in G_TAGS:
-        # print tag
-        if tag in item1['tags']:
-            vector1.append(1.0)
-        else:
-            vector1.append(0.0)
-        if tag in item2['tags']:
-            vector2.append(1.0)
-        else:
-            vector2.append(0.0)
-    # print vector1
-    numerator, pow1, pow2 = 0.0, 0.0, 0.0
-
-    for i in range(0, len(G_TAGS)):
-        numerator = numerator + (vector1[i] * vector2[i])
-        pow1 = pow1 + (vector1[i] * vector1[i])
-        pow2 = pow2 + (vector2[i] * vector2[i])
-
-    denumerator = math.sqrt(pow1) * math.sqrt(pow2)
-    if denumerator == 0.0:
-        return 0.0
+    i = G_TAGBITS.item_index.get(item1['_id'])
+    j = G_TAGBITS.item_index.get(item2['_id'])
+    if i is None or j is None: return 0.0
+    return G_TAGBITS.cosine(i, j)
+
+
+def compute_tag_vectors(base=None, changes=None):
+    """
+    Encode tags of all recipes as bitsets over tag dictionary G_TAGS
+    and save it to global variable G_TAGBITS.
+    With a snapshot only tags of changed recipes are encoded again.
+
+    :param base: snapshot.Snapshot up to date with the last run, None reads everything
+    :param changes: changelog.Changes since the snapshot
+    """
+    global G_TAGS, G_TAGBITS
+    # webapp adds new tags to the dictionary, the order of old tags never changes
+    G_TAGS = nonpcol.find_one({'_id': 1}, {'tags': 1}).get('tags')
+    if base is None or G_TAGS[:len(base.tags.tags)] != base.tags.tags:
+        recipes = [(recipe['_id'], recipe.get('tags', [])) for recipe in recipecol.find({}, {'tags': 1})]
+        G_TAGBITS = TagBitsets.build(G_TAGS, recipes)
+        return
+    recipes = list(changes.items[changelog.RECIPE])
+    recipes += missing_ids(recipecol, base.tags.item_index, recipes)
+    if not recipes and len(G_TAGS) == len(base.tags.tags):
+        G_TAGBITS = base.tags
+        return
+    G_TAGBITS = base.tags.updated(G_TAGS, [(recipe['_id'], recipe.get('tags', []))
+                                           for recipe in recipecol.find(only(recipes), {'tags': 1})])
+
+
+def compute_idf(base=None, changes=None):
+    """
+    compute idf for all ingredients in recipes
+    and save it to global variable G_INGREDIENTS
+    then we can use the idf later
+    also build tf-idf matrix of recipes G_TFIDF from it
+    With a snapshot only ingredients of changed recipes are counted again.
+
+    :param base: snapshot.Snapshot up to date with the last run, None reads everything
+    :param changes: changelog.Changes since the snapshot
+    """
+    global G_INGREDIENTS, G_TFIDF
+    recipes = None
+    if base is not None:
+        recipes = list(changes.items[changelog.RECIPE])
+        recipes += missing_ids(recipecol, base.ingredients.item_index, recipes)
+        if not recipes:
+            G_INGREDIENTS, G_TFIDF = base.ingredients.idf, base.ingredients
+            return
+    # get ingredients of all recipes or of changed recipes only
+    ingredients = [(recipe['_id'], [ingredient['ingredient'] for ingredient in recipe['ingredients']])
+                   for recipe in recipecol.find(only(recipes), {'ingredients.ingredient': 1})]
+    item_ids, names, occurrences = IngredientMatrix.count(ingredients, base.ingredients if base else None)
+    # compute idf, the same as search in webapp uses, ingredient listed twice in recipe counts twice
+    df = np.asarray(occurrences.sum(axis=0)).ravel()
+    G_INGREDIENTS = dict((name, textindex.idf(len(item_ids), df[col])) for col, name in enumerate(names))
+    G_TFIDF = IngredientMatrix.from_occurrences(item_ids, names, occurrences, G_INGREDIENTS)
+
+def affected_users(changes):
+    """
+    Users whose neighbours and predictions can change because of changes.
+
+    :param changes: changelog.Changes
+    :return: (users for similar people, users for predictions)
+    """
+    rated = changes.items[changelog.RATING]
+    neighbours = set(changes.users[changelog.RATING])
+    # pearson similarity changes with everybody who rated the same recipe
+    for itemid in rated:
+        i = G_RATINGS.item_index.get(itemid)
+        if i is None: continue
+        neighbours.update(G_RATINGS.user_ids[u] for u in G_RATINGS.item_ratings(i)[0])
+
+    predicted = neighbours | changes.users[changelog.FAVORITE]
+    # and users who have changed users as neighbours get new predictions too
+    for user in resultuserscol.find({'similar_users.userid': {'$in': list(neighbours)}}, {'_id': 1}):
+        predicted.add(user['_id'])
+    return neighbours, predicted
+
+
+def affected_items(changes):
+    """
+    Recipes whose similar recipes can change because of changed recipes:
+    the changed ones, recipes which have a changed recipe as a similar one
+    and recipes to which a changed recipe is now more similar than their
+    least similar recipe of the same type.
+
+    :param changes: changelog.Changes
+    :return: set of recipe ids
+    """
+    changed = changes.items[changelog.RECIPE]
+    affected = set(changed)
+    for recipe in resultrecipecol.find({'similar_items.itemid': {'$in': list(changed)}}, {'_id': 1}):
+        affected.add(recipe['_id'])
+
+    # the best similarity of a changed recipe to every recipe, by type of similar_items
+    closest = {}
+    for kind, model in ((2, G_TFIDF), (1, G_TAGBITS)):
+        rows = model.rows(changed)
+        if not rows: continue
+        best = np.zeros(len(model.item_ids))
+        for block, sims in model.similar_blocks(rows):
+            best = np.maximum(best, sims.max(axis=0))
+        for i in np.nonzero(best > 0)[0]:
+            closest.setdefault(model.item_ids[i], {})[kind] = best[i]
+
+    candidates = [itemid for itemid in closest if itemid not in affected]
+    found = set()
+    for recipe in resultrecipecol.find(only(candidates), {'similar_items': 1}):
+        found.add(recipe['_id'])
+        similar = recipe.get('similar_items', [])
+        for kind, value in closest[recipe['_id']].items():
+            values = [item['value'] for item in similar if item['type'] == kind]
+            if len(values) < 2 or value > min(values):
+                affected.add(recipe['_id'])
+    # recipes without similar recipes yet
+    affected.update(itemid for itemid in candidates if itemid not in found)
+    return affected
+
+
+def sharded(stage, ids, run, allids):
+    """
+    Run stage for ids, split to shards in worker processes when there are more workers.
+    Workers are forked now, so they share G_RATINGS, G_TFIDF and G_TAGBITS with us.
+
+    :param stage: stage function taking ids of users or recipes, None for all
+    :param ids: ids to process, None for all
+    :param run: Run with number of worker processes and lease of the engine
+    :param allids: all ids, to split them when ids is None
+    """
+    if run.workers <= 1:
+        stage(ids)
     else:
-        return numerator / denumerator
-
-def compute_idf():
-   """
-   compute idf for all ingredients in recipes
-   and save it to global variable G_INGREDIENTS
-   then we can use the idf later
-   """
-    global G_INGREDIENTS
-    G_INGREDIENTS = {}
-    count_recipes = 0
-    # get all ingredients
-    for recipe in recipecol.Recipe.find():
-        count_recipes += 1
-        for ingredient in recipe['ingredients']:
-            if not G_INGREDIENTS.get(ingredient['ingredient']):
-                G_INGREDIENTS[ingredient['ingredient']] = 1
-            else:
-                G_INGREDIENTS[ingredient['ingredient']] += 1
-    # compute idf
-    for ingredient in G_INGREDIENTS.keys():
-        G_INGREDIENTS[ingredient] = math.log10(float(count_recipes) / float(G_INGREDIENTS[ingredient]))
-
-def clear():
-    """
-    Before we compute new recommendation, we need to clean some data from database.
-    """
-    nonpcol.update({'_id': 1}, {'$pull': {'topfavorites': {'$exists': True}}}, multi=True)
-    nonpcol.update({'_id': 1}, {'$pull': {'toprated': {'$exists': True}}}, multi=True)
-    userscol.update({}, {'$pull': {'similar_users': {'$exists': True}}}, multi=True)
-    userscol.update({}, {'$pull': {'predicted': {'$exists': True}}}, multi=True)
-    recipecol.update({}, {'$pull': {'similar_items': {'$exists': True}}}, multi=True)
-
-def recommend():
-    clear()
-    print "0. precompute avg.rating users"
-    precompute_avg_userratings()
-    print "1. computing most favorite items"
-    most_favorite()
-    print "2. computing average ratings for items"
-    average_ratings_recipes()
-    print "3. computing best rated items"
-    best_rated()
-    print "4. computing interesting with hacker news formula"
-    hackernews_interesting()
-    print "5. computing similar people"
-    similar_people()
-    print "6. computing idf"
-    compute_idf()
-    print "7. computing similar recipes/items"
-    similar_items()
-    print "8. computing collaborative filtering"
-    collaborative_filtering()
-    print "9. computing content based recommendations by tags"
-    content_based()
-
-
-recommend()
+        parallel.run_sharded(stage, allids if ids is None else ids, run.workers, connect,
+                             run.lease.lock if run.lease is not None else None)
+
+
+class Run(object):
+    """
+    Context of one engine run passed to every stage.
+    """
+
+    def __init__(self, changes=None, workers=1, base=None, lease=None):
+        """
+        :param changes: changelog.Changes to process, None recomputes everything
+        :param workers: number of worker processes for per user and per recipe stages
+        :param base: snapshot.Snapshot memory stages update with changes, None reads everything
+        :param lease: lease.Lease held by the run, None without lease
+        """
+        self.changes = changes
+        self.workers = workers
+        self.base = base
+        self.lease = lease
+        self.affected = None
+        self.recipes = None
+
+    def users(self, kind):
+        """
+        Ids of users changed by kind of change, None (all users) in full run.
+        """
+        if self.changes is None: return None
+        return self.changes.users[kind]
+
+    def items(self, kind):
+        """
+        Ids of recipes changed by kind of change, None (all recipes) in full run.
+        """
+        if self.changes is None: return None
+        return self.changes.items[kind]
+
+    def neighbours(self):
+        """
+        Ids of users whose similar people change, None (all users) in full run.
+        """
+        return self.affected_users()[0]
+
+    def predicted(self):
+        """
+        Ids of users whose predictions change, None (all users) in full run.
+        """
+        return self.affected_users()[1]
+
+    def affected_users(self):
+        # computed once, before similar people of users are rewritten
+        if self.changes is None: return None, None
+        if self.affected is None:
+            self.affected = affected_users(self.changes)
+        return self.affected
+
+    def similar(self):
+        """
+        Ids of recipes whose similar recipes change, None (all recipes) in full run.
+        """
+        if self.changes is None: return None
+        if self.recipes is None:
+            self.recipes = affected_items(self.changes)
+        return self.recipes
+
+
+RATINGS = [changelog.RATING]
+FAVORITES = [changelog.FAVORITE]
+RECIPES = [changelog.RECIPE]
+EVERYTHING = [changelog.RATING, changelog.FAVORITE, changelog.RECIPE]
+
+# stages of the engine, a stage runs after all stages it requires,
+# stages forking worker processes are exclusive and run alone
+STAGES = [
+    Stage('ratings', lambda run: load_ratings(run.base, run.changes),
+          memory=True, label="loading ratings"),
+    Stage('idf', lambda run: compute_idf(run.base, run.changes),
+          memory=True, label="6. computing idf"),
+    Stage('tags', lambda run: compute_tag_vectors(run.base, run.changes),
+          memory=True, label="6. computing tag vectors"),
+    # webapp keeps averages up to date, they are only checked in full runs
+    Stage('avg_users', lambda run: precompute_avg_userratings(run.users(changelog.RATING)),
+          requires=['ratings'], label="0. checking avg.rating users"),
+    Stage('most_favorite', lambda run: most_favorite(),
+          inputs=FAVORITES, label="1. computing most favorite items"),
+    Stage('avg_recipes', lambda run: average_ratings_recipes(run.items(changelog.RATING)),
+          requires=['ratings'], label="2. checking average ratings for items"),
+    Stage('best_rated', lambda run: best_rated(),
+          requires=['avg_recipes'], inputs=RATINGS, label="3. computing best rated items"),
+    Stage('interesting', lambda run: hackernews_interesting(),
+          inputs=FAVORITES, label="4. computing interesting with hacker news formula"),
+    Stage('similar_people', lambda run: sharded(similar_people, run.neighbours(), run, G_RATINGS.user_ids),
+          requires=['ratings'], inputs=RATINGS, exclusive=True, label="5. computing similar people"),
+    Stage('similar_items', lambda run: sharded(similar_items, run.similar(), run, G_TFIDF.item_ids),
+          requires=['idf', 'tags'], inputs=RECIPES, exclusive=True, label="7. computing similar recipes/items"),
+    Stage('collaborative_filtering', lambda run: sharded(collaborative_filtering, run.predicted(), run, G_RATINGS.user_ids),
+          requires=['ratings', 'similar_people'], inputs=EVERYTHING, exclusive=True,
+          label="8. computing collaborative filtering"),
+    Stage('content_based', lambda run: sharded(content_based, run.predicted(), run, G_RATINGS.user_ids),
+          requires=['ratings', 'idf', 'tags'], inputs=EVERYTHING, exclusive=True,
+          label="9. computing content based recommendations by tags"),
+]
+
+# stages building the model kept in snapshots
+MODEL = set(stage.name for stage in STAGES if stage.memory)
+
+
+def recommend(full=False, workers=parallel.WORKERS, selected=None, profile=None, snapshots=snapshot.DIRECTORY,
+              engine_lease=None):
+    """
+    Run the engine. Without full, only changes logged by webapp since
+    the last run are processed and stages whose inputs did not change are skipped,
+    nothing is done when there are no changes.
+    Full runs and runs of selected stages write a new generation of results
+    and publish it when all stages are done, other runs update the published one.
+    Measurements of stages are printed as JSON lines and saved to enginehistory,
+    other messages go to stderr so stdout holds only the JSON lines.
+    Full and incremental runs save the model to a snapshot, the next incremental
+    run starts from it and reads only changed users and recipes from database.
+
+    :param full: recompute everything
+    :param workers: number of worker processes for per user and per recipe stages
+    :param selected: names of stages to recompute for all users and recipes,
+                     change log is left for the next run
+    :param profile: directory for cProfile statistics of stages
+    :param snapshots: directory of snapshots of the model, None reads everything every run
+    :param engine_lease: lease.Lease of the run, checked between stages and before
+                         anything is committed or published, LeaseLost stops the run
+    """
+    meter = instrument.Instrument(mconnection, sys.stdout, profile)
+    check = engine_lease.check if engine_lease is not None else None
+    if selected:
+        # results of other stages are copied from the published generation
+        use_generation(generations.new_generation(mconnection, DATABASE, copy=True))
+        stages.execute(STAGES, stages.plan(STAGES, selected=selected), Run(None, workers, lease=engine_lease),
+                       runner=meter, check=check)
+        if check is not None:
+            check()
+        generations.publish(mconnection, G_GENERATION, RETIRED_SECONDS, DATABASE)
+        meter.save(mconnection[DATABASE].enginehistory, mode='stages', workers=workers, generation=G_GENERATION)
+        return
+
+    changes = changelog.pending_changes(mconnection)
+    published = generations.published_generation(mconnection, DATABASE)
+    # there is nothing to update before the first generation
+    full = full or published == 0
+    if full:
+        names, run = stages.plan(STAGES), Run(None, workers, lease=engine_lease)
+        use_generation(generations.new_generation(mconnection, DATABASE))
+    elif changes.empty():
+        print >> sys.stderr, "nothing changed"
+        return
+    else:
+        base = None
+        if snapshots:
+            base = snapshot.latest(changelog.watermark(mconnection), DATABASE, snapshots)
+        names, run = stages.plan(STAGES, changed=changes.kinds()), Run(changes, workers, base, engine_lease)
+        if snapshots:
+            # the whole model is saved for the next run, even if no stage needs all of it
+            names |= MODEL
+        use_generation(published)
+    stages.execute(STAGES, names, run, runner=meter, check=check)
+    if check is not None:
+        # another engine may run since our lease expired, its results win
+        check()
+    changelog.commit_changes(mconnection, changes)
+    if full:
+        generations.publish(mconnection, G_GENERATION, RETIRED_SECONDS, DATABASE)
+    else:
+        cache.bump_results_version(mconnection, DATABASE)
+    saved = None
+    if snapshots:
+        saved = save_snapshot(snapshots)
+    meter.save(mconnection[DATABASE].enginehistory, mode='full' if full else 'incremental', workers=workers,
+               generation=G_GENERATION, base=run.base.path if run.base else None, snapshot=saved)
+
+
+def save_snapshot(directory):
+    """
+    Save the model to a snapshot up to date with the changes processed so far.
+    Results are already published, so a failure only makes the next run read everything.
+
+    :param directory: directory of snapshots
+    :return: path of snapshot, None when it could not be saved
+    """
+    try:
+        return snapshot.save(G_RATINGS, G_TFIDF, G_TAGBITS, changelog.watermark(mconnection), DATABASE, directory)
+    except (IOError, OSError) as e:
+        sys.stderr.write('snapshot was not saved: %s\n' % e)
+        return None
+
+
+def run_exclusive(full=False, workers=parallel.WORKERS, selected=None, profile=None, backoff=True,
+                  snapshots=snapshot.DIRECTORY):
+    """
+    Run the engine under the lease in enginestate, so that runs never overlap.
+    When another engine runs, a trigger is left for it and we exit, it runs
+    once more for all such triggers. Incremental runs coming sooner after the
+    last run than it took are skipped, the next one processes their changes.
+    A run which lost its lease stops with lease.LeaseLost before it commits
+    the change log or publishes results.
+
+    :param full: recompute everything
+    :param workers: number of worker processes for per user and per recipe stages
+    :param selected: names of stages to recompute, see recommend
+    :param profile: directory for cProfile statistics of stages
+    :param backoff: skip incremental run too soon after a long one
+    :param snapshots: directory of snapshots of the model, see recommend
+    """
+    engine_lease = lease.Lease(mconnection[DATABASE].enginestate)
+    mode = lease.FULL if full else lease.INCREMENTAL
+    if backoff and not full and not selected and engine_lease.too_soon():
+        print >> sys.stderr, "last run finished too recently, skipping"
+        return
+    if not engine_lease.acquire():
+        if not selected:
+            engine_lease.trigger(mode)
+        print >> sys.stderr, "engine is already running"
+        return
+    try:
+        while mode != lease.NONE:
+            started = time.time()
+            recommend(full=mode == lease.FULL, workers=workers, selected=selected, profile=profile,
+                      snapshots=snapshots, engine_lease=engine_lease)
+            selected = None
+            mode = engine_lease.finish(time.time() - started)
+    except:
+        engine_lease.release()
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recipe recommender engine.')
+    parser.add_argument('--full', action='store_true', help='recompute everything, not only changes')
+    parser.add_argument('--stage', action='append', dest='stages', metavar='NAME',
+                        choices=[stage.name for stage in STAGES],
+                        help='recompute only this stage for everything, can be repeated')
+    parser.add_argument('--workers', type=int, default=parallel.WORKERS,
+                        help='number of worker processes (default %(default)s)')
+    parser.add_argument('--profile', metavar='DIR', help='save cProfile statistics of every stage to DIR')
+    parser.add_argument('--force', action='store_true', help='do not skip run coming soon after a long one')
+    parser.add_argument('--snapshots', metavar='DIR', default=snapshot.DIRECTORY,
+                        help='directory of snapshots of the model (default %(default)s)')
+    parser.add_argument('--no-snapshot', action='store_true', help='read everything from database, save no snapshot')
+    parser.add_argument('--list', action='store_true', help='list stages and exit')
+    parser.add_argument('--check', type=int, metavar='USERS',
+                        help='compare batch similarities and predictions with pairwise ones for USERS users and exit')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for stage in STAGES:
+            print stage.name, '<-', ', '.join(stage.requires), '#', stage.label
+        return
+    if args.check:
+        sys.exit(0 if check(args.check) else 1)
+    schema.ensure_indexes(mconnection)
+    run_exclusive(full=args.full, workers=args.workers, selected=args.stages, profile=args.profile,
+                  backoff=not args.force, snapshots=None if args.no_snapshot else args.snapshots)
+
+
+if __name__ == '__main__':
+    main()
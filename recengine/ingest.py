@@ -0,0 +1,348 @@
+"""
+
+Bulk loader of rating and favorite events from JSONL or CSV files.
+Events are streamed through a pipeline of generators, so memory use does
+not grow with the size of files, and written in batches of ordered bulk
+operations. Every batch logs its changes, the next engine run picks them up.
+Rating aggregates and numbers of favorites are updated by every batch, from
+ratings of users of the batch only, so nothing is kept between batches.
+
+JSONL lines and CSV rows (with header) have fields
+    type         rating or favorite
+    userid       id of user, created when he does not exist
+    itemid       id of recipe
+    value        rating, for type rating
+    favorite     true/1 to add, false/0 to remove favorite, for type favorite
+    date_creation  ISO date of rating, now by default
+
+Usage: python ingest.py [--batch N] FILE [FILE ...]
+
+"""
+
+from mongokit import Connection
+from pymongo.errors import BulkWriteError
+from datetime import datetime
+from itertools import islice
+import argparse
+import csv
+import json
+import sys
+
+# i need to add this because of imports
+sys.path.append('../')
+
+from webapp.models import recommender, changelog, events
+from writer import BulkWriter
+
+# number of events written in one batch
+BATCH_SIZE = 5000
+
+# schema of one rating, the same as the webapp saves
+RATING = recommender.User.structure['ratings'][0]
+
+# lowest and highest rating
+MIN_RATING = 0.0
+MAX_RATING = 5.0
+
+# fields of users created by ingestion, the same as a new User() document has
+NEW_USER = {'fullname': None, 'email': None, 'password': None, 'ratings': [], 'similar_users': [],
+            'avgrating': 0.0, 'favorites': [], 'predicted': [],
+            'ratingsum': 0.0, 'ratingcount': 0, 'ratingsumsq': 0.0}
+
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+def read_lines(paths):
+    """
+    Raw events from files, JSONL or CSV by extension.
+
+    :param paths: list of file names
+    :return: generator of (file name, line number, dictionary)
+    """
+    for path in paths:
+        with open(path, 'rb') as f:
+            if path.endswith('.csv'):
+                for number, row in enumerate(csv.DictReader(f), 2):
+                    # values without column in header are under None
+                    if None in row:
+                        yield path, number, InvalidEvent('%d values more than columns' % len(row[None]))
+                        continue
+                    yield path, number, dict((key, value.decode('utf-8')) for key, value in row.items() if value)
+            else:
+                for number, line in enumerate(f, 1):
+                    if not line.strip(): continue
+                    try:
+                        yield path, number, json.loads(line)
+                    except ValueError, e:
+                        yield path, number, InvalidEvent('not json: %s' % e)
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    for format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise InvalidEvent('bad date %r' % value)
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if unicode(value).lower() in (u'1', u'true', u'yes'):
+        return True
+    if unicode(value).lower() in (u'0', u'false', u'no'):
+        return False
+    raise InvalidEvent('bad favorite %r' % value)
+
+
+# how to convert raw values to types of RATING schema
+CONVERTERS = {int: int, float: float, datetime: parse_date}
+
+
+def validate(raw):
+    """
+    Check and convert one raw event.
+
+    :param raw: dictionary from file
+    :return: ('rating', userid, {'itemid', 'value', 'date_creation'}) or ('favorite', userid, itemid, bool)
+    """
+    if isinstance(raw, Exception):
+        raise raw
+    kind = raw.get('type')
+    userid = raw.get('userid')
+    if not userid:
+        raise InvalidEvent('missing userid')
+    userid = unicode(userid)
+
+    if kind == 'favorite':
+        try:
+            return kind, userid, int(raw['itemid']), parse_bool(raw.get('favorite', True))
+        except (KeyError, TypeError, ValueError), e:
+            raise InvalidEvent('bad favorite: %s' % e)
+    if kind != 'rating':
+        raise InvalidEvent('unknown type %r' % kind)
+
+    rating = {}
+    for field, type in RATING.items():
+        value = raw.get(field)
+        if value is None and type is datetime:
+            value = datetime.now()
+        if value is None:
+            raise InvalidEvent('missing %s' % field)
+        try:
+            rating[field] = CONVERTERS[type](value)
+        except (TypeError, ValueError), e:
+            raise InvalidEvent('bad %s %r: %s' % (field, value, e))
+    if not MIN_RATING <= rating['value'] <= MAX_RATING:
+        raise InvalidEvent('rating %r out of range' % rating['value'])
+    return kind, userid, rating
+
+
+def valid_events(lines, errors=sys.stderr):
+    """
+    Validated events, invalid ones are reported and skipped.
+
+    :param lines: generator from read_lines
+    :param errors: file for reports of invalid events
+    :return: generator of events from validate
+    """
+    for path, number, raw in lines:
+        try:
+            yield validate(raw)
+        except InvalidEvent, e:
+            errors.write('%s:%d: %s\n' % (path, number, e))
+
+
+def batches(iterable, size):
+    """
+    Split iterable to lists of size items.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch: return
+        yield batch
+
+
+def read_ratings(db, users):
+    """
+    Ratings of users as they are before a batch, only the first rating of
+    recipe counts like in User.getRating.
+
+    :param users: ids of users
+    :return: dictionary user id -> dictionary recipe id -> rating
+    """
+    before = dict((userid, {}) for userid in users)
+    for user in db.users.find({'_id': {'$in': list(before)}}, {'ratings.itemid': 1, 'ratings.value': 1}):
+        values = before[user['_id']]
+        for rating in user.get('ratings', []):
+            values.setdefault(rating['itemid'], rating['value'])
+    return before
+
+
+def rating_changes(before, ratings):
+    """
+    Aggregates of users and changes of aggregates of recipes after ratings
+    are written. A rating replaces the first rating of user for recipe, the
+    same one the update of ratings.$ changes.
+
+    :param before: ratings of users from read_ratings
+    :param ratings: list of (user id, recipe id, rating) in order of writing
+    :return: (dictionary user id -> RatingAggregate, dictionary recipe id -> RatingAggregate of change)
+    """
+    after = dict((userid, dict(values)) for userid, values in before.items())
+    changes = {}
+    for userid, itemid, value in ratings:
+        values = after.setdefault(userid, {})
+        change = events.RatingAggregate.of(value)
+        if itemid in values:
+            change = change - events.RatingAggregate.of(values[itemid])
+        changes[itemid] = changes.get(itemid, events.RatingAggregate()) + change
+        values[itemid] = value
+    totals = {}
+    for userid in set(userid for userid, _, _ in ratings):
+        totals[userid] = sum((events.RatingAggregate.of(value) for value in after[userid].values()),
+                             events.RatingAggregate())
+    return totals, changes
+
+
+def write_batch(mconnection, batch):
+    """
+    Write one batch of events with ordered bulk operations, so later events
+    of the same user and recipe win. Changes are logged for the engine.
+    Aggregates of users of the batch are computed from their ratings read
+    before the batch, recipes get the changes of their aggregates with $inc
+    like events.rate does it, so no other user is read.
+    When a write fails, changes of the events written before it are still
+    logged and applied to aggregates and the error is raised then.
+
+    :param mconnection: mongodb connection
+    :param batch: list of events from validate
+    """
+    db = mconnection['recsys']
+    before = read_ratings(db, set(event[1] for event in batch if event[0] == 'rating'))
+    users = db.users.initialize_ordered_bulk_op()
+    operations = 0
+    created = set()
+    # (index of the last operation of event on users, update of recipe or None, change, rating or None)
+    written = []
+
+    for event in batch:
+        kind, userid = event[0], event[1]
+        if userid not in created:
+            users.find({'_id': userid}).upsert().update_one({'$setOnInsert': NEW_USER})
+            operations += 1
+            created.add(userid)
+        if kind == 'rating':
+            rating = event[2]
+            itemid = rating['itemid']
+            users.find({'_id': userid, 'ratings.itemid': itemid}).update_one(
+                {'$set': {'ratings.$.value': rating['value'], 'ratings.$.date_creation': rating['date_creation']}})
+            users.find({'_id': userid, 'ratings.itemid': {'$ne': itemid}}).update_one({'$push': {'ratings': rating}})
+            operations += 2
+            written.append((operations - 1, None, (changelog.RATING, userid, itemid),
+                            (userid, itemid, rating['value'])))
+        else:
+            itemid, add = event[2], event[3]
+            operator = '$addToSet' if add else '$pull'
+            users.find({'_id': userid}).update_one({operator: {'favorites': itemid}})
+            operations += 1
+            # counted only when the favorite really changes, the same as events.favorite
+            recipe = ({'_id': itemid, 'favorites': {'$ne': userid} if add else userid},
+                      {operator: {'favorites': userid}, '$inc': {'favoritecount': 1 if add else -1}})
+            written.append((operations - 1, recipe, (changelog.FAVORITE, userid, itemid), None))
+
+    error = None
+    try:
+        users.execute()
+    except BulkWriteError, e:
+        # ordered bulk operation stops at the first error, operations before it are applied
+        error = e
+        failed = e.details['writeErrors'][0]['index']
+        written = [entry for entry in written if entry[0] < failed]
+
+    recipes = [entry[1] for entry in written if entry[1] is not None]
+    if recipes:
+        bulk = db.recipes.initialize_ordered_bulk_op()
+        for query, update in recipes:
+            bulk.find(query).update_one(update)
+        try:
+            bulk.execute()
+        except BulkWriteError, e:
+            # favorites of users are written, the engine has to see them anyway
+            error = error or e
+
+    totals, changes = rating_changes(before, [entry[3] for entry in written if entry[3] is not None])
+    update_aggregates(mconnection, totals, changes)
+    changelog.log_changes(mconnection, sorted(set(entry[2] for entry in written)))
+    if error is not None:
+        raise error
+
+
+def update_aggregates(mconnection, totals, changes):
+    """
+    Store aggregates of users and add changes to aggregates of recipes, then
+    store averages of the recipes computed from their new aggregates.
+
+    :param mconnection: mongodb connection
+    :param totals: dictionary user id -> RatingAggregate of all ratings
+    :param changes: dictionary recipe id -> RatingAggregate of change
+    """
+    db = mconnection['recsys']
+    with BulkWriter(db.users) as writer:
+        for userid, total in totals.items():
+            fields = total.fields()
+            fields['avgrating'] = total.average(0.0)
+            writer.set(userid, fields)
+    if not changes: return
+    with BulkWriter(db.recipes) as writer:
+        for itemid, change in changes.items():
+            writer.update(itemid, {'$inc': change.fields()})
+    bulk = db.recipes.initialize_unordered_bulk_op()
+    for recipe in db.recipes.find({'_id': {'$in': list(changes)}}, events.AGGREGATE_FIELDS):
+        # stored only while aggregates are the same, like events.set_average
+        query = dict((field, recipe.get(field)) for field in events.AGGREGATE_FIELDS)
+        query['_id'] = recipe['_id']
+        bulk.find(query).update_one({'$set': {'avgrating': events.stored_aggregate(recipe).average(None)}})
+    bulk.execute()
+
+
+def ingest(mconnection, paths, batch_size=BATCH_SIZE, errors=sys.stderr):
+    """
+    Load all events from files.
+
+    :param mconnection: mongodb connection
+    :param paths: list of JSONL or CSV file names
+    :param batch_size: number of events written at once
+    :param errors: file for reports of invalid events
+    :return: number of written events
+    """
+    written = 0
+    for batch in batches(valid_events(read_lines(paths), errors), batch_size):
+        write_batch(mconnection, batch)
+        written += len(batch)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load rating and favorite events from JSONL or CSV files.')
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE,
+                        help='number of events written at once (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    started = datetime.now()
+    written = ingest(Connection(), args.files, args.batch)
+    seconds = max((datetime.now() - started).total_seconds(), 1e-6)
+    print "%d events in %.1f s, %.0f events/s" % (written, seconds, written / seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+
+Measurements of engine stages.
+Every stage is timed and its counters, peak memory and the work of the
+database server during the stage are written as one JSON line. Stages add
+to counters with count(), worker processes send their counters back with
+their results.
+
+Peak memory of the engine process is reset before every stage where linux
+allows it (/proc/self/clear_refs), so it is the peak of the stage, stages
+running at the same time share it. Otherwise it is the peak of the whole
+process so far and the record says so with peak_rss_cumulative. The peak of
+worker processes can not be reset, workers_peak_rss_mb is the largest of
+all finished workers so far. Round trips and documents are differences of
+serverStatus of the whole server, requests of webapps and other clients
+during the stage are included in them. All records of a run are saved in enginehistory, so a stage
+which got slower after data grew can be found later. cProfile of every
+stage is saved when a profile directory is given.
+
+"""
+
+from datetime import datetime
+from pymongo.errors import OperationFailure
+import threading
+import resource
+import cProfile
+import json
+import time
+import os
+
+# counters of the stage running in this thread, None when nothing is measured
+_local = threading.local()
+
+
+def count(name, n=1):
+    """
+    Add n to counter of the stage running in this thread.
+
+    :param name: name of counter, e.g. written or pairs
+    :param n: number to add
+    """
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + n
+
+
+def start_counting():
+    _local.counters = {}
+
+
+def stop_counting():
+    """
+    Stop counting in this thread.
+
+    :return: dictionary counter -> number counted since start_counting
+    """
+    counters = getattr(_local, 'counters', None) or {}
+    _local.counters = None
+    return counters
+
+
+def add_counts(counters):
+    """
+    Add counters, e.g. from a worker process, to the stage running in this thread.
+    """
+    for name, n in counters.items():
+        count(name, n)
+
+
+# files of linux for resetting and reading peak memory of this process
+CLEAR_REFS = '/proc/self/clear_refs'
+STATUS = '/proc/self/status'
+
+
+def reset_peak_rss():
+    """
+    Start measuring peak resident memory of this process again.
+
+    :return: False when the system does not allow it
+    """
+    try:
+        with open(CLEAR_REFS, 'w') as f:
+            # 5 resets the peak, see proc(5)
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """
+    Peak resident memory in MB of this process since reset_peak_rss,
+    or since the start of the process when it can not be reset.
+    """
+    try:
+        with open(STATUS) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def workers_peak_rss():
+    """
+    Peak resident memory in MB of the largest finished worker process so far.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+
+def server_counters(mconnection):
+    """
+    Operations and documents the mongodb server processed so far, for all its
+    clients, not only for the engine.
+
+    :param mconnection: mongodb connection
+    :return: dictionary with round_trips, documents_read and documents_written,
+             None when serverStatus is not allowed
+    """
+    try:
+        status = mconnection['admin'].command('serverStatus')
+    except OperationFailure:
+        return None
+    documents = status.get('metrics', {}).get('document', {})
+    return {'round_trips': sum(int(value) for value in status['opcounters'].values()),
+            'documents_read': int(documents.get('returned', 0)),
+            'documents_written': int(sum(documents.get(kind, 0) for kind in ('inserted', 'updated', 'deleted')))}
+
+
+class Instrument(object):
+    """
+    Runner of stages for stages.execute which measures every stage.
+    Server counters include the work of all clients of the server, also of
+    stages running at the same time and of webapps.
+    """
+
+    def __init__(self, mconnection, output=None, profile=None):
+        """
+        :param mconnection: mongodb connection
+        :param output: file for JSON lines of stages, None writes nothing
+        :param profile: directory for cProfile statistics of stages, None does not profile
+        """
+        self.mconnection = mconnection
+        self.output = output
+        self.profile = profile
+        if profile and not os.path.isdir(profile):
+            os.makedirs(profile)
+        self.records = []
+        self.started = datetime.now()
+        self.lock = threading.Lock()
+
+    def __call__(self, stage, run):
+        before = server_counters(self.mconnection)
+        reset = reset_peak_rss()
+        started = datetime.now()
+        clock = time.time()
+        start_counting()
+        try:
+            if self.profile:
+                profiler = cProfile.Profile()
+                profiler.runcall(stage.function, run)
+                profiler.dump_stats(os.path.join(self.profile, stage.name + '.prof'))
+            else:
+                stage.function(run)
+        finally:
+            counters = stop_counting()
+
+        record = {'stage': stage.name, 'label': stage.label, 'started': started,
+                  'seconds': time.time() - clock, 'peak_rss_mb': peak_rss(),
+                  'workers_peak_rss_mb': workers_peak_rss(), 'counters': counters}
+        if not reset:
+            record['peak_rss_cumulative'] = True
+        after = server_counters(self.mconnection)
+        if before is not None and after is not None:
+            for name in after:
+                record[name] = after[name] - before[name]
+            # serverStatus itself is one round trip
+            record['round_trips'] -= 1
+        with self.lock:
+            self.records.append(record)
+            if self.output is not None:
+                self.output.write(json.dumps(record, default=datetime.isoformat) + '\n')
+                self.output.flush()
+
+    def history(self, **fields):
+        """
+        Document about the whole run with records of all stages.
+
+        :param fields: other fields of document, e.g. mode of run
+        :return: dictionary
+        """
+        finished = datetime.now()
+        fields.update({'started': self.started, 'finished': finished,
+                       'seconds': (finished - self.started).total_seconds(), 'stages': self.records})
+        return fields
+
+    def save(self, collection, **fields):
+        """
+        Save history of the run to collection, e.g. enginehistory.
+        """
+        collection.insert(self.history(**fields))
@@ -0,0 +1,172 @@
+"""
+
+Lease which lets only one engine run at a time.
+The lease is a document in enginestate, owned by one process until it
+releases it or stops renewing it. A heartbeat thread renews it while the
+engine runs, so a crashed engine blocks others for LEASE_SECONDS at most.
+Engines started while another one runs do not wait, they leave a trigger
+in the lease document and exit. The owner runs once more for all triggers
+left during its run. Duration of the last run is kept in the lease too, so
+cron triggers coming too soon after a long run are skipped.
+An engine whose lease was lost, e.g. because it was stuck longer than
+LEASE_SECONDS, must stop before it commits or publishes anything, another
+engine may already run. check() raises LeaseLost then.
+
+"""
+
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+import threading
+import socket
+import uuid
+import sys
+import os
+
+# seconds after which lease of engine which stopped renewing it can be taken
+LEASE_SECONDS = 300
+
+# seconds between renewals of lease
+HEARTBEAT_SECONDS = 60
+
+# triggers left in the lease, a full run covers an incremental one
+NONE = 0
+INCREMENTAL = 1
+FULL = 2
+
+# incremental runs are skipped until the last run is this many of its durations old
+BACKOFF = 1.0
+
+
+class LeaseLost(Exception):
+    """
+    The lease expired and may be held by another engine now.
+    """
+
+
+class Lease(object):
+    """
+    Lease of the engine in a document of enginestate.
+    Times are in UTC, engines on different machines compare them.
+    """
+
+    def __init__(self, collection, name='engine', seconds=LEASE_SECONDS, heartbeat=HEARTBEAT_SECONDS):
+        """
+        :param collection: enginestate collection
+        :param name: id of lease document
+        :param seconds: how long the lease is valid without renewal
+        :param heartbeat: seconds between renewals
+        """
+        self.collection = collection
+        self.name = name
+        self.seconds = seconds
+        self.heartbeat = heartbeat
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+        # held while the heartbeat talks to the database, processes are not forked meanwhile
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take the lease when nobody holds it or it expired and start renewing it.
+
+        :return: True if the lease is ours now
+        """
+        now = datetime.utcnow()
+        try:
+            self.collection.find_and_modify(
+                {'_id': self.name, '$or': [{'owner': None}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': self.owner, 'acquired': now, 'expires': now + timedelta(seconds=self.seconds)},
+                 '$setOnInsert': {'pending': NONE}},
+                upsert=True, new=True)
+        except DuplicateKeyError:
+            # somebody else holds the lease, the upsert could not create it again
+            return False
+        self.lost = False
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.renew)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def renew(self):
+        while not self.stopped.wait(self.heartbeat):
+            now = datetime.utcnow()
+            with self.lock:
+                renewed = self.collection.update({'_id': self.name, 'owner': self.owner, 'expires': {'$gt': now}},
+                                                 {'$set': {'expires': now + timedelta(seconds=self.seconds)}})['n']
+            if renewed == 0:
+                self.lost = True
+                sys.stderr.write('lease %s of %s was lost\n' % (self.name, self.owner))
+                return
+
+    def check(self):
+        """
+        Raise LeaseLost unless the lease is still ours and did not expire.
+        Engine calls it between stages and before it commits or publishes results.
+        """
+        if not self.lost:
+            state = self.collection.find_one({'_id': self.name}, {'owner': 1, 'expires': 1}) or {}
+            if state.get('owner') != self.owner or state.get('expires') is None \
+                    or state['expires'] <= datetime.utcnow():
+                self.lost = True
+        if self.lost:
+            raise LeaseLost('lease %s of %s was lost' % (self.name, self.owner))
+
+    def trigger(self, mode=INCREMENTAL):
+        """
+        Ask the running engine for one more run after its current one.
+
+        :param mode: INCREMENTAL or FULL
+        """
+        self.collection.update({'_id': self.name}, {'$max': {'pending': mode}}, upsert=True)
+
+    def too_soon(self, factor=BACKOFF):
+        """
+        True if the last run finished less than factor times its duration ago.
+        """
+        state = self.collection.find_one({'_id': self.name}, {'finished': 1, 'duration': 1}) or {}
+        if state.get('finished') is None or not state.get('duration'):
+            return False
+        return datetime.utcnow() - state['finished'] < timedelta(seconds=state['duration'] * factor)
+
+    def finish(self, seconds):
+        """
+        Record duration of a run and release the lease, unless triggers were left during the run.
+
+        :param seconds: duration of the run
+        :return: mode of the next run, NONE when the lease was released
+        :raise LeaseLost: when the lease was lost during the run
+        """
+        if self.lost or self.collection.update({'_id': self.name, 'owner': self.owner},
+                                               {'$set': {'finished': datetime.utcnow(),
+                                                         'duration': seconds}})['n'] == 0:
+            self.lost = True
+            self.stop()
+            raise LeaseLost('lease %s of %s was lost' % (self.name, self.owner))
+        if self.collection.update({'_id': self.name, 'owner': self.owner, 'pending': NONE},
+                                  {'$set': {'owner': None, 'expires': None}})['n'] == 1:
+            self.stop()
+            return NONE
+        # all triggers left so far are handled by the next run
+        state = self.collection.find_and_modify({'_id': self.name, 'owner': self.owner},
+                                                {'$set': {'pending': NONE}}, fields={'pending': 1})
+        if state is None:
+            self.lost = True
+            self.stop()
+            raise LeaseLost('lease %s of %s was lost' % (self.name, self.owner))
+        return state.get('pending', NONE)
+
+    def release(self):
+        """
+        Give up the lease, e.g. after a failed run.
+        """
+        self.stop()
+        self.collection.update({'_id': self.name, 'owner': self.owner}, {'$set': {'owner': None, 'expires': None}})
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
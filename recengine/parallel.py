@@ -0,0 +1,80 @@
+"""
+
+Sharded execution of engine stages in a pool of worker processes.
+Workers are forked after the rating matrix, idf table and content vectors
+are loaded, so they read them from the shared memory of the parent process
+without copying or pickling. Only shards of ids are sent to workers.
+
+Forked workers inherit only the forking thread, not the lease heartbeat or
+stages running in other threads (stages forking workers run alone). They
+open their own mongodb connection in the initializer and never touch the
+connection of the parent. The heartbeat holds its lock while it talks to
+the database and run_sharded forks under the same lock, so no worker starts
+with a copy of a socket or lock in the middle of a heartbeat.
+
+"""
+
+import multiprocessing
+import instrument
+
+# default number of worker processes, 1 runs everything in this process
+WORKERS = multiprocessing.cpu_count()
+
+# shards per worker, more shards balance uneven work better
+SHARDS_PER_WORKER = 4
+
+# function of the running stage, inherited by forked workers
+_FUNCTION = None
+
+
+def shards(ids, count):
+    """
+    Split ids to count interleaved shards.
+
+    :param ids: list of ids
+    :param count: number of shards
+    :return: list of non-empty lists of ids
+    """
+    ids = list(ids)
+    return [ids[start::count] for start in range(count) if ids[start::count]]
+
+
+def _run_shard(shard):
+    # counters of the shard go back to the stage in the parent process
+    instrument.start_counting()
+    result = _FUNCTION(shard)
+    return result, instrument.stop_counting()
+
+
+def run_sharded(function, ids, workers=WORKERS, initializer=None, fork_lock=None):
+    """
+    Call function(shard) for shards of ids in a pool of processes.
+    Entities in different shards must not depend on each other.
+
+    :param function: function taking list of ids
+    :param ids: ids of users or recipes to process
+    :param workers: number of worker processes
+    :param initializer: function called in every worker first, e.g. to open own db connection
+    :param fork_lock: lock held while workers are forked, e.g. lease.Lease.lock
+    :return: list of results of function for shards
+    """
+    global _FUNCTION
+    ids = list(ids)
+    if workers <= 1 or len(ids) <= 1:
+        return [function(ids)]
+
+    _FUNCTION = function
+    if fork_lock is not None:
+        with fork_lock:
+            pool = multiprocessing.Pool(workers, initializer)
+    else:
+        pool = multiprocessing.Pool(workers, initializer)
+    try:
+        results = pool.map(_run_shard, shards(ids, workers * SHARDS_PER_WORKER), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _FUNCTION = None
+    for result, counters in results:
+        instrument.add_counts(counters)
+    return [result for result, counters in results]
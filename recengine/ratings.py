@@ -0,0 +1,379 @@
+"""
+
+User x item rating matrix for the recommender engine.
+All ratings are pulled from mongodb once per run and kept in compressed
+sparse rows (per user) and columns (per recipe), so the algorithms never
+have to walk user['ratings'] lists again.
+
+python ratings.py checks pearson_blocks against pairwise pearson on random
+ratings, also after updated() as incremental runs use it.
+
+"""
+
+from array import array
+from scipy import sparse
+import numpy as np
+
+# how many cells (users x users) one block of pearson similarities may have
+BLOCK_CELLS = 1 << 22
+
+
+def add_ratings(row, ratings, item_ids, item_index, rows, cols, values):
+    """
+    Append ratings of user on row to rows, cols and values.
+
+    When user rated one recipe more times, only the first rating is used
+    in the same way as User.getRating does it. Recipes which are not
+    in item_index get new columns at the end.
+
+    :param row: row index of user
+    :param ratings: list of ratings {'itemid', 'value'} of user
+    :param item_ids: list of recipe ids, extended with new columns
+    :param item_index: dictionary recipe id -> column index, extended with new columns
+    """
+    seen = set()
+    for rating in ratings:
+        col = item_index.get(rating['itemid'])
+        if col is None:
+            # rating of recipe which is not in recipes anymore, keep it for similarities
+            col = item_index[rating['itemid']] = len(item_ids)
+            item_ids.append(rating['itemid'])
+        if col in seen: continue
+        seen.add(col)
+        rows.append(row)
+        cols.append(col)
+        values.append(rating['value'])
+
+
+class RatingMatrix(object):
+    """
+    Ratings of all users stored as CSR (user rows) and CSC (recipe columns)
+    matrices with id <-> index maps for users and recipes.
+    """
+
+    def __init__(self, user_ids, item_ids, rows, cols, values, recipes=None):
+        """
+        :param user_ids: list of user ids, position is the row index
+        :param item_ids: list of recipe ids, position is the column index
+        :param rows: row index of every rating
+        :param cols: column index of every rating
+        :param values: value of every rating
+        :param recipes: number of first columns which are recipes in database, all columns by default
+        """
+        self.user_ids = list(user_ids)
+        self.item_ids = list(item_ids)
+        self.recipes = len(self.item_ids) if recipes is None else recipes
+        self.user_index = dict((userid, i) for i, userid in enumerate(self.user_ids))
+        self.item_index = dict((itemid, i) for i, itemid in enumerate(self.item_ids))
+
+        shape = (len(self.user_ids), len(self.item_ids))
+        coo = sparse.coo_matrix((np.asarray(values, dtype=np.float64),
+                                 (np.asarray(rows, dtype=np.int32), np.asarray(cols, dtype=np.int32))),
+                                shape=shape)
+        # explicit zero ratings are kept, the structure itself says what is rated
+        self.csr = coo.tocsr()
+        self.csr.sort_indices()
+        self.csc = self.csr.tocsc()
+        self.csc.sort_indices()
+
+        self.user_counts = np.diff(self.csr.indptr)
+        self.user_sums = np.bincount(coo.row, weights=coo.data, minlength=shape[0])
+        self.user_sumsq = np.bincount(coo.row, weights=coo.data * coo.data, minlength=shape[0])
+        self.item_counts = np.diff(self.csc.indptr)
+        self.item_sums = np.bincount(coo.col, weights=coo.data, minlength=shape[1])
+        self.item_sumsq = np.bincount(coo.col, weights=coo.data * coo.data, minlength=shape[1])
+
+    @classmethod
+    def load(cls, userscol, recipecol):
+        """
+        Read all ratings from database with only two queries.
+        When user rated one recipe more times, only the first rating is used.
+
+        :param userscol: users collection
+        :param recipecol: recipes collection
+        :return: new RatingMatrix
+        """
+        item_ids = [recipe['_id'] for recipe in recipecol.find({}, {'_id': 1})]
+        item_index = dict((itemid, i) for i, itemid in enumerate(item_ids))
+        recipes = len(item_ids)
+
+        user_ids = []
+        rows, cols, values = array('i'), array('i'), array('d')
+        for user in userscol.find({}, {'ratings.itemid': 1, 'ratings.value': 1}):
+            add_ratings(len(user_ids), user.get('ratings', []), item_ids, item_index, rows, cols, values)
+            user_ids.append(user['_id'])
+        return cls(user_ids, item_ids, rows, cols, values, recipes)
+
+    @classmethod
+    def from_arrays(cls, user_ids, item_ids, recipes, arrays):
+        """
+        Matrix from arrays of arrays(), e.g. memory mapped from a snapshot.
+        Nothing is sorted or summed again, arrays are used as they are.
+
+        :param user_ids: list of user ids, position is the row index
+        :param item_ids: list of recipe ids, position is the column index
+        :param recipes: number of first columns which are recipes in database
+        :param arrays: dictionary name -> array
+        :return: new RatingMatrix
+        """
+        matrix = cls.__new__(cls)
+        matrix.user_ids = list(user_ids)
+        matrix.item_ids = list(item_ids)
+        matrix.recipes = recipes
+        matrix.user_index = dict((userid, i) for i, userid in enumerate(matrix.user_ids))
+        matrix.item_index = dict((itemid, i) for i, itemid in enumerate(matrix.item_ids))
+
+        shape = (len(matrix.user_ids), len(matrix.item_ids))
+        matrix.csr = sparse.csr_matrix((arrays['csr_data'], arrays['csr_indices'], arrays['csr_indptr']), shape=shape)
+        matrix.csc = sparse.csc_matrix((arrays['csc_data'], arrays['csc_indices'], arrays['csc_indptr']), shape=shape)
+        matrix.user_counts = np.diff(matrix.csr.indptr)
+        matrix.user_sums = arrays['user_sums']
+        matrix.user_sumsq = arrays['user_sumsq']
+        matrix.item_counts = np.diff(matrix.csc.indptr)
+        matrix.item_sums = arrays['item_sums']
+        matrix.item_sumsq = arrays['item_sumsq']
+        return matrix
+
+    def arrays(self):
+        """
+        All arrays of the matrix, from_arrays() builds it from them again.
+
+        :return: dictionary name -> array
+        """
+        return {'csr_data': self.csr.data, 'csr_indices': self.csr.indices, 'csr_indptr': self.csr.indptr,
+                'csc_data': self.csc.data, 'csc_indices': self.csc.indices, 'csc_indptr': self.csc.indptr,
+                'user_sums': self.user_sums, 'user_sumsq': self.user_sumsq,
+                'item_sums': self.item_sums, 'item_sumsq': self.item_sumsq}
+
+    def updated(self, users, recipes=()):
+        """
+        New matrix with ratings of some users read again, the others are kept.
+        Users which are not in the matrix yet get new rows at the end.
+
+        :param users: list of (user id, list of ratings {'itemid', 'value'}) from database
+        :param recipes: ids of recipes added to database since the matrix was built
+        :return: new RatingMatrix
+        """
+        # new recipes are placed after old recipes, before ratings of recipes which are not in database
+        extra = self.item_ids[self.recipes:]
+        new, added = [], set()
+        for itemid in recipes:
+            if self.item_index.get(itemid, self.recipes) >= self.recipes and itemid not in added:
+                new.append(itemid)
+                added.add(itemid)
+        item_ids = self.item_ids[:self.recipes] + new
+        item_ids += [itemid for itemid in extra if itemid not in added]
+        item_index = dict((itemid, i) for i, itemid in enumerate(item_ids))
+        moved = np.array([item_index[itemid] for itemid in self.item_ids], dtype=np.int32)
+
+        user_ids = list(self.user_ids)
+        replaced = []
+        rows, cols, values = array('i'), array('i'), array('d')
+        for userid, ratings in users:
+            row = self.user_index.get(userid)
+            if row is None:
+                row = len(user_ids)
+                user_ids.append(userid)
+            else:
+                replaced.append(row)
+            add_ratings(row, ratings, item_ids, item_index, rows, cols, values)
+
+        # ratings of users which were not read again
+        oldrows = np.repeat(np.arange(len(self.user_ids), dtype=np.int32), np.diff(self.csr.indptr))
+        keep = ~np.in1d(oldrows, replaced)
+        return RatingMatrix(user_ids, item_ids,
+                            np.concatenate([oldrows[keep], np.asarray(rows, dtype=np.int32)]),
+                            np.concatenate([moved[self.csr.indices[keep]], np.asarray(cols, dtype=np.int32)]),
+                            np.concatenate([self.csr.data[keep], np.asarray(values, dtype=np.float64)]),
+                            self.recipes + len(new))
+
+    def user_ratings(self, u):
+        """
+        Ratings of user on row u.
+
+        :param u: row index of user
+        :return: (column indexes sorted, values) arrays
+        """
+        start, end = self.csr.indptr[u], self.csr.indptr[u + 1]
+        return self.csr.indices[start:end], self.csr.data[start:end]
+
+    def item_ratings(self, i):
+        """
+        Ratings of recipe on column i.
+
+        :param i: column index of recipe
+        :return: (row indexes sorted, values) arrays
+        """
+        start, end = self.csc.indptr[i], self.csc.indptr[i + 1]
+        return self.csc.indices[start:end], self.csc.data[start:end]
+
+    def rating(self, u, i):
+        """
+        Rating of user u for recipe i.
+
+        :return: value of rating or None if user did not rate the recipe.
+        """
+        indices, values = self.user_ratings(u)
+        pos = np.searchsorted(indices, i)
+        if pos < len(indices) and indices[pos] == i:
+            return float(values[pos])
+        return None
+
+    def user_mean(self, u):
+        """
+        Average rating of user on row u, 0.0 for user without ratings.
+        """
+        if self.user_counts[u] == 0:
+            return 0.0
+        return float(self.user_sums[u] / self.user_counts[u])
+
+    def user_means(self):
+        """
+        Average ratings of all users as array, 0.0 for users without ratings.
+        """
+        return self.user_sums / np.maximum(self.user_counts, 1)
+
+    def item_mean(self, i):
+        """
+        Average rating of recipe on column i, None for recipe without ratings.
+        """
+        if self.item_counts[i] == 0:
+            return None
+        return float(self.item_sums[i] / self.item_counts[i])
+
+    def pearson(self, u, v):
+        """
+        Pearson correlation between users on rows u and v over mutual ratings.
+
+        :return: similarity between two users.
+        """
+        indices1, values1 = self.user_ratings(u)
+        indices2, values2 = self.user_ratings(v)
+        if len(indices1) == 0 or len(indices2) == 0: return 0.0
+
+        # mutual ratings, both index arrays are sorted and unique
+        common, pos1, pos2 = np.intersect1d(indices1, indices2, assume_unique=True, return_indices=True)
+        if len(common) == 0: return 0.0
+        r1 = values1[pos1]
+        r2 = values2[pos2]
+
+        n = float(len(common))
+        sum1 = r1.sum()
+        sum2 = r2.sum()
+        sum1sq = (r1 * r1).sum()
+        sum2sq = (r2 * r2).sum()
+        psum = (r1 * r2).sum()
+
+        num = psum - (sum1 * sum2 / n)
+        den = (sum1sq - sum1 * sum1 / n) * (sum2sq - sum2 * sum2 / n)
+        if den <= 0.0:
+            return 0.0
+        return float(num / np.sqrt(den))
+
+    def pearson_blocks(self, users=None, block_size=None):
+        """
+        Pearson correlations of users against all users, computed with sparse
+        products over co-rated masks for a block of users at once.
+        For every pair the sums are taken only over mutually rated recipes,
+        so the scores are the same as from pearson().
+
+        :param users: row indexes of users to compute, all users by default
+        :param block_size: number of users in one block, by default it fits BLOCK_CELLS
+        :return: generator of (row indexes, similarities block x all users)
+        """
+        count = len(self.user_ids)
+        if users is None:
+            users = np.arange(count)
+        users = np.asarray(users, dtype=np.int64)
+        if block_size is None:
+            block_size = max(1, BLOCK_CELLS // max(count, 1))
+
+        values = self.csr
+        mask = values.copy()
+        mask.data = np.ones_like(mask.data)
+        squares = values.copy()
+        squares.data = squares.data * squares.data
+        values_t = values.T.tocsr()
+        mask_t = mask.T.tocsr()
+        squares_t = squares.T.tocsr()
+
+        for start in range(0, len(users), block_size):
+            block = users[start:start + block_size]
+            r, m, s = values[block], mask[block], squares[block]
+            n = m.dot(mask_t).toarray()
+            sum1 = r.dot(mask_t).toarray()
+            sum2 = m.dot(values_t).toarray()
+            sum1sq = s.dot(mask_t).toarray()
+            sum2sq = m.dot(squares_t).toarray()
+            psum = r.dot(values_t).toarray()
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                num = psum - (sum1 * sum2 / n)
+                den = (sum1sq - sum1 * sum1 / n) * (sum2sq - sum2 * sum2 / n)
+                sims = np.where((n > 0) & (den > 0), num / np.sqrt(den), 0.0)
+            yield block, sims
+
+
+
+def check_pearson(matrix, users=None, tolerance=1e-9):
+    """
+    Compare pearson_blocks with pearson for pairs of users, a regression
+    check that both give the same scores.
+
+    :param matrix: RatingMatrix
+    :param users: row indexes of users to check against all users, all users by default
+    :param tolerance: largest allowed difference of scores
+    :return: list of (u, v, score from pearson_blocks, score from pearson) which differ
+    """
+    differ = []
+    for block, sims in matrix.pearson_blocks(users):
+        for u, row in zip(block, sims):
+            for v in range(len(matrix.user_ids)):
+                expected = matrix.pearson(u, v)
+                if abs(row[v] - expected) > tolerance:
+                    differ.append((int(u), v, float(row[v]), expected))
+    return differ
+
+
+def random_ratings(users, items, seed):
+    """
+    Random ratings of users for self check, integer values like the webapp
+    saves them, so users with equal ratings are common.
+
+    :return: list of (user id, list of ratings {'itemid', 'value'})
+    """
+    generator = np.random.RandomState(seed)
+    return [(u, [{'itemid': int(i), 'value': float(generator.randint(1, 6))}
+                 for i in generator.choice(items, generator.randint(0, items // 3 + 1), replace=False)])
+            for u in range(users)]
+
+
+def self_check(users=80, items=60, seed=1):
+    """
+    Check pearson_blocks against pearson on random ratings, for a matrix
+    built at once and for one updated with changed users and new recipes
+    like an incremental run does it from a snapshot.
+
+    :return: list of differences from check_pearson
+    """
+    ratings = random_ratings(users, items, seed)
+    rows, cols, values = array('i'), array('i'), array('d')
+    item_ids = range(items)
+    item_index = dict((itemid, i) for i, itemid in enumerate(item_ids))
+    for row, (userid, userratings) in enumerate(ratings):
+        add_ratings(row, userratings, item_ids, item_index, rows, cols, values)
+    matrix = RatingMatrix([userid for userid, _ in ratings], item_ids, rows, cols, values)
+
+    # some users rate again, new users rate also new recipes
+    changed = random_ratings(users // 2, items + 10, seed + 1)[::3]
+    changed += [(users + u, userratings) for u, userratings in random_ratings(10, items + 10, seed + 2)]
+    updated = matrix.updated(changed, range(items, items + 10))
+    return check_pearson(matrix) + check_pearson(updated)
+
+
+if __name__ == '__main__':
+    differences = self_check()
+    for u, v, block, pairwise in differences[:20]:
+        print "users %d and %d: pearson_blocks %r, pearson %r" % (u, v, block, pairwise)
+    print "%d differences" % len(differences)
+    raise SystemExit(1 if differences else 0)
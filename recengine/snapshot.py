@@ -0,0 +1,190 @@
+"""
+
+Snapshots of the working model of the engine.
+Rating matrix, TF-IDF matrix with IDF of ingredients and tag bitsets are
+saved after every run to a directory of .npy arrays with a manifest. The next
+run maps the arrays to memory instead of reading all users and recipes from
+mongodb again and reads only users and recipes changed since then. Other
+readers can load a snapshot the same way, without the engine.
+
+Snapshots are written to a temporary directory which is renamed when it is
+complete, so readers never see a half written one. The manifest keeps the
+changelog watermark of enginestate at the time the snapshot was taken, a
+snapshot is used only while the watermark did not move, otherwise changes
+processed by a run which did not save a snapshot would be lost.
+
+"""
+
+from bson import json_util
+from datetime import datetime
+import numpy as np
+import shutil
+import os
+import re
+
+from ratings import RatingMatrix
+from content import IngredientMatrix, TagBitsets
+
+# version of the format, snapshots of other versions are ignored
+FORMAT = 1
+
+# snapshots kept in directory, the older ones are removed
+KEEP = 2
+
+# directory of snapshots of the engine
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+
+# names of snapshot directories, numbered in order of saving
+NAME = re.compile(r'^snapshot-(\d+)$')
+
+MANIFEST = 'manifest.json'
+IDS = 'ids.json'
+
+
+class Snapshot(object):
+    """
+    Model of the engine loaded from a snapshot.
+    """
+
+    def __init__(self, path, manifest, ratings, ingredients, tags):
+        """
+        :param path: directory of snapshot
+        :param manifest: dictionary from manifest.json
+        :param ratings: RatingMatrix
+        :param ingredients: IngredientMatrix
+        :param tags: TagBitsets
+        """
+        self.path = path
+        self.manifest = manifest
+        self.ratings = ratings
+        self.ingredients = ingredients
+        self.tags = tags
+
+    @property
+    def watermark(self):
+        return self.manifest['watermark']
+
+    def __repr__(self):
+        return '<Snapshot %s>' % self.path
+
+
+def snapshots(directory=DIRECTORY):
+    """
+    Snapshots in directory.
+
+    :return: list of (number, path) sorted from the oldest
+    """
+    if not os.path.isdir(directory): return []
+    found = []
+    for name in os.listdir(directory):
+        match = NAME.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def save(ratings, ingredients, tags, watermark, database, directory=DIRECTORY, keep=KEEP):
+    """
+    Save the model to a new snapshot and remove old snapshots.
+
+    :param ratings: RatingMatrix
+    :param ingredients: IngredientMatrix with occurrences
+    :param tags: TagBitsets
+    :param watermark: changelog watermark of enginestate the model is up to date with
+    :param database: name of database of the model
+    :param directory: directory of snapshots
+    :param keep: number of snapshots kept
+    :return: path of the new snapshot
+    """
+    existing = snapshots(directory)
+    number = existing[-1][0] + 1 if existing else 1
+    path = os.path.join(directory, 'snapshot-%08d' % number)
+    temporary = os.path.join(directory, '.snapshot-%08d-%d' % (number, os.getpid()))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    os.mkdir(temporary)
+    try:
+        arrays = {}
+        for prefix, model in (('ratings', ratings.arrays()), ('ingredients', ingredients.arrays()),
+                              ('tags', {'bits': tags.bits})):
+            for name, values in model.items():
+                filename = '%s_%s.npy' % (prefix, name)
+                np.save(os.path.join(temporary, filename), np.ascontiguousarray(values))
+                arrays['%s_%s' % (prefix, name)] = filename
+        with open(os.path.join(temporary, IDS), 'w') as f:
+            f.write(json_util.dumps({'users': ratings.user_ids, 'items': ratings.item_ids,
+                                     'recipes': ingredients.item_ids, 'ingredients': ingredients.ingredients,
+                                     'tagitems': tags.item_ids, 'tags': tags.tags}))
+        manifest = {'format': FORMAT, 'number': number, 'created': datetime.utcnow(), 'database': database,
+                    'watermark': watermark, 'recipes': ratings.recipes, 'arrays': arrays}
+        with open(os.path.join(temporary, MANIFEST), 'w') as f:
+            f.write(json_util.dumps(manifest, indent=2))
+        os.rename(temporary, path)
+    except:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+
+    for _, old in snapshots(directory)[:-keep]:
+        shutil.rmtree(old, ignore_errors=True)
+    return path
+
+
+def load(path, mmap=True):
+    """
+    Load snapshot, arrays are mapped to memory read only.
+
+    :param path: directory of snapshot
+    :param mmap: map arrays to memory instead of reading them
+    :return: Snapshot
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json_util.loads(f.read())
+    if manifest.get('format') != FORMAT:
+        raise ValueError('snapshot %s has format %r, not %d' % (path, manifest.get('format'), FORMAT))
+    with open(os.path.join(path, IDS)) as f:
+        ids = json_util.loads(f.read())
+
+    mode = 'r' if mmap else None
+    arrays = dict((name, np.load(os.path.join(path, filename), mmap_mode=mode))
+                  for name, filename in manifest['arrays'].items())
+
+    def model(prefix):
+        return dict((name[len(prefix) + 1:], values) for name, values in arrays.items()
+                    if name.startswith(prefix + '_'))
+
+    ratings = RatingMatrix.from_arrays(ids['users'], ids['items'], manifest['recipes'], model('ratings'))
+    ingredients = IngredientMatrix.from_arrays(ids['recipes'], ids['ingredients'], model('ingredients'))
+    tags = TagBitsets(ids['tags'], ids['tagitems'], model('tags')['bits'])
+    return Snapshot(path, manifest, ratings, ingredients, tags)
+
+
+def latest(watermark, database, directory=DIRECTORY, mmap=True):
+    """
+    The newest snapshot, if it is up to date with watermark.
+
+    :param watermark: changelog watermark of enginestate now
+    :param database: name of database the snapshot has to be of
+    :param directory: directory of snapshots
+    :param mmap: map arrays to memory instead of reading them
+    :return: Snapshot or None
+    """
+    existing = snapshots(directory)
+    if not existing: return None
+    path = existing[-1][1]
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json_util.loads(f.read())
+    except (IOError, ValueError):
+        return None
+    if manifest.get('format') != FORMAT or manifest.get('database') != database:
+        return None
+    if not same_watermark(manifest.get('watermark'), watermark):
+        return None
+    return load(path, mmap)
+
+
+def same_watermark(saved, current):
+    if saved is None or current is None:
+        return saved is current
+    # json keeps milliseconds of dates only
+    return abs(saved.replace(tzinfo=None) - current.replace(tzinfo=None)).total_seconds() < 0.001
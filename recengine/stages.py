@@ -0,0 +1,127 @@
+"""
+
+Stages of the engine declared as a dependency graph.
+The scheduler decides which stages have to run and runs stages whose
+requirements are done concurrently in threads.
+
+"""
+
+import threading
+
+
+class Stage(object):
+    """
+    One step of the engine.
+    """
+
+    def __init__(self, name, function, requires=(), inputs=(), memory=False, exclusive=False, label=None):
+        """
+        :param name: unique name of stage
+        :param function: function taking the run context
+        :param requires: names of stages which have to be done before
+        :param inputs: kinds of changes (changelog) the stage reads, stage is skipped when none of them changed
+        :param memory: stage only builds data in memory, it runs when a stage requiring it runs
+        :param exclusive: stage has to run alone, e.g. because it forks worker processes
+        :param label: description of stage
+        """
+        self.name = name
+        self.function = function
+        self.requires = list(requires)
+        self.inputs = set(inputs)
+        self.memory = memory
+        self.exclusive = exclusive
+        self.label = label or name
+
+    def __repr__(self):
+        return '<Stage %s>' % self.name
+
+
+def plan(stages, selected=None, changed=None):
+    """
+    Names of stages which have to run.
+
+    :param stages: list of all stages
+    :param selected: run only these stages, None for all
+    :param changed: kinds of changes since the last run, None when everything changed
+    :return: set of stage names, memory stages required by them included
+    """
+    bynames = dict((stage.name, stage) for stage in stages)
+    if selected is not None:
+        unknown = set(selected) - set(bynames)
+        if unknown:
+            raise ValueError('unknown stages %s' % ', '.join(sorted(unknown)))
+        names = set(selected)
+    elif changed is None:
+        names = set(bynames)
+    else:
+        names = set(stage.name for stage in stages if not stage.memory and stage.inputs & set(changed))
+
+    # data built in memory is needed again, persisted results of skipped stages are not
+    pending = list(names)
+    while pending:
+        for name in bynames[pending.pop()].requires:
+            if bynames[name].memory and name not in names:
+                names.add(name)
+                pending.append(name)
+    return names
+
+
+def execute(stages, names, run, concurrent=True, runner=None, check=None):
+    """
+    Run stages in order of dependencies. Stages whose requirements are done
+    run together in threads, exclusive stages run alone in this thread.
+    Requirements which are not in names are taken as done.
+
+    :param stages: list of all stages in preferred order
+    :param names: names of stages to run
+    :param run: context passed to stage functions
+    :param concurrent: False runs one stage after another, e.g. to measure them
+    :param runner: function(stage, run) running one stage, run_stage by default
+    :param check: function called before every wave of stages, it raises to stop the run
+    """
+    runner = runner or run_stage
+    done = set()
+    remaining = [stage for stage in stages if stage.name in names]
+    while remaining:
+        ready = [stage for stage in remaining
+                 if all(name in done or name not in names for name in stage.requires)]
+        if not ready:
+            raise ValueError('cyclic requirements of stages %s' % remaining)
+        if check is not None:
+            check()
+
+        together = [stage for stage in ready if not stage.exclusive]
+        wave = together if together and concurrent else ready[:1]
+        if len(wave) == 1:
+            runner(wave[0], run)
+        else:
+            run_concurrently(wave, run, runner)
+        for stage in wave:
+            done.add(stage.name)
+            remaining.remove(stage)
+
+
+def run_stage(stage, run):
+    stage.function(run)
+
+
+def run_concurrently(wave, run, runner):
+    """
+    Run stages in threads and wait for all of them.
+    The first error of a stage is raised again here.
+    """
+    errors = []
+
+    def target(stage):
+        try:
+            runner(stage, run)
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=target, args=(stage,), name=stage.name) for stage in wave]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
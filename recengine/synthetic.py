@@ -0,0 +1,220 @@
+"""
+
+Synthetic datasets for benchmarks of the engine.
+Users and recipes have the same documents as the webapp writes. How often
+recipes are rated, how many ratings users give and how common tags and
+ingredients are follow power laws. Tags are the real tag dictionary of
+NonPersonal, ingredients are the real ones with a long synthetic tail.
+
+Usage: python synthetic.py --database recsys_synthetic --users N --items N
+
+"""
+
+from mongokit import Connection
+from datetime import datetime, timedelta
+import argparse
+import sys
+
+# i need to add this because of imports
+sys.path.append('../')
+
+from webapp.models import schema
+import numpy as np
+
+# exponents of zipf distributions of popularity of recipes, tags and ingredients
+ITEM_POPULARITY = 1.0
+TAG_POPULARITY = 1.0
+INGREDIENT_POPULARITY = 1.0
+
+# ratings per user are pareto distributed with this shape and minimum
+USER_ACTIVITY = 1.5
+MIN_RATINGS = 5
+
+# ratings are quality of recipe + bias of user + noise, rounded to halves
+MEAN_QUALITY = 3.5
+QUALITY_SPREAD = 0.7
+USER_BIAS = 0.5
+NOISE = 0.8
+
+# probability user faves recipe he rated 4.5 or better
+FAVORITE_PROBABILITY = 0.3
+
+# one synthetic ingredient per this many recipes is added to the real ones
+RECIPES_PER_INGREDIENT = 10
+
+# documents inserted at once
+INSERT_BATCH = 1000
+
+# dates of ratings and recipes are from this many last days
+DAYS = 365
+
+
+def zipf_cumulative(count, exponent):
+    """
+    Cumulative probabilities of zipf distribution over count ranks.
+    """
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    return np.cumsum(weights / weights.sum())
+
+
+def draw(random, cumulative, size):
+    """
+    Indexes drawn from cumulative distribution, repeated ones are left out.
+    """
+    picks = np.searchsorted(cumulative, random.random_sample(size), side='right')
+    return np.unique(np.minimum(picks, len(cumulative) - 1))
+
+
+def vocabulary(mconnection, source='recsys'):
+    """
+    Real tags and ingredients of the webapp.
+
+    :param mconnection: mongodb connection
+    :param source: database of the webapp
+    :return: (list of tags, list of ingredient names)
+    """
+    nonpersonal = mconnection[source].nonpersonal.find_one({'_id': 1}, {'tags': 1}) or {}
+    tags = nonpersonal.get('tags') or []
+    if not tags:
+        raise ValueError('no tags in %s.nonpersonal, run the webapp once to create them' % source)
+    ingredients = [name for name in mconnection[source].recipes.distinct('ingredients.ingredient') if name]
+    return tags, ingredients
+
+
+class Generator(object):
+    """
+    Random users with ratings and favorites and recipes with tags and ingredients.
+    """
+
+    def __init__(self, users, items, tags, ingredients, seed=0):
+        """
+        :param users: number of users
+        :param items: number of recipes
+        :param tags: tag dictionary
+        :param ingredients: real ingredient names
+        :param seed: seed of random numbers, the same seed gives the same dataset
+        """
+        self.users = users
+        self.items = items
+        self.tags = list(tags)
+        self.ingredients = list(ingredients) + [u'ingredient %d' % n for n in range(items // RECIPES_PER_INGREDIENT)]
+        self.random = np.random.RandomState(seed)
+        self.now = datetime.now()
+
+        self.item_popularity = zipf_cumulative(items, ITEM_POPULARITY)
+        self.tag_popularity = zipf_cumulative(len(self.tags), TAG_POPULARITY)
+        self.ingredient_popularity = zipf_cumulative(len(self.ingredients), INGREDIENT_POPULARITY)
+        # quality does not depend on popularity
+        self.quality = self.random.normal(MEAN_QUALITY, QUALITY_SPREAD, items)
+
+        # filled while users are generated, recipes need them
+        self.item_sums = np.zeros(items)
+        self.item_counts = np.zeros(items, dtype=np.int64)
+        self.item_sumsq = np.zeros(items)
+        self.favorites = {}
+        self.ratings = 0
+
+    def date(self):
+        return self.now - timedelta(seconds=int(self.random.randint(0, DAYS * 24 * 3600)))
+
+    def user_documents(self):
+        """
+        Generator of user documents, it has to be exhausted before recipe_documents.
+        """
+        for n in range(self.users):
+            userid = u'user%d' % n
+            count = min(self.items, int(MIN_RATINGS * (self.random.pareto(USER_ACTIVITY) + 1)))
+            items = draw(self.random, self.item_popularity, count)
+            values = self.quality[items] + self.random.normal(0, USER_BIAS) + self.random.normal(0, NOISE, len(items))
+            values = np.clip(np.round(values * 2) / 2, 1.0, 5.0)
+
+            np.add.at(self.item_sums, items, values)
+            np.add.at(self.item_counts, items, 1)
+            np.add.at(self.item_sumsq, items, values * values)
+            self.ratings += len(items)
+
+            favorites = [int(i) + 1 for i, value in zip(items, values)
+                         if value >= 4.5 and self.random.random_sample() < FAVORITE_PROBABILITY]
+            for itemid in favorites:
+                self.favorites.setdefault(itemid, []).append(userid)
+
+            ratings = [{'itemid': int(i) + 1, 'value': float(value), 'date_creation': self.date()}
+                       for i, value in zip(items, values)]
+            total = float(values.sum())
+            yield {'_id': userid, 'fullname': u'User %d' % n, 'email': u'user%d@example.com' % n,
+                   'password': u'synthetic', 'ratings': ratings, 'similar_users': [],
+                   'avgrating': total / len(values) if len(values) else 0.0,
+                   'favorites': favorites, 'predicted': [],
+                   'ratingsum': total, 'ratingcount': len(values), 'ratingsumsq': float((values * values).sum())}
+
+    def recipe_documents(self):
+        """
+        Generator of recipe documents, ids are 1..items like in the seed data.
+        """
+        for i in range(self.items):
+            itemid = i + 1
+            tags = [self.tags[t] for t in draw(self.random, self.tag_popularity, self.random.randint(1, 6))]
+            ingredients = [{'ingredient': self.ingredients[j], 'number': unicode(self.random.randint(1, 500))}
+                           for j in draw(self.random, self.ingredient_popularity, self.random.randint(3, 13))]
+            favorites = self.favorites.get(itemid, [])
+            count = int(self.item_counts[i])
+            yield {'_id': itemid, 'userid': u'user%d' % self.random.randint(0, max(self.users, 1)),
+                   'title': u'Recipe %d %s' % (itemid, ' '.join(tags)), 'text': u'',
+                   'date_creation': self.date(), 'favorites': favorites,
+                   'ingredients': ingredients, 'tags': tags,
+                   'avgrating': float(self.item_sums[i] / count) if count else None,
+                   'interesting': 0.0, 'similar_items': [], 'serves': int(self.random.randint(1, 9)),
+                   'ratingsum': float(self.item_sums[i]), 'ratingcount': count,
+                   'ratingsumsq': float(self.item_sumsq[i]), 'favoritecount': len(favorites)}
+
+
+def insert_all(collection, documents):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == INSERT_BATCH:
+            collection.insert(batch)
+            batch = []
+    if batch:
+        collection.insert(batch)
+
+
+def generate(mconnection, database, users, items, seed=0, source='recsys'):
+    """
+    Replace database with a synthetic dataset.
+
+    :param mconnection: mongodb connection
+    :param database: name of database to fill, it can not be the source
+    :param users: number of users
+    :param items: number of recipes
+    :param seed: seed of random numbers
+    :param source: database of the webapp with real tags and ingredients
+    :return: dictionary with numbers of users, items, ratings and favorites
+    """
+    if database == source:
+        raise ValueError('synthetic data would overwrite %s' % source)
+    tags, ingredients = vocabulary(mconnection, source)
+    mconnection.drop_database(database)
+    db = mconnection[database]
+
+    generator = Generator(users, items, tags, ingredients, seed)
+    insert_all(db.users, generator.user_documents())
+    insert_all(db.recipes, generator.recipe_documents())
+    db.nonpersonal.insert({'_id': 1, 'tags': tags, 'topfavorites': [], 'toprated': [], 'topinteresting': []})
+    schema.ensure_indexes(mconnection, database)
+    return {'users': users, 'items': items, 'ratings': generator.ratings,
+            'favorites': sum(len(favorites) for favorites in generator.favorites.values())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate synthetic users and recipes.')
+    parser.add_argument('--database', default='recsys_synthetic', help='database to replace (default %(default)s)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    print generate(Connection(), args.database, args.users, args.items, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+
+Bounded top-k selection used by every ranking step of the engine.
+Only k candidates are kept in memory instead of sorting whole lists.
+
+"""
+
+import heapq
+import numpy as np
+
+
+def top_k(items, k, key=None):
+    """
+    Select k largest items with a bounded min-heap.
+    Items with equal key keep their input order, same as stable sorted().
+
+    :param items: iterable (can be generator) of items
+    :param k: number of items to keep
+    :param key: function returning value of item, item itself by default
+    :return: list of at most k items sorted by key descending
+    """
+    if k <= 0:
+        return []
+    heap = []
+    for i, item in enumerate(items):
+        value = item if key is None else key(item)
+        # -i makes earlier items win ties and items are never compared
+        entry = (value, -i, item)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    heap.sort(reverse=True)
+    return [entry[2] for entry in heap]
+
+
+def top_k_indices(values, k):
+    """
+    Indexes of k largest values of array sorted by value descending,
+    equal values are ordered by index.
+
+    :param values: 1d array
+    :param k: number of indexes
+    :return: array of indexes
+    """
+    k = min(k, len(values))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(values):
+        threshold = np.partition(values, len(values) - k)[len(values) - k]
+        candidates = np.flatnonzero(values >= threshold)
+    else:
+        candidates = np.arange(len(values))
+    # lexsort is stable, last key is primary
+    order = np.lexsort((candidates, -values[candidates]))
+    return candidates[order][:k]
@@ -0,0 +1,85 @@
+"""
+
+Bulk write-back of results computed by the engine.
+Instead of saving every document on its own, the updates are buffered
+and sent to mongodb as unordered bulk operations.
+
+"""
+
+import instrument
+
+# default number of updates sent to database in one bulk operation
+BATCH_SIZE = 1000
+
+
+class BulkWriter(object):
+    """
+    Buffer of updates for one collection, flushed every batch_size updates
+    and when leaving the with block.
+
+    Every document should be updated only once per flush, because
+    unordered bulk operations do not keep the order of updates.
+    """
+
+    def __init__(self, collection, batch_size=BATCH_SIZE, upsert=False):
+        """
+        :param collection: mongodb collection to write to
+        :param batch_size: number of updates in one bulk operation
+        :param upsert: create documents which do not exist
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.pending = []
+        self.written = 0
+
+    def set(self, _id, fields):
+        """
+        Set computed fields of document.
+
+        :param _id: id of document
+        :param fields: dictionary field -> new value
+        """
+        self.update(_id, {'$set': fields})
+
+    def push(self, _id, field, values):
+        """
+        Append values to array field of document.
+
+        :param _id: id of document
+        :param field: name of array field
+        :param values: list of values to append
+        """
+        self.update(_id, {'$push': {field: {'$each': values}}})
+
+    def update(self, _id, update):
+        """
+        Buffer any update of document with id _id.
+        """
+        self.pending.append((_id, update))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send all buffered updates to database in one unordered bulk operation.
+        """
+        if not self.pending: return
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for _id, update in self.pending:
+            if self.upsert:
+                bulk.find({'_id': _id}).upsert().update_one(update)
+            else:
+                bulk.find({'_id': _id}).update_one(update)
+        bulk.execute()
+        self.written += len(self.pending)
+        instrument.count('written', len(self.pending))
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # do not write results of failed computation
+        if exc_type is None:
+            self.flush()
@@ -7,6 +7,9 @@ class Config(object):
   PASSWORD = 'default'
   TESTING = False
   UPLOAD_FOLDER = '/tmp/test'
+  # seconds between checks for new results of engine, the engine keeps
+  # results it replaced for twice as long, see generations.retention
+  RESULTS_CACHE_TTL = 60
 
 class ProductionConfig(Config):
   DATABASE = '/tmp/flaskr.db'
@@ -7,17 +7,25 @@ authors : Michal Lukac, Boris Valentovic
 
 from random import randint
 from mongokit import Connection
-from flask import Flask, request, session, flash, redirect, url_for, render_template, make_response
+from flask import Flask, request, session, flash, redirect, url_for, render_template, make_response, abort
+from bson.objectid import ObjectId, InvalidId
 from sqlalchemy import and_, or_
-from models import recommender
-from datetime import datetime
+from models import recommender, changelog, cache, textindex, facets, schema, events, generations
+from bisect import bisect_right
+import metrics
 import base64
 import json
-import re
 
 # allowed constants for file extension to database
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
 
+# fields of recipes shown in lists of recipes
+LISTING_FIELDS = {'title': 1, 'userid': 1, 'avgrating': 1}
+
+# default and maximal number of recipes on one page
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
 # create our mongodb connection and register models
 # this is our recommender computing database
 mconnection = Connection()
@@ -27,14 +35,26 @@ mconnection.register([recommender.NonPersonal])
 userscol = mconnection['recsys'].users
 recipecol = mconnection['recsys'].recipes
 nonpcol = mconnection['recsys'].nonpersonal
+schema.ensure_indexes(mconnection)
 
 # create our recsys app with flask framework
 app = Flask(__name__)
 app.config.from_object('config.Config')
 
+# latency of endpoints and their mongodb calls, served on /metrics
+request_metrics = metrics.Metrics(app)
+
+# hydrated top lists, kept until the engine writes new results
+results = cache.ResultCache(mconnection, app.config['RESULTS_CACHE_TTL'])
+
 
 def init_mongodb():
     recommender.init_mongodbnew(mconnection)
+    events.rebuild_aggregates(mconnection)
+    textindex.rebuild_index(mconnection)
+    facets.rebuild_facets(mconnection)
+    # collections were dropped with their indexes
+    schema.ensure_indexes(mconnection)
 
 
 def allowed_file(filename):
@@ -42,6 +62,139 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
 
 
+def hydrate_recipes(ids, fields=LISTING_FIELDS):
+    """
+    Fetch recipes by ids with one query and keep the order of ids,
+    which is the ranking computed by the engine.
+
+    :param ids: list of recipe ids
+    :param fields: projection of recipe fields
+    :return: list of recipes in order of ids, missing and repeated recipes are left out
+    """
+    ids = list(ids)
+    if not ids: return []
+    found = dict((recipe['_id'], recipe) for recipe in recipecol.find({'_id': {'$in': ids}}, fields))
+    return [found.pop(itemid) for itemid in ids if itemid in found]
+
+
+def engine_results(kind, _id, fields):
+    """
+    Results computed by the engine for user or recipe, from the published generation.
+
+    :param kind: generations.USERS or generations.RECIPES
+    :param _id: id of user or recipe
+    :param fields: projection of result fields
+    :return: dictionary of results, empty when engine did not compute any
+    """
+    collection = generations.results(mconnection, results.current_generation(), kind)
+    return collection.find_one({'_id': _id}, fields) or {}
+
+
+def top_list(field):
+    """
+    Hydrated recipes of one top list of the engine, cached between runs of engine.
+
+    :param field: name of list, e.g. 'topfavorites'
+    :return: list of recipes in rank order
+    """
+    def compute():
+        return hydrate_recipes(engine_results(generations.TOP, 1, {field: 1}).get(field, []))
+    return results.get(field, compute)
+
+
+def parse_recipe_id(value):
+    """
+    Recipe id from url, recipes have int ids or ObjectIds.
+    """
+    if value.isdigit():
+        return int(value)
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        abort(400)
+
+
+def page_args():
+    """
+    Keyset pagination arguments ?after=<id>&limit=<n> of request.
+
+    :return: (id of last recipe of previous page or None, number of recipes on page)
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+    after = request.args.get('after')
+    return (parse_recipe_id(after) if after else None), limit
+
+
+def next_page_url(entries, limit):
+    """
+    Url of the page after the last of entries, other arguments of request are kept.
+    """
+    args = request.args.to_dict(flat=False)
+    args.update(request.view_args or {})
+    args.update(after=str(entries[-1]['_id']), limit=limit)
+    return url_for(request.endpoint, **args)
+
+
+def page_recipes(query):
+    """
+    One page of recipes matching query in order of ids, read with keyset
+    pagination from ?after=<id>&limit=<n>, so every page costs the same
+    and only fields of LISTING_FIELDS are fetched.
+
+    :param query: mongodb query for recipes
+    :return: (list of recipes, url of next page or None)
+    """
+    after, limit = page_args()
+    if after is not None:
+        if isinstance(after, ObjectId):
+            keyset = {'_id': {'$gt': after}}
+        else:
+            # mongodb compares only values of the same type, ObjectIds are sorted after numbers
+            keyset = {'$or': [{'_id': {'$gt': after}}, {'_id': {'$type': 7}}]}
+        query = {'$and': [query, keyset]} if query else keyset
+
+    entries = list(recipecol.find(query, LISTING_FIELDS).sort('_id', 1).limit(limit + 1))
+    next_url = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_url = next_page_url(entries, limit)
+    return entries, next_url
+
+
+def page_ids(ids):
+    """
+    One page of recipes from sorted list of ids, paginated like page_recipes.
+
+    :param ids: sorted list of recipe ids
+    :return: (list of recipes, url of next page or None)
+    """
+    after, limit = page_args()
+    start = 0 if after is None else bisect_right(ids, after)
+    entries = hydrate_recipes(ids[start:start + limit])
+    next_url = None
+    if start + limit < len(ids) and entries:
+        next_url = next_page_url(entries, limit)
+    return entries, next_url
+
+
+def parse_facets(name):
+    """
+    Facets from repeated argument name of request, values are kind:value.
+
+    :return: list of (kind, value)
+    """
+    parsed = []
+    for facet in request.args.getlist(name):
+        kind, _, value = facet.partition(':')
+        if kind not in (facets.TAGS, facets.INGREDIENTS) or not value:
+            abort(400)
+        parsed.append((kind, value))
+    return parsed
+
+
 @app.before_request
 def before_request():
     """
@@ -49,7 +202,7 @@ def before_request():
 
     :return: redirect to login page if user is not loged in
     """
-    if 'logged_in' not in session and (request.endpoint != 'login' and request.endpoint != 'signup'):
+    if 'logged_in' not in session and request.endpoint not in ('login', 'signup', 'metrics'):
         return redirect(url_for('login'))
 
 
@@ -62,9 +215,10 @@ def show_entries(entries=None, headline="Recipes"):
     :param headline: headline for page
     :return: rendered page with recipes
     """
+    next_url = None
     if entries == None:
-      entries = recipecol.Recipe.find()
-    return render_template('show_entries.html', entries=entries, headline="Recipes")
+      entries, next_url = page_recipes({})
+    return render_template('show_entries.html', entries=entries, headline="Recipes", next_url=next_url)
 
 
 @app.route('/user/<login>', methods=['GET', 'POST'])
@@ -75,8 +229,7 @@ def show_profile(login):
     :param login: unique login id of specific user
     :return: rendered page with user profile and similar people
     """
-    user = userscol.User.find_one({'_id': login})
-    simpeople_ids = user['similar_users']
+    simpeople_ids = engine_results(generations.USERS, login, {'similar_users': 1}).get('similar_users', [])
     simpeople = []
 
     i = 0
@@ -98,7 +251,6 @@ def login():
     error = None
     if request.method == 'POST':
         user = userscol.User.find_one({'_id': request.form['login'], 'password': request.form['password']})
-        print user
         if user:
             session['logged_in'] = True
             session['user_in'] = request.form['login']
@@ -154,10 +306,10 @@ def cookbook(login):
     :param login: unique id of user
     :return: Rendered page with custom cookbook.
     """
-    user = userscol.User.find_one({'_id': login})
-    recipes = recipecol.Recipe.find({'$or': [{'userid': login}, {'_id': {'$in': user['favorites']}}]})
+    user = userscol.find_one({'_id': login}, {'favorites': 1})
+    recipes, next_url = page_recipes({'$or': [{'userid': login}, {'_id': {'$in': user['favorites']}}]})
     headline = login + '\'s Cookbook'
-    return render_template('show_entries.html', entries=recipes, headline=headline)
+    return render_template('show_entries.html', entries=recipes, headline=headline, next_url=next_url)
 
 
 @app.route('/user/<login>/favorites', methods=['GET'])
@@ -239,10 +391,12 @@ def add_entry():
             count += 1
             recipemongo['ingredients'].append({'ingredient': name, 'number': amount})
         else:
-            print ("no more ingredients")
             nextIng = False
 
     recipemongo.save()
+    textindex.index_recipe(mconnection, recipemongo)
+    facets.index_recipe(mconnection, recipemongo)
+    changelog.log_change(mconnection, changelog.RECIPE, session['user_in'], recipemongo['_id'])
     flash('New entry was successfully posted')
     return redirect(url_for('show_entries', headline="Recipes"))
 
@@ -271,21 +425,29 @@ def edit_entry():
             count += 1
             recipemongo['ingredients'].append({'ingredient': name, 'number': amount})
         else:
-            print ("no more ingredients")
             nextIng = False
     recipemongo.save()
+    textindex.index_recipe(mconnection, recipemongo)
+    facets.index_recipe(mconnection, recipemongo)
+    changelog.log_change(mconnection, changelog.RECIPE, session['user_in'], recipemongo['_id'])
     return redirect(url_for('show_entries', headline="Recipes", tags=','.join(recipemongo['tags'])))
 
 
 @app.route('/search/<text>', methods=['GET'])
 def search(text=None):
     """
-    Search recipes through mongo database on recipes.
+    Search recipes by words of title, tags and ingredients in the inverted index.
+    Best ?limit=<n> recipes are shown.
 
     :param text: search string
-    :return: Recipes with title similar to text param.
-    """
-    entries = recipecol.Recipe.find({'title': {'$regex': re.compile(text, re.IGNORECASE)}})
+    :return: Recipes with all words of text, best matches first.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+    found = textindex.search(mconnection, text, limit)
+    entries = hydrate_recipes([itemid for itemid, score in found])
     return render_template('show_entries.html', entries=entries, headline="Recipes like " + text)
 
 
@@ -300,33 +462,29 @@ def show_entry(id):
     canedit = None
     favorited = None
 
-    # has user already faved the item?
-    user = userscol.User.find_one({'_id': session['user_in'], 'favorites': int(id)})
-    rated = userscol.User.find_one({'_id': session['user_in'], 'ratings.itemid': int(id)}, {'ratings.itemid': 1,
-                                                                                            'ratings.value': 1,
-                                                                                            '_id': 0})
+    # has user already faved and rated the item? only matching elements are returned
+    user = userscol.find_one({'_id': session['user_in']},
+                             {'favorites': {'$elemMatch': {'$in': [int(id)]}},
+                              'ratings': {'$elemMatch': {'itemid': int(id)}}})
     value = 0
-    if rated:
-        for item in rated.get('ratings'):
-            if item.get('itemid') == int(id):
-                value = item.get('value')
+    if user and user.get('ratings'):
+        value = user['ratings'][0].get('value')
 
     # get tags
     rec = recipecol.Recipe.find_one({'_id': int(id)})
     tags = ','.join(rec['tags'])
 
-    # now show similar recipes
-    simrecipes_ids = rec['similar_items']
-    simrecipes_t = []
-    simrecipes_i = []
-    for recipe_ in simrecipes_ids:
-        if recipe_['type'] == 1:
-            simrecipes_t.append(recipecol.Recipe.find_one({'_id': recipe_['itemid']}))
-        else:
-            simrecipes_i.append(recipecol.Recipe.find_one({'_id': recipe_['itemid']}))
+    # now show similar recipes, all of them fetched at once
+    similar = engine_results(generations.RECIPES, rec['_id'], {'similar_items': 1}).get('similar_items', [])
+    simrecipes = dict((recipe['_id'], recipe) for recipe in
+                      hydrate_recipes([recipe_['itemid'] for recipe_ in similar], {'title': 1}))
+    simrecipes_t = [simrecipes[recipe_['itemid']] for recipe_ in similar
+                    if recipe_['type'] == 1 and recipe_['itemid'] in simrecipes]
+    simrecipes_i = [simrecipes[recipe_['itemid']] for recipe_ in similar
+                    if recipe_['type'] != 1 and recipe_['itemid'] in simrecipes]
 
     # if is users logged in recipe then he can edit it
-    if user:
+    if user and user.get('favorites'):
         favorited = True
     if rec['userid'] == session['user_in']:
         canedit = True
@@ -344,9 +502,7 @@ def topfav():
 
     :return: page with most favorited recipes.
     """
-    recipe = nonpcol.NonPersonal.find_one({'_id': 1})
-    entries = recipecol.Recipe.find({'_id': {'$in': recipe['topfavorites']}})
-    if entries == None: entries = []
+    entries = top_list('topfavorites')
     return render_template('show_entries.html', entries=entries, headline="Top favorites")
 
 
@@ -357,10 +513,7 @@ def toprated():
 
     :return: page with top rated recipes.
     """
-    recipe = nonpcol.NonPersonal.find_one({'_id': 1})
-    entries = recipecol.Recipe.find({'_id': {'$in': recipe['toprated']}})
-    print entries
-    if entries == None: entries = []
+    entries = top_list('toprated')
     return render_template('show_entries.html', entries=entries, headline="Top rated")
 
 
@@ -372,18 +525,14 @@ def recommend(login):
     :param login: id of specific user
     :return: Page with recipes for selected user.
     """
-    user = userscol.User.find_one({'_id': login})
-    values = [predict['itemid'] for predict in user['predicted']]
-    entries = recipecol.Recipe.find({'_id': {'$in': values}})
+    # collaborative filtering first, then content based
+    user = engine_results(generations.USERS, login, {'predicted.itemid': 1, 'content.itemid': 1})
+    entries = hydrate_recipes([predict['itemid'] for predict in user.get('predicted', []) + user.get('content', [])])
 
     # if there is no recommended recipes, get some random
-    print entries.count()
-    if entries.count() == 0:
-        entries = []
-        count = recipecol.Recipe.find().count()
-        for i in range(1, 6):
-            recipe = randint(1, count)
-            entries.append(recipecol.Recipe.find_one({'_id': recipe}))
+    if len(entries) == 0:
+        count = recipecol.count()
+        entries = hydrate_recipes([randint(1, count) for i in range(1, 6)])
     return render_template('show_entries.html', entries=entries, headline="Recommended for you")
 
 
@@ -396,20 +545,45 @@ def interesting():
 
     :return: Page with interesting recipes.
     """
-    recipe = nonpcol.NonPersonal.find_one({'_id': 1})
-    entries = recipecol.Recipe.find({'_id': {'$in': recipe['topinteresting']}})
-    if entries == None: entries = []
+    entries = top_list('topinteresting')
     return render_template('show_entries.html', entries=entries, headline="Interesting")
 
 
 @app.route('/recipes/<type>/<value>', methods=['GET'])
 def show_recipes_adv(type=None, value=None, headline="Recipes"):
     if type == 'tags':  # tags
-        entries = recipecol.Recipe.find({'tags': {'$in': [value]}})
-        return render_template('show_entries.html', entries=entries, headline="Recipes in " + value)
+        entries, next_url = page_ids(facets.browse(mconnection, every=[(facets.TAGS, value)]))
+        return render_template('show_entries.html', entries=entries, headline="Recipes in " + value, next_url=next_url)
     else:  # ingredients
-        entries = recipecol.Recipe.find({'ingredients.ingredient': {'$in': [value]}})
-        return render_template('show_entries.html', entries=entries, headline="Recipes in " + value)
+        entries, next_url = page_ids(facets.browse(mconnection, every=[(facets.INGREDIENTS, value)]))
+        return render_template('show_entries.html', entries=entries, headline="Recipes in " + value, next_url=next_url)
+
+
+@app.route('/browse', methods=['GET'])
+def browse():
+    """
+    Browse recipes by facets, e.g. ?and=tags:vegan&and=tags:low-carb&not=ingredients:nuts,
+    recipes have all facets of and, at least one of or and none of not.
+
+    :return: Page with recipes and counts of tags and ingredients in them.
+    """
+    every, some, none = parse_facets('and'), parse_facets('or'), parse_facets('not')
+    ids = facets.browse(mconnection, every, some, none) if every or some or none else None
+    if ids is None:
+        entries, next_url = page_recipes({})
+    else:
+        entries, next_url = page_ids(ids)
+
+    # counts of facets in result, every count links to result narrowed by it
+    counts = []
+    for kind in (facets.TAGS, facets.INGREDIENTS):
+        for value, count in facets.facet_counts(mconnection, kind, ids):
+            args = request.args.to_dict(flat=False)
+            args.pop('after', None)
+            args['and'] = args.get('and', []) + [kind + ':' + value]
+            counts.append((kind, value, count, url_for('browse', **args)))
+    return render_template('show_entries.html', entries=entries, headline="Browse recipes", next_url=next_url,
+                           facets=counts)
 
 
 @app.route('/api/favorite', methods=['POST'])
@@ -423,20 +597,10 @@ def favorite():
         # try:
         data = json.loads(request.data)
         if data['favorite'] == '1':
-            # save to users
-            user = userscol.User.find_one({'_id': data['userid']})
-            user['favorites'].append(int(data['itemid']))
-            user.save()
-            # save to recipes
-            recipe = recipecol.Recipe.find_one({'_id': int(data['itemid'])})
-            recipe['favorites'].append(unicode(data['userid']))
-            recipe.save()
+            events.favorite(mconnection, unicode(data['userid']), int(data['itemid']))
         else:
-            # and remove
-            mconnection['recsys'].users.update({'_id': session['user_in']},
-                                               {'$pull': {'favorites': int(data['itemid'])}})
-            mconnection['recsys'].recipes.update({'_id': int(data['itemid'])},
-                                                 {'$pull': {'favorites': data['userid']}})
+            events.unfavorite(mconnection, unicode(data['userid']), int(data['itemid']))
+        changelog.log_change(mconnection, changelog.FAVORITE, data['userid'], int(data['itemid']))
         return json.dumps({'status': 'OK'})
 
 
@@ -450,11 +614,9 @@ def rate():
     if request.method == "POST":
         try:
             data = json.loads(request.data)
-            # insert rating for user and item
-            user = userscol.User.find_one({'_id': data['userid']})
-            user['ratings'].append(
-                {'itemid': data['itemid'], 'value': float(data['rating']), 'date_creation': datetime.now()})
-            user.save()
+            # insert or replace rating for user and item
+            events.rate(mconnection, data['userid'], int(data['itemid']), float(data['rating']))
+            changelog.log_change(mconnection, changelog.RATING, data['userid'], data['itemid'])
             # user.print_ratings()
             return json.dumps({'status': 'OK'})
         except:
@@ -0,0 +1,323 @@
+"""
+
+Latency and mongodb metrics of the webapp.
+Every request is timed per endpoint and every mongodb call made while
+it is handled is counted and timed, so a page which asks the database once
+per listed recipe shows up as an N+1 pattern. Aggregates are served on
+/metrics in the Prometheus text format, only to requests from this machine.
+
+Queries of the calls are collected too and every query shape not seen before
+is explained after the request, see schema.QueryLog, so a query which reads
+a whole collection is logged the first time any page issues it.
+
+"""
+
+from flask import request, g, abort
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.command_cursor import CommandCursor
+from pymongo.bulk import _Bulk
+import threading
+import time
+
+from models import schema
+
+# upper bounds of buckets of request latency in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# upper bounds of buckets of number of mongodb calls in one request
+CALLS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# the same query on the same collection this many times in one request is reported as N+1
+N_PLUS_ONE = 10
+
+# addresses allowed to read /metrics
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# collection methods which talk to the server, calls made inside them are not counted again
+COLLECTION_OPERATIONS = ('insert', 'update', 'remove', 'save', 'find_and_modify', 'aggregate',
+                         'count', 'distinct', 'group', 'map_reduce')
+
+# mongodb calls of the request handled in this thread, None outside of requests
+_local = threading.local()
+
+
+def _record(operation, collection_name, function, sends=None, query=None):
+    """
+    Wrap method of pymongo so that its calls are recorded for the current request.
+
+    :param operation: name of operation
+    :param collection_name: function(self) -> name of collection
+    :param function: original method
+    :param sends: function(self) -> False when the call does not reach the server
+    :param query: function(self, args, kwargs) -> (collection, query, sort) of the call or None
+    """
+    def recorded(self, *args, **kwargs):
+        calls = getattr(_local, 'calls', None)
+        if calls is None or getattr(_local, 'inside', False) or (sends is not None and not sends(self)):
+            return function(self, *args, **kwargs)
+        kind = operation(self) if callable(operation) else operation
+        issued = query(self, args, kwargs) if query is not None else None
+        if issued is not None:
+            _local.queries.append(issued)
+        _local.inside = True
+        started = time.time()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            _local.inside = False
+            calls.append((collection_name(self), kind, time.time() - started))
+    recorded.__name__ = function.__name__
+    recorded.__doc__ = function.__doc__
+    return recorded
+
+
+def _cursor_sends(prefix):
+    # the same test _refresh makes before it asks the server for documents
+    def sends(cursor):
+        return not len(getattr(cursor, prefix + '__data')) and not getattr(cursor, prefix + '__killed')
+    return sends
+
+
+def _argument(args, kwargs, position, name, default=None):
+    # argument of the wrapped method, args do not include self
+    if len(args) > position:
+        return args[position]
+    return kwargs.get(name, default)
+
+
+def _cursor_query(cursor, args, kwargs):
+    if _cursor_operation(cursor) != 'find': return None
+    ordering = cursor._Cursor__ordering
+    return cursor.collection, cursor._Cursor__spec or {}, ordering.items() if ordering else None
+
+
+def _update_query(collection, args, kwargs):
+    return collection, _argument(args, kwargs, 0, 'spec') or {}, None
+
+
+def _remove_query(collection, args, kwargs):
+    spec = _argument(args, kwargs, 0, 'spec_or_id')
+    if spec is None:
+        spec = {}
+    elif not isinstance(spec, dict):
+        spec = {'_id': spec}
+    return collection, spec, None
+
+
+def _find_and_modify_query(collection, args, kwargs):
+    return collection, _argument(args, kwargs, 0, 'query') or {}, _argument(args, kwargs, 3, 'sort')
+
+
+def _aggregate_query(collection, args, kwargs):
+    # only the first $match of pipeline can use an index
+    pipeline = _argument(args, kwargs, 0, 'pipeline') or []
+    if isinstance(pipeline, dict):
+        pipeline = [pipeline]
+    if pipeline and '$match' in pipeline[0]:
+        return collection, pipeline[0]['$match'], None
+    return None
+
+
+# collection methods -> function(collection, args, kwargs) -> (collection, query, sort) of the call
+COLLECTION_QUERIES = {
+    'update': _update_query,
+    'remove': _remove_query,
+    'find_and_modify': _find_and_modify_query,
+    'aggregate': _aggregate_query,
+}
+
+
+def _cursor_operation(cursor):
+    collection = cursor.collection.name
+    if collection == '$cmd':
+        return 'command'
+    return 'find' if cursor.cursor_id is None else 'getmore'
+
+
+def instrument_pymongo():
+    """
+    Record calls of pymongo collections, cursors and bulk operations.
+    Calls made outside of requests are not recorded, it is safe to call this more times.
+    """
+    if getattr(Collection, '_metrics', False): return
+    Collection._metrics = True
+    for name in COLLECTION_OPERATIONS:
+        setattr(Collection, name, _record(name, lambda collection: collection.name, getattr(Collection, name),
+                                          query=COLLECTION_QUERIES.get(name)))
+    Cursor._refresh = _record(_cursor_operation, lambda cursor: cursor.collection.name,
+                              Cursor._refresh, _cursor_sends('_Cursor'), _cursor_query)
+    command_sends = _cursor_sends('_CommandCursor')
+    CommandCursor._refresh = _record('getmore', lambda cursor: cursor._CommandCursor__collection.name,
+                                     CommandCursor._refresh,
+                                     lambda cursor: command_sends(cursor) and bool(cursor.cursor_id))
+    _Bulk.execute = _record('bulk', lambda bulk: bulk.collection.name, _Bulk.execute)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with sum and count like Prometheus histograms.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def labels(**values):
+    return '{' + ','.join('%s="%s"' % (name, escape(values[name])) for name in sorted(values)) + '}'
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    """
+    Metrics of all requests of app.
+    """
+
+    def __init__(self, app=None, logger=None):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.calls = {}
+        self.requests = {}
+        self.mongo_calls = {}
+        self.mongo_seconds = {}
+        self.n_plus_one = {}
+        self.queries = schema.QueryLog()
+        self.logger = logger
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Measure requests of app and add /metrics endpoint.
+        Call it before other before_request functions, so that they are measured too.
+        """
+        instrument_pymongo()
+        if self.logger is None:
+            self.logger = app.logger
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.teardown_request(self.stop)
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+
+    def start(self):
+        g.metrics_started = time.time()
+        _local.calls = []
+        _local.queries = []
+
+    def finish(self, response):
+        calls = getattr(_local, 'calls', None) or []
+        seconds = time.time() - g.get('metrics_started', time.time())
+        self.observe(request.endpoint or 'none', response.status_code, seconds, calls)
+        self.audit(request.endpoint or 'none', getattr(_local, 'queries', None) or [])
+        return response
+
+    def stop(self, exception=None):
+        _local.calls = None
+        _local.queries = None
+
+    def audit(self, endpoint, queries):
+        """
+        Explain queries of shapes not seen before and log those which scan a whole collection.
+
+        :param endpoint: name of endpoint
+        :param queries: list of (collection, query, sort) issued by the request
+        """
+        # explains are not calls of the request
+        _local.inside = True
+        try:
+            unindexed = self.queries.audit(queries)
+        finally:
+            _local.inside = False
+        for collection, query, sort in unindexed:
+            self.logger.warning('query without index in %s: %s %r sort %r', endpoint, collection, query, sort)
+
+    def observe(self, endpoint, status, seconds, calls):
+        """
+        Add one request to aggregates.
+
+        :param endpoint: name of endpoint
+        :param status: HTTP status code
+        :param seconds: time of request
+        :param calls: list of (collection, operation, seconds) of mongodb calls
+        """
+        repeated = {}
+        for collection, operation, duration in calls:
+            if operation not in ('getmore', 'bulk'):
+                repeated[collection, operation] = repeated.get((collection, operation), 0) + 1
+
+        with self.lock:
+            self.latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.calls.setdefault(endpoint, Histogram(CALLS_BUCKETS)).observe(len(calls))
+            self.requests[endpoint, status] = self.requests.get((endpoint, status), 0) + 1
+            for collection, operation, duration in calls:
+                key = (endpoint, collection, operation)
+                self.mongo_calls[key] = self.mongo_calls.get(key, 0) + 1
+                self.mongo_seconds[key] = self.mongo_seconds.get(key, 0.0) + duration
+            for (collection, operation), count in repeated.items():
+                if count >= N_PLUS_ONE:
+                    key = (endpoint, collection, operation)
+                    self.n_plus_one[key] = self.n_plus_one.get(key, 0) + 1
+
+        for (collection, operation), count in repeated.items():
+            if count >= N_PLUS_ONE:
+                self.logger.warning('N+1 queries in %s: %d x %s on %s', endpoint, count, operation, collection)
+
+    def serve(self):
+        """
+        Aggregates in the Prometheus text format, for requests from this machine only.
+        """
+        if request.remote_addr not in LOCAL_ADDRESSES:
+            abort(404)
+        return self.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    def render(self):
+        lines = []
+        with self.lock:
+            self.render_histograms(lines, 'flaskr_request_seconds', 'Latency of requests by endpoint.', self.latency)
+            self.render_histograms(lines, 'flaskr_request_mongo_calls', 'Mongodb calls in one request by endpoint.',
+                                   self.calls)
+            self.render_counters(lines, 'flaskr_requests_total', 'Requests by endpoint and status.',
+                                 self.requests, ('endpoint', 'status'))
+            self.render_counters(lines, 'flaskr_mongo_calls_total', 'Mongodb calls by endpoint.',
+                                 self.mongo_calls, ('endpoint', 'collection', 'operation'))
+            self.render_counters(lines, 'flaskr_mongo_seconds_total', 'Time of mongodb calls by endpoint.',
+                                 self.mongo_seconds, ('endpoint', 'collection', 'operation'))
+            self.render_counters(lines, 'flaskr_mongo_n_plus_one_total',
+                                 'Requests repeating the same mongodb operation %d or more times.' % N_PLUS_ONE,
+                                 self.n_plus_one, ('endpoint', 'collection', 'operation'))
+        unindexed = dict(((database, collection, repr(query), repr(sort)), 1)
+                         for database, collection, query, sort in self.queries.unindexed())
+        self.render_counters(lines, 'flaskr_mongo_unindexed_queries',
+                             'Query shapes seen which scan a whole collection.',
+                             unindexed, ('database', 'collection', 'query', 'sort'), 'gauge')
+        return '\n'.join(lines) + '\n'
+
+    def render_histograms(self, lines, name, help, histograms):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        for endpoint in sorted(histograms):
+            histogram = histograms[endpoint]
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append('%s_bucket%s %d' % (name, labels(endpoint=endpoint, le=repr(float(bound))), count))
+            lines.append('%s_bucket%s %d' % (name, labels(endpoint=endpoint, le='+Inf'), histogram.count))
+            lines.append('%s_sum%s %r' % (name, labels(endpoint=endpoint), histogram.sum))
+            lines.append('%s_count%s %d' % (name, labels(endpoint=endpoint), histogram.count))
+
+    def render_counters(self, lines, name, help, counters, names, type='counter'):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type))
+        for key in sorted(counters):
+            lines.append('%s%s %r' % (name, labels(**dict(zip(names, key))), counters[key]))
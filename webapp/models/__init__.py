@@ -1 +1 @@
-__all__ = ['recommender']
\ No newline at end of file
+__all__ = ['recommender', 'changelog', 'cache', 'textindex', 'facets', 'schema', 'events', 'generations']
\ No newline at end of file
@@ -0,0 +1,111 @@
+# coding=utf-8
+"""
+In-process cache of results computed by the recommender engine.
+The engine bumps the version of results after every run, cached values
+are used until the version changes. The version and the published
+generation of results are read from database at most once per ttl seconds.
+"""
+import threading
+import time
+
+# id of document with version of results in enginestate collection
+RESULTS = 'results'
+
+# default number of seconds between checks of results version
+TTL = 60
+
+
+def results_version(mconnection, database='recsys'):
+  """
+  Current version of results computed by the engine, 0 before its first run.
+
+  :param mconnection: mongodb connection
+  :param database: name of database
+  """
+  return results_state(mconnection, database)[0]
+
+
+def results_state(mconnection, database='recsys'):
+  """
+  Current version and published generation of results, see generations.
+
+  :param mconnection: mongodb connection
+  :param database: name of database
+  :return: (version, generation)
+  """
+  state = mconnection[database].enginestate.find_one({'_id': RESULTS}, {'version': 1, 'generation': 1}) or {}
+  return state.get('version', 0), state.get('generation', 0)
+
+
+def bump_results_version(mconnection, database='recsys'):
+  """
+  Tell webapps the engine has written new results.
+
+  :param mconnection: mongodb connection
+  :param database: name of database
+  """
+  mconnection[database].enginestate.update({'_id': RESULTS}, {'$inc': {'version': 1}}, upsert=True)
+
+
+class ResultCache(object):
+  """
+  Values computed from engine results, e.g. hydrated top lists, kept until
+  the engine writes new results.
+  """
+
+  def __init__(self, mconnection, ttl=TTL, clock=time.time, database='recsys'):
+    """
+    :param mconnection: mongodb connection
+    :param ttl: number of seconds a known version is trusted without asking database
+    :param clock: function returning current time in seconds
+    :param database: name of database
+    """
+    self.mconnection = mconnection
+    self.database = database
+    self.ttl = ttl
+    self.clock = clock
+    self.lock = threading.Lock()
+    # key -> (version, value)
+    self.entries = {}
+    self.version = None
+    self.generation = None
+    self.checked = None
+
+  def current_version(self):
+    return self.current_state()[0]
+
+  def current_generation(self):
+    """
+    Generation of results to read, see generations.
+    """
+    return self.current_state()[1]
+
+  def current_state(self):
+    now = self.clock()
+    with self.lock:
+      if self.checked is None or now - self.checked >= self.ttl:
+        self.version, self.generation = results_state(self.mconnection, self.database)
+        self.checked = now
+      return self.version, self.generation
+
+  def get(self, key, compute):
+    """
+    Cached value for key, compute() is called when it is missing or older than results.
+
+    :param key: name of cached value
+    :param compute: function without arguments computing the value
+    :return: value
+    """
+    version = self.current_version()
+    entry = self.entries.get(key)
+    if entry is not None and entry[0] == version:
+      return entry[1]
+    value = compute()
+    with self.lock:
+      self.entries[key] = (version, value)
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.entries = {}
+      self.checked = None
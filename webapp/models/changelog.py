@@ -0,0 +1,110 @@
+# coding=utf-8
+"""
+Change log of ratings, favorites and recipes written by the webapp.
+The recommender engine reads it to recompute only what has changed.
+"""
+from datetime import datetime
+
+# kinds of changes
+RATING = 'rating'
+FAVORITE = 'favorite'
+RECIPE = 'recipe'
+
+# number of processed changes removed from log in one query
+REMOVE_BATCH = 1000
+
+
+def log_change(mconnection, kind, userid=None, itemid=None):
+  """
+  Append change to the log.
+
+  :param mconnection: mongodb connection
+  :param kind: RATING, FAVORITE or RECIPE
+  :param userid: id of user who made the change
+  :param itemid: id of changed recipe
+  """
+  mconnection['recsys'].changelog.insert({'kind': kind, 'userid': userid, 'itemid': itemid,
+                                          'date_creation': datetime.now()})
+
+
+def log_changes(mconnection, changes):
+  """
+  Append many changes to the log with one insert.
+
+  :param mconnection: mongodb connection
+  :param changes: list of (kind, userid, itemid)
+  """
+  now = datetime.now()
+  entries = [{'kind': kind, 'userid': userid, 'itemid': itemid, 'date_creation': now}
+             for kind, userid, itemid in changes]
+  if entries:
+    mconnection['recsys'].changelog.insert(entries)
+
+
+class Changes(object):
+  """
+  Users and recipes changed since the last processed change.
+  """
+
+  def __init__(self):
+    self.ids = []
+    # users and recipes by kind of change
+    self.users = dict((kind, set()) for kind in (RATING, FAVORITE, RECIPE))
+    self.items = dict((kind, set()) for kind in (RATING, FAVORITE, RECIPE))
+    self.watermark = None
+
+  def add(self, entry):
+    self.ids.append(entry['_id'])
+    if entry.get('userid') is not None:
+      self.users[entry['kind']].add(entry['userid'])
+    if entry.get('itemid') is not None:
+      self.items[entry['kind']].add(entry['itemid'])
+    if self.watermark is None or entry['date_creation'] > self.watermark:
+      self.watermark = entry['date_creation']
+
+  def empty(self):
+    return len(self.ids) == 0
+
+  def kinds(self):
+    return set(kind for kind in self.users if self.users[kind] or self.items[kind])
+
+  def __repr__(self):
+    return '<Changes %d, users %r, items %r>' % (len(self.ids), self.users, self.items)
+
+
+def pending_changes(mconnection):
+  """
+  Read all changes which were not processed yet.
+
+  :param mconnection: mongodb connection
+  :return: Changes
+  """
+  changes = Changes()
+  for entry in mconnection['recsys'].changelog.find().sort('_id', 1):
+    changes.add(entry)
+  return changes
+
+
+def commit_changes(mconnection, changes):
+  """
+  Mark changes as processed, remove them from log and move the watermark.
+  Changes logged while the engine was running stay in the log for the next run.
+
+  :param mconnection: mongodb connection
+  :param changes: processed Changes
+  """
+  for start in range(0, len(changes.ids), REMOVE_BATCH):
+    mconnection['recsys'].changelog.remove({'_id': {'$in': changes.ids[start:start + REMOVE_BATCH]}})
+  if changes.watermark is not None:
+    mconnection['recsys'].enginestate.update({'_id': 'changelog'},
+                                             {'$set': {'watermark': changes.watermark}}, upsert=True)
+
+
+def watermark(mconnection):
+  """
+  Date of the newest processed change, None before any change was processed.
+
+  :param mconnection: mongodb connection
+  """
+  state = mconnection['recsys'].enginestate.find_one({'_id': 'changelog'}, {'watermark': 1})
+  return state.get('watermark') if state else None
@@ -0,0 +1,198 @@
+# coding=utf-8
+"""
+Ratings and favorites written by the webapp with atomic updates.
+No document is saved whole after it was changed in python, updates change
+only their fields and a rating is written only while the aggregates it was
+computed from did not change, so concurrent clicks do not lose updates.
+Users and recipes keep running sums, counts and sums of squares of their
+ratings and their average rating, recipes also the number of favorites, so
+averages are never computed from all ratings.
+"""
+from datetime import datetime
+
+# how many times a rating is tried again when another request changed it in the meantime
+RETRIES = 3
+
+# fields of running aggregates of ratings
+AGGREGATE_FIELDS = {'ratingsum': 1, 'ratingcount': 1, 'ratingsumsq': 1}
+
+
+class RatingAggregate(object):
+  """
+  Sum, number and sum of squares of ratings, or a change of them.
+  """
+
+  def __init__(self, total=0.0, count=0, sumsq=0.0):
+    self.sum = total
+    self.count = count
+    self.sumsq = sumsq
+
+  @classmethod
+  def of(cls, value):
+    return cls(value, 1, value * value)
+
+  def __add__(self, other):
+    return RatingAggregate(self.sum + other.sum, self.count + other.count, self.sumsq + other.sumsq)
+
+  def __sub__(self, other):
+    return RatingAggregate(self.sum - other.sum, self.count - other.count, self.sumsq - other.sumsq)
+
+  def average(self, empty):
+    return self.sum / self.count if self.count > 0 else empty
+
+  def fields(self):
+    return {'ratingsum': self.sum, 'ratingcount': self.count, 'ratingsumsq': self.sumsq}
+
+
+def rate(mconnection, userid, itemid, value):
+  """
+  Set rating of user for recipe, an existing rating is replaced, never duplicated.
+  The rating, aggregates and average rating of user change in one update, it
+  is applied only while the user's aggregates are those read before it and
+  tried again otherwise. Aggregates of recipe are changed by a second update,
+  if the process dies between them the recipe is fixed by the consistency
+  check of the engine, see average_ratings_recipes.
+
+  :param mconnection: mongodb connection
+  :param userid: id of user
+  :param itemid: id of recipe
+  :param value: rating
+  :return: previous rating or None if user did not rate recipe before
+  """
+  users = mconnection['recsys'].users
+  now = datetime.now()
+  fields = dict(AGGREGATE_FIELDS, ratings={'$elemMatch': {'itemid': itemid}})
+  for attempt in range(RETRIES):
+    user = users.find_one({'_id': userid}, fields)
+    if user is None:
+      raise ValueError('unknown user %s' % userid)
+    query = {'_id': userid}
+    for field in AGGREGATE_FIELDS:
+      query[field] = user.get(field)
+    if user.get('ratings'):
+      # replace rating in place, only if it is still the one read
+      previous = user['ratings'][0]['value']
+      change = RatingAggregate.of(value) - RatingAggregate.of(previous)
+      query['ratings'] = {'$elemMatch': {'itemid': itemid, 'value': previous}}
+      update = {'$set': {'ratings.$.value': value, 'ratings.$.date_creation': now}}
+    else:
+      # first rating, pushed only if there is still no rating of recipe
+      previous = None
+      change = RatingAggregate.of(value)
+      query['ratings.itemid'] = {'$ne': itemid}
+      update = {'$push': {'ratings': {'itemid': itemid, 'value': value, 'date_creation': now}}, '$set': {}}
+    total = stored_aggregate(user) + change
+    update['$set'].update(total.fields())
+    update['$set']['avgrating'] = total.average(0.0)
+    if users.update(query, update)['n'] == 1:
+      update_aggregates(mconnection, itemid, change)
+      return previous
+  raise RuntimeError('rating of %s for %s changed concurrently' % (userid, itemid))
+
+
+def stored_aggregate(doc):
+  """
+  RatingAggregate from aggregate fields of doc.
+  """
+  return RatingAggregate(doc.get('ratingsum', 0.0), doc.get('ratingcount', 0), doc.get('ratingsumsq', 0.0))
+
+
+def set_average(collection, doc, empty):
+  """
+  Store avgrating computed from aggregates of doc returned by an update.
+  It is stored only while the aggregates are the same, otherwise a later
+  update has newer aggregates and stores the average itself.
+
+  :param collection: users or recipes
+  :param doc: document with aggregate fields after update
+  :param empty: average of document without ratings
+  """
+  average = stored_aggregate(doc).average(empty)
+  query = {'_id': doc['_id']}
+  for field in AGGREGATE_FIELDS:
+    query[field] = doc.get(field)
+  collection.update(query, {'$set': {'avgrating': average}})
+
+
+def update_aggregates(mconnection, itemid, change):
+  """
+  Apply change of ratings to aggregates and average of recipe.
+
+  :param itemid: id of recipe
+  :param change: RatingAggregate
+  """
+  recipes = mconnection['recsys'].recipes
+  doc = recipes.find_and_modify({'_id': itemid}, {'$inc': change.fields()}, new=True, fields=AGGREGATE_FIELDS)
+  if doc is not None:
+    set_average(recipes, doc, None)
+
+
+def favorite(mconnection, userid, itemid):
+  """
+  Add recipe to favorites of user.
+
+  :param mconnection: mongodb connection
+  :param userid: id of user
+  :param itemid: id of recipe
+  :return: True if recipe was not favorite before
+  """
+  added = mconnection['recsys'].users.update({'_id': userid, 'favorites': {'$ne': itemid}},
+                                             {'$addToSet': {'favorites': itemid}})['n'] == 1
+  mconnection['recsys'].recipes.update({'_id': itemid, 'favorites': {'$ne': userid}},
+                                       {'$addToSet': {'favorites': userid}, '$inc': {'favoritecount': 1}})
+  return added
+
+
+def unfavorite(mconnection, userid, itemid):
+  """
+  Remove recipe from favorites of user.
+
+  :param mconnection: mongodb connection
+  :param userid: id of user
+  :param itemid: id of recipe
+  :return: True if recipe was favorite before
+  """
+  removed = mconnection['recsys'].users.update({'_id': userid, 'favorites': itemid},
+                                               {'$pull': {'favorites': itemid}})['n'] == 1
+  mconnection['recsys'].recipes.update({'_id': itemid, 'favorites': userid},
+                                       {'$pull': {'favorites': userid}, '$inc': {'favoritecount': -1}})
+  return removed
+
+
+def rebuild_aggregates(mconnection):
+  """
+  Compute aggregates of ratings, averages and numbers of favorites of all
+  users and recipes from scratch, e.g. for seed data. When user rated one
+  recipe more times, only the first rating counts like in User.getRating.
+
+  :param mconnection: mongodb connection
+  """
+  db = mconnection['recsys']
+  recipes = {}
+  for user in db.users.find({}, {'ratings.itemid': 1, 'ratings.value': 1}):
+    total, seen = RatingAggregate(), set()
+    for rating in user.get('ratings', []):
+      if rating['itemid'] in seen: continue
+      seen.add(rating['itemid'])
+      change = RatingAggregate.of(rating['value'])
+      total += change
+      recipes[rating['itemid']] = recipes.get(rating['itemid'], RatingAggregate()) + change
+    set_aggregates(db.users, user['_id'], total, 0.0)
+  for recipe in db.recipes.find({}, {'favorites': 1}):
+    set_aggregates(db.recipes, recipe['_id'], recipes.get(recipe['_id'], RatingAggregate()), None,
+                   favoritecount=len(recipe.get('favorites', [])))
+
+
+def set_aggregates(collection, _id, total, empty, **fields):
+  """
+  Overwrite aggregates and average of document.
+
+  :param collection: users or recipes
+  :param _id: id of document
+  :param total: RatingAggregate of all ratings of document
+  :param empty: average of document without ratings
+  :param fields: other fields to set
+  """
+  fields.update(total.fields())
+  fields['avgrating'] = total.average(empty)
+  collection.update({'_id': _id}, {'$set': fields})
@@ -0,0 +1,305 @@
+# coding=utf-8
+"""
+Facets of recipes for browsing by tags and ingredients.
+Every tag and ingredient has one document in facets collection with the
+number of its recipes. Its posting list of recipe ids is split to buckets
+in facetbuckets, one document per range of ids with the sorted ids of the
+range, so saving a recipe rewrites one small bucket per facet and no facet
+grows into one huge document. Filters like vegan AND low-carb AND NOT nuts
+first intersect the bucket ranges of their facets, then merge the sorted
+ids of the common buckets only.
+"""
+from bisect import bisect_left
+from calendar import timegm
+from datetime import datetime
+from heapq import merge
+from bson.objectid import ObjectId
+from schema import execute_unique
+
+# kinds of facets, the same names as types of /recipes/<type>/<value>
+TAGS = 'tags'
+INGREDIENTS = 'ingredients'
+
+# how many most common facets of every kind are read for counts of all recipes
+COUNTED_FACETS = 200
+
+# recipes with int ids in one bucket
+BUCKET_SIZE = 1024
+
+# seconds of creation of recipes with ObjectIds in one bucket
+BUCKET_SECONDS = 86400
+
+
+def facet_id(kind, value):
+  return kind + ':' + value
+
+
+def recipe_facets(recipe):
+  """
+  Ids of facets of recipe.
+
+  :param recipe: recipe document
+  :return: set of facet ids
+  """
+  facets = set(facet_id(TAGS, tag) for tag in recipe.get('tags', []) if tag)
+  facets.update(facet_id(INGREDIENTS, ingredient.get('ingredient'))
+                for ingredient in recipe.get('ingredients', []) if ingredient.get('ingredient'))
+  return facets
+
+
+def bucket_of(itemid):
+  """
+  Key of bucket of recipe id, keys are ordered the same as the ids they hold.
+  """
+  if isinstance(itemid, ObjectId):
+    seconds = timegm(itemid.generation_time.utctimetuple())
+    return ObjectId.from_datetime(datetime.utcfromtimestamp(seconds - seconds % BUCKET_SECONDS))
+  return itemid - itemid % BUCKET_SIZE
+
+
+def recipe_facets_indexed(db, itemid):
+  """
+  Ids of facets recipe is indexed in now.
+  """
+  return set(bucket['facet'] for bucket in db.facetbuckets.find({'items': itemid}, {'facet': 1}))
+
+
+def remove_postings(db, itemid, facets):
+  """
+  Remove recipe from posting lists of facets.
+  """
+  facets = list(facets)
+  if not facets: return
+  db.facetbuckets.update({'facet': {'$in': facets}, 'items': itemid},
+                         {'$pull': {'items': itemid}, '$inc': {'count': -1}}, multi=True)
+  db.facets.update({'_id': {'$in': facets}}, {'$inc': {'count': -1}}, multi=True)
+  db.facetbuckets.remove({'facet': {'$in': facets}, 'count': {'$lte': 0}})
+  db.facets.remove({'_id': {'$in': facets}, 'count': {'$lte': 0}})
+
+
+def remove_recipe(mconnection, itemid):
+  """
+  Remove recipe from all its facets.
+
+  :param mconnection: mongodb connection
+  :param itemid: id of recipe
+  """
+  db = mconnection['recsys']
+  remove_postings(db, itemid, recipe_facets_indexed(db, itemid))
+
+
+def index_recipe(mconnection, recipe):
+  """
+  Put recipe to posting lists of its facets, call it after recipe is saved.
+  Only facets the recipe got or lost are written.
+
+  :param mconnection: mongodb connection
+  :param recipe: saved recipe document
+  """
+  db = mconnection['recsys']
+  itemid = recipe['_id']
+  old = recipe_facets_indexed(db, itemid)
+  new = recipe_facets(recipe)
+  remove_postings(db, itemid, old - new)
+  added = new - old
+  if not added: return
+  bucket = bucket_of(itemid)
+  buckets = db.facetbuckets.initialize_unordered_bulk_op()
+  totals = db.facets.initialize_unordered_bulk_op()
+  for facet in added:
+    kind, value = facet.split(':', 1)
+    # ids stay sorted in the bucket, a recipe already in it matches no bucket and its upsert is skipped
+    buckets.find({'facet': facet, 'bucket': bucket, 'items': {'$ne': itemid}}).upsert().update_one(
+      {'$push': {'items': {'$each': [itemid], '$sort': 1}}, '$inc': {'count': 1}})
+    totals.find({'_id': facet}).upsert().update_one({'$set': {'kind': kind, 'value': value}, '$inc': {'count': 1}})
+  execute_unique(buckets)
+  totals.execute()
+
+
+def rebuild_facets(mconnection):
+  """
+  Build posting lists of all facets from scratch.
+
+  :param mconnection: mongodb connection
+  """
+  postings = {}
+  for recipe in mconnection['recsys'].recipes.find({}, {'tags': 1, 'ingredients.ingredient': 1}):
+    for facet in recipe_facets(recipe):
+      postings.setdefault(facet, []).append(recipe['_id'])
+  db = mconnection['recsys']
+  db.facets.drop()
+  db.facetbuckets.drop()
+  # index_recipe relies on one bucket of facet per key
+  db.facetbuckets.ensure_index([('facet', 1), ('bucket', 1)], unique=True)
+  for facet, items in postings.items():
+    kind, value = facet.split(':', 1)
+    items.sort()
+    db.facets.insert({'_id': facet, 'kind': kind, 'value': value, 'count': len(items)})
+    buckets = {}
+    for itemid in items:
+      buckets.setdefault(bucket_of(itemid), []).append(itemid)
+    db.facetbuckets.insert([{'facet': facet, 'bucket': bucket, 'items': ids, 'count': len(ids)}
+                            for bucket, ids in buckets.items()])
+
+
+def bucket_keys(db, facets):
+  """
+  Keys of buckets of facets, without their ids.
+
+  :return: dictionary facet id -> set of bucket keys
+  """
+  keys = dict((facet, set()) for facet in facets)
+  if facets:
+    for bucket in db.facetbuckets.find({'facet': {'$in': list(keys)}}, {'facet': 1, 'bucket': 1}):
+      keys[bucket['facet']].add(bucket['bucket'])
+  return keys
+
+
+def posting_lists(db, facets, buckets=None):
+  """
+  Sorted posting lists of facets.
+
+  :param facets: facet ids
+  :param buckets: keys of buckets to read, None for all
+  :return: dictionary facet id -> sorted list of recipe ids
+  """
+  lists = dict((facet, []) for facet in facets)
+  if not lists: return lists
+  query = {'facet': {'$in': list(lists)}}
+  if buckets is not None:
+    query['bucket'] = {'$in': list(buckets)}
+  buckets = sorted((bucket['bucket'], bucket['facet'], bucket['items'])
+                   for bucket in db.facetbuckets.find(query, {'facet': 1, 'bucket': 1, 'items': 1}))
+  for _, facet, items in buckets:
+    lists[facet].extend(items)
+  return lists
+
+
+def gallop(items, target, lo=0):
+  """
+  Position of the first id not smaller than target in sorted items, searched
+  from lo with doubling steps, so walking a long list for a short one is cheap.
+  """
+  step = 1
+  hi = lo
+  while hi < len(items) and items[hi] < target:
+    lo = hi + 1
+    hi = lo + step
+    step *= 2
+  return bisect_left(items, target, lo, min(hi, len(items)))
+
+
+def intersect(lists):
+  """
+  Sorted ids which are in all sorted lists, shortest list is walked and
+  the others are galloped through.
+  """
+  if not lists: return []
+  lists = sorted(lists, key=len)
+  positions = [0] * len(lists)
+  result = []
+  for itemid in lists[0]:
+    for n in range(1, len(lists)):
+      positions[n] = gallop(lists[n], itemid, positions[n])
+      if positions[n] == len(lists[n]):
+        return result
+      if lists[n][positions[n]] != itemid:
+        break
+    else:
+      result.append(itemid)
+  return result
+
+
+def union(lists):
+  """
+  Sorted ids which are in any of sorted lists.
+  """
+  result = []
+  for itemid in merge(*lists):
+    if not result or result[-1] != itemid:
+      result.append(itemid)
+  return result
+
+
+def difference(items, lists):
+  """
+  Sorted ids of sorted items which are in none of sorted lists.
+  """
+  positions = [0] * len(lists)
+  result = []
+  for itemid in items:
+    for n, other in enumerate(lists):
+      positions[n] = gallop(other, itemid, positions[n])
+      if positions[n] < len(other) and other[positions[n]] == itemid:
+        break
+    else:
+      result.append(itemid)
+  return result
+
+
+def browse(mconnection, every=(), some=(), none=()):
+  """
+  Recipes which have every facet of every, at least one facet of some and
+  no facet of none. Facets are (kind, value) pairs.
+
+  :param mconnection: mongodb connection
+  :return: sorted list of recipe ids
+  """
+  db = mconnection['recsys']
+  every = [facet_id(kind, value) for kind, value in every]
+  some = [facet_id(kind, value) for kind, value in some]
+  none = [facet_id(kind, value) for kind, value in none]
+  if every or some:
+    # only buckets all wanted facets have can hold results
+    keys = bucket_keys(db, every + some)
+    buckets = None
+    for facet in every:
+      buckets = keys[facet] if buckets is None else buckets & keys[facet]
+    if some:
+      anyof = set().union(*[keys[facet] for facet in some])
+      buckets = anyof if buckets is None else buckets & anyof
+    if not buckets: return []
+    lists = posting_lists(db, every + some + none, buckets)
+    positive = [lists[facet] for facet in every]
+    if some:
+      positive.append(union([lists[facet] for facet in some]))
+    items = intersect(positive)
+  else:
+    # only excluded facets, start from all recipes
+    lists = posting_lists(db, none)
+    items = sorted(recipe['_id'] for recipe in db.recipes.find({}, {'_id': 1}))
+  return difference(items, [lists[facet] for facet in none])
+
+
+def facet_counts(mconnection, kind, items=None, limit=20):
+  """
+  Number of recipes of result in every facet of kind, for the browse page.
+  Counts of all recipes are stored. Counts of a result are counted for the
+  COUNTED_FACETS most common facets of kind, only their buckets which hold
+  recipes of the result are read and intersected with the result.
+
+  :param mconnection: mongodb connection
+  :param kind: TAGS or INGREDIENTS
+  :param items: ids of recipes in result, None for all recipes
+  :param limit: number of facets returned
+  :return: list of (value, count) sorted by count
+  """
+  db = mconnection['recsys']
+  facets = db.facets.find({'kind': kind}, {'value': 1, 'count': 1}).sort('count', -1).limit(COUNTED_FACETS)
+  if items is None:
+    counts = [(facet['value'], facet['count']) for facet in facets if facet['count'] > 0]
+  else:
+    # sorted ids of result in every bucket
+    result = {}
+    for itemid in sorted(items):
+      result.setdefault(bucket_of(itemid), []).append(itemid)
+    if not result: return []
+    values = dict((facet['_id'], facet['value']) for facet in facets)
+    totals = dict.fromkeys(values, 0)
+    if values:
+      for bucket in db.facetbuckets.find({'facet': {'$in': list(values)}, 'bucket': {'$in': list(result)}},
+                                         {'facet': 1, 'bucket': 1, 'items': 1}):
+        totals[bucket['facet']] += len(intersect([bucket['items'], result[bucket['bucket']]]))
+    counts = [(values[facet], count) for facet, count in totals.items() if count > 0]
+  counts.sort(key=lambda pair: (-pair[1], pair[0]))
+  return counts[:limit]
@@ -0,0 +1,129 @@
+# coding=utf-8
+"""
+Generations of results of the recommender engine.
+Similar users, predictions, similar recipes and top lists live in
+collections of one generation, results_<n>_users, results_<n>_recipes and
+results_<n>_top. Full runs of the engine write a new generation and publish
+it by flipping the pointer in enginestate when they are done, so readers
+never see half written results. Old generations are dropped as whole
+collections, a generation which was published is kept for some seconds
+after it was replaced, for readers which did not notice the flip yet. That
+holds also when runs publish faster than readers check the pointer.
+Incremental runs update the published generation in place.
+"""
+from datetime import datetime, timedelta
+import re
+import cache
+
+# kinds of results, suffixes of collection names
+USERS = 'users'
+RECIPES = 'recipes'
+TOP = 'top'
+
+# names of collections of generations
+COLLECTION = re.compile(r'^results_(\d+)_(%s|%s|%s)$' % (USERS, RECIPES, TOP))
+
+# indexes of collections of every generation, in the same format as schema.INDEXES
+INDEXES = {
+  # users who have changed users as neighbours
+  USERS: [{'fields': ['similar_users.userid']}],
+  # recipes which have changed recipes as similar ones
+  RECIPES: [{'fields': ['similar_items.itemid']}],
+}
+
+
+def collection_name(generation, kind):
+  return 'results_%d_%s' % (generation, kind)
+
+
+def results(mconnection, generation, kind, database='recsys'):
+  """
+  Collection of one kind of results of generation.
+
+  :param mconnection: mongodb connection
+  :param generation: number of generation
+  :param kind: USERS, RECIPES or TOP
+  :param database: name of database
+  """
+  return mconnection[database][collection_name(generation, kind)]
+
+
+def published_generation(mconnection, database='recsys'):
+  """
+  Generation webapps read, 0 before the first engine run.
+
+  :param mconnection: mongodb connection
+  :param database: name of database
+  """
+  state = mconnection[database].enginestate.find_one({'_id': cache.RESULTS}, {'generation': 1})
+  return state.get('generation', 0) if state else 0
+
+
+def new_generation(mconnection, database='recsys', copy=False):
+  """
+  Allocate an empty generation, nobody reads it until it is published.
+
+  :param mconnection: mongodb connection
+  :param database: name of database
+  :param copy: start from a copy of the published generation, e.g. when only some stages are recomputed
+  :return: number of generation
+  """
+  state = mconnection[database].enginestate.find_and_modify({'_id': cache.RESULTS}, {'$inc': {'allocated': 1}},
+                                                            upsert=True, new=True)
+  # generations allocated before the first one was published are never reused
+  generation = max(state['allocated'], state.get('generation', 0) + 1)
+  if generation != state['allocated']:
+    mconnection[database].enginestate.update({'_id': cache.RESULTS}, {'$max': {'allocated': generation}})
+  for kind in (USERS, RECIPES, TOP):
+    target = results(mconnection, generation, kind, database)
+    target.drop()
+    if copy:
+      source = collection_name(published_generation(mconnection, database), kind)
+      if source in mconnection[database].collection_names():
+        # copied by the server
+        mconnection[database][source].aggregate([{'$match': {}}, {'$out': target.name}])
+    for index in INDEXES.get(kind, []):
+      target.ensure_index([(field, 1) for field in index['fields']])
+  return generation
+
+
+def retention(ttl):
+  """
+  Seconds a replaced generation is kept, webapps read the pointer at most
+  ttl seconds old and need time to finish requests started before.
+
+  :param ttl: RESULTS_CACHE_TTL of webapps
+  """
+  return 2 * ttl
+
+
+def publish(mconnection, generation, keep, database='recsys', now=None):
+  """
+  Make generation the one webapps read. Generations replaced more than keep
+  seconds ago and generations which were never published are dropped.
+
+  :param mconnection: mongodb connection
+  :param generation: number of finished generation
+  :param keep: seconds a replaced generation is kept for readers, longer than
+               webapps trust the pointer they read, see retention
+  :param database: name of database
+  :param now: current time, utc
+  """
+  now = now or datetime.utcnow()
+  enginestate = mconnection[database].enginestate
+  state = enginestate.find_and_modify({'_id': cache.RESULTS},
+                                      {'$set': {'generation': generation}, '$inc': {'version': 1}},
+                                      upsert=True, fields={'generation': 1})
+  previous = state.get('generation', 0) if state else 0
+  if previous and previous != generation:
+    enginestate.update({'_id': cache.RESULTS}, {'$push': {'retired': {'generation': previous, 'since': now}}})
+
+  # readers noticed the flips which are older than keep
+  enginestate.update({'_id': cache.RESULTS},
+                     {'$pull': {'retired': {'since': {'$lte': now - timedelta(seconds=keep)}}}})
+  state = enginestate.find_one({'_id': cache.RESULTS}, {'retired': 1})
+  kept = set([generation] + [retired['generation'] for retired in state.get('retired', [])])
+  for name in mconnection[database].collection_names():
+    match = COLLECTION.match(name)
+    if match and int(match.group(1)) not in kept:
+      mconnection[database].drop_collection(name)
@@ -18,7 +18,7 @@ class User(Document):
     'password' : unicode, # in future we will encrypt the pass
     # value is rating, itemid is id of item
     'ratings' : [{'itemid' : int, 'value' : float, 'date_creation' : datetime}],
-    # value is similarity
+    # value is similarity, unused, the engine keeps similar users and predictions in generations
     'similar_users' : [{'userid' : unicode, 'value' : float}],
     # average rating
     'avgrating' : float,
@@ -26,7 +26,18 @@ class User(Document):
     'favorites' : [ int],
     # ids of recommended (from collaborative filtering and content based) recipes sorted by expected rating
     'predicted': [{'itemid': int, 'value': float}],
+    # running sum, number and sum of squares of ratings, kept by events.rate
+    'ratingsum': float,
+    'ratingcount': int,
+    'ratingsumsq': float,
   }
+  default_values = {'ratingsum': 0.0, 'ratingcount': 0, 'ratingsumsq': 0.0}
+  # created by schema.ensure_indexes, mongokit can not check fields inside lists
+  indexes = [
+    # show_entry, affected users of engine
+    {'fields': ['ratings.itemid'], 'check': False},
+    {'fields': ['favorites']},
+  ]
   use_dot_notation = True
 
   # returns none if user dont rate item with
@@ -68,12 +79,27 @@ class Recipe(Document):
     'avgrating' : float,
     # interesting score by hacker news formula
     'interesting' : float,
-    # value is similarity, type = 1tags, 2ingredients
+    # value is similarity, type = 1tags, 2ingredients, unused, the engine keeps them in generations
     'similar_items' : [ {'itemid' : int, 'value' : float, 'type' : int} ],
     # for how many people
     'serves' : int,
+    # running sum, number and sum of squares of ratings and number of favorites, kept by events
+    'ratingsum' : float,
+    'ratingcount' : int,
+    'ratingsumsq' : float,
+    'favoritecount' : int,
   }
-  default_values = {'date_creation':datetime.now()}
+  # created by schema.ensure_indexes, mongokit can not check fields inside lists
+  indexes = [
+    # cookbook
+    {'fields': ['userid']},
+    {'fields': ['tags']},
+    {'fields': ['ingredients.ingredient'], 'check': False},
+    # best rated
+    {'fields': [('avgrating', -1)]},
+  ]
+  default_values = {'date_creation':datetime.now(), 'ratingsum': 0.0, 'ratingcount': 0, 'ratingsumsq': 0.0,
+                    'favoritecount': 0}
 
   use_dot_notation = True
   def print_favorites(self):
@@ -917,7 +943,6 @@ def init_mongodbnew(mconnection):
   user3['ratings'].append({'itemid':13,'value':4.0, 'date_creation': datetime.now()})
   user3['ratings'].append({'itemid':25,'value':1.0, 'date_creation': datetime.now()})
   user3['ratings'].append({'itemid':2,'value':4.0, 'date_creation': datetime.now()})
-  user3['ratings'].append({'itemid':2,'value':4.0, 'date_creation': datetime.now()})
   user3.save()
 
   user4 = userscol.User()
@@ -0,0 +1,202 @@
+# coding=utf-8
+"""
+Indexes of the recsys database.
+Indexes of users and recipes are declared in indexes of the mongokit models,
+collections without model are declared here. ensure_indexes is called when
+webapp and engine start, creating an existing index again does nothing.
+QueryLog collects shapes of the queries the webapp issues while it runs, see
+webapp/metrics.py, and explains every shape the first time it is seen, so a
+new query without an index is reported as soon as it is used.
+"""
+import threading
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import recommender
+
+# duplicate key error of mongodb
+DUPLICATE_KEY = 11000
+
+# collection -> mongokit model with indexes
+MODELS = {
+  'users': recommender.User,
+  'recipes': recommender.Recipe,
+  'nonpersonal': recommender.NonPersonal,
+}
+
+# collection -> indexes in the same format as indexes of mongokit models
+INDEXES = {
+  # facet_counts of facets
+  'facets': [
+    {'fields': [('kind', 1), ('count', -1)]},
+  ],
+  # posting lists of facets in buckets, index_recipe needs the unique one
+  'facetbuckets': [
+    {'fields': [('facet', 1), ('bucket', 1)], 'unique': True},
+    {'fields': ['items']},
+  ],
+  # postings of search terms, index_recipe needs the unique one
+  'searchpostings': [
+    {'fields': [('term', 1), ('itemid', 1)], 'unique': True},
+    {'fields': [('term', 1), ('impact', -1)]},
+    {'fields': [('itemid', 1), ('version', 1)]},
+  ],
+  # runs of the engine, newest first
+  'enginehistory': [
+    {'fields': [('started', -1)]},
+  ],
+}
+
+def index_fields(index):
+  """
+  Fields of index declaration as list of (field, direction).
+  """
+  fields = index['fields']
+  if isinstance(fields, tuple):
+    return [fields]
+  if isinstance(fields, basestring):
+    return [(fields, 1)]
+  return [(field, 1) if isinstance(field, basestring) else field for field in fields]
+
+
+def execute_unique(bulk):
+  """
+  Execute bulk operation, upserts a unique index rejects as duplicates are
+  skipped, they lost to a concurrent write of the same document.
+  """
+  try:
+    bulk.execute()
+  except BulkWriteError as e:
+    if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+      raise
+
+
+def declared_indexes():
+  """
+  All declared indexes.
+
+  :return: dictionary collection -> list of index declarations
+  """
+  indexes = dict((name, list(model.indexes)) for name, model in MODELS.items())
+  for name, extra in INDEXES.items():
+    indexes.setdefault(name, []).extend(extra)
+  return indexes
+
+
+def ensure_indexes(mconnection, database='recsys'):
+  """
+  Create all declared indexes which do not exist yet.
+
+  :param mconnection: mongodb connection
+  :param database: name of database
+  """
+  for name, indexes in declared_indexes().items():
+    collection = mconnection[database][name]
+    for index in indexes:
+      options = dict((key, value) for key, value in index.items() if key not in ('fields', 'check'))
+      collection.ensure_index(index_fields(index), **options)
+
+
+def collection_scan(plan):
+  """
+  True if explain output of query says it reads the whole collection.
+  """
+  # mongodb 2.x
+  if 'cursor' in plan:
+    return plan['cursor'].startswith('BasicCursor')
+  # mongodb 3.x and newer, look at all stages of the winning plan
+  stages = [plan.get('queryPlanner', {}).get('winningPlan', {})]
+  while stages:
+    stage = stages.pop()
+    if stage.get('stage') == 'COLLSCAN':
+      return True
+    stages.extend(stage.get('inputStages', []))
+    if 'inputStage' in stage:
+      stages.append(stage['inputStage'])
+  return False
+
+
+def query_shape(value):
+  """
+  Query or sort with values replaced by names of their types, queries of the
+  same shape are answered with the same indexes.
+  """
+  if isinstance(value, dict):
+    return tuple(sorted((key, query_shape(item)) for key, item in value.items()))
+  if isinstance(value, (list, tuple)):
+    return tuple(sorted(set(query_shape(item) for item in value)))
+  return type(value).__name__
+
+
+def scans_collection(collection, query, sort=None):
+  """
+  True if query, run as find on collection, reads the whole collection.
+  """
+  cursor = collection.find(query)
+  if sort:
+    cursor = cursor.sort(sort.items() if isinstance(sort, dict) else sort)
+  return collection_scan(cursor.explain())
+
+
+def audit_queries(mconnection, queries, database='recsys'):
+  """
+  Explain queries and find those which are not answered from an index.
+
+  :param mconnection: mongodb connection
+  :param queries: list of (collection, query, sort)
+  :param database: name of database
+  :return: list of (collection, query, sort) which scan the whole collection
+  """
+  return [(name, query, sort) for name, query, sort in queries
+          if scans_collection(mconnection[database][name], query, sort)]
+
+
+class QueryLog(object):
+  """
+  Shapes of queries issued at runtime. Updates and removes are explained as
+  finds with the same query.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # (database, collection, query shape, sort shape) -> True if it scans the collection, None if not known
+    self.shapes = {}
+    # the same keys -> (collection, query, sort) of the first query of the shape
+    self.examples = {}
+
+  def audit(self, queries):
+    """
+    Remember queries and explain those of shapes not seen before.
+
+    :param queries: list of (pymongo collection, query, sort)
+    :return: list of (collection, query, sort) of new shapes which scan the whole collection
+    """
+    new = []
+    with self.lock:
+      for collection, query, sort in queries:
+        key = (collection.database.name, collection.name, query_shape(query), query_shape(sort))
+        if key not in self.shapes:
+          self.shapes[key] = None
+          self.examples[key] = (collection.name, query, sort)
+          new.append((key, collection, query, sort))
+
+    unindexed = []
+    for key, collection, query, sort in new:
+      try:
+        scan = scans_collection(collection, query, sort)
+      except PyMongoError:
+        continue
+      with self.lock:
+        self.shapes[key] = scan
+      if scan:
+        unindexed.append(self.examples[key])
+    return unindexed
+
+  def unindexed(self):
+    """
+    Queries of all shapes seen so far which scan the whole collection.
+
+    :return: list of (database, collection, query, sort)
+    """
+    with self.lock:
+      return [(key[0],) + self.examples[key] for key, scan in self.shapes.items() if scan]
@@ -0,0 +1,230 @@
+# coding=utf-8
+"""
+Inverted index of recipes for full text search.
+Titles, tags and ingredient names are split to lowercase tokens. Every
+(token, recipe) pair is one small document in searchpostings, so common
+tokens never grow into one huge document and a reindexed recipe touches
+only its own postings. searchterms keeps the number of recipes of every
+token. Queries read postings of their rarest token first, at most
+CANDIDATES of them in order of their BM25 weight, and read postings of the
+other tokens only for these recipes. Recipes are ranked by BM25 with the
+same idf as the engine uses for ingredients.
+"""
+from collections import defaultdict
+from schema import execute_unique
+import math
+import re
+
+# id of document with number of indexed recipes and their total length in enginestate
+STATS = 'search'
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# maximal number of index terms the last (unfinished) query token can expand to
+PREFIX_TERMS = 50
+
+# postings of the rarest query token read at most, results are exact while it has fewer
+CANDIDATES = 1000
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def idf(documents, df):
+  """
+  Inverse document frequency log10(N / df), shared with the engine.
+
+  :param documents: number of all documents
+  :param df: number of documents with term
+  :return: idf, 0.0 for term without documents
+  """
+  if df == 0: return 0.0
+  return math.log10(float(documents) / float(df))
+
+
+def tokenize(text):
+  """
+  Lowercase word tokens of text.
+  """
+  return [token.lower() for token in TOKEN.findall(text or u'')]
+
+
+def recipe_terms(recipe):
+  """
+  Term frequencies of title, tags and ingredient names of recipe.
+
+  :param recipe: recipe document
+  :return: dictionary term -> number of occurrences
+  """
+  terms = defaultdict(int)
+  texts = [recipe.get('title')] + list(recipe.get('tags', []))
+  texts += [ingredient.get('ingredient') for ingredient in recipe.get('ingredients', [])]
+  for text in texts:
+    for token in tokenize(text):
+      terms[token] += 1
+  return terms
+
+
+def bm25(tf, length, avglength):
+  """
+  Term frequency part of BM25, the weight is idf times this.
+  """
+  return tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avglength))
+
+
+def average_length(db):
+  stats = db.enginestate.find_one({'_id': STATS}) or {}
+  documents = stats.get('documents', 0)
+  return documents, (float(stats.get('length', 0)) / documents if documents > 0 else 0.0) or 1.0
+
+
+def update_stats(db, old, new):
+  """
+  Move number of recipes of terms and total length of recipes from old to new indexed version of recipe.
+
+  :param db: database
+  :param old: searchdocs document of the old version, None for new recipe
+  :param new: searchdocs document of the new version, None for removed recipe
+  """
+  oldterms = set(old['terms']) if old else set()
+  newterms = set(new['terms']) if new else set()
+  changes = [(term, 1) for term in newterms - oldterms] + [(term, -1) for term in oldterms - newterms]
+  if changes:
+    bulk = db.searchterms.initialize_unordered_bulk_op()
+    for term, n in changes:
+      bulk.find({'_id': term}).upsert().update_one({'$inc': {'df': n}})
+    bulk.execute()
+  dropped = list(oldterms - newterms)
+  if dropped:
+    db.searchterms.remove({'_id': {'$in': dropped}, 'df': {'$lte': 0}})
+  documents = (1 if new else 0) - (1 if old else 0)
+  length = (new['length'] if new else 0) - (old['length'] if old else 0)
+  if documents or length:
+    db.enginestate.update({'_id': STATS}, {'$inc': {'documents': documents, 'length': length}}, upsert=True)
+
+
+def remove_recipe(mconnection, itemid):
+  """
+  Remove recipe from index.
+
+  :param mconnection: mongodb connection
+  :param itemid: id of recipe
+  """
+  db = mconnection['recsys']
+  old = db.searchdocs.find_and_modify({'_id': itemid}, remove=True)
+  if not old: return
+  db.searchpostings.remove({'itemid': itemid})
+  update_stats(db, old, None)
+
+
+def index_recipe(mconnection, recipe):
+  """
+  Add recipe to index or replace its old postings, call it after recipe is saved.
+
+  Every indexing of recipe gets a higher version in searchdocs. Postings are
+  written only over postings of older versions and postings of older versions
+  are removed when they are written. When two edits of one recipe are indexed
+  at once, the older one removes its own postings if it sees the newer
+  version at the end, otherwise the newer one removes them, so postings of
+  the newer version are left either way.
+
+  :param mconnection: mongodb connection
+  :param recipe: saved recipe document
+  """
+  db = mconnection['recsys']
+  itemid = recipe['_id']
+  terms = recipe_terms(recipe)
+  length = sum(terms.values())
+  old = db.searchdocs.find_and_modify({'_id': itemid},
+                                      {'$set': {'terms': list(terms), 'length': length}, '$inc': {'version': 1}},
+                                      upsert=True)
+  version = (old or {}).get('version', 0) + 1
+  update_stats(db, old, {'terms': list(terms), 'length': length})
+
+  if terms:
+    documents, avglength = average_length(db)
+    bulk = db.searchpostings.initialize_unordered_bulk_op()
+    for term, tf in terms.items():
+      posting = {'tf': tf, 'length': length, 'impact': bm25(tf, length, avglength), 'version': version}
+      bulk.find({'term': term, 'itemid': itemid, 'version': {'$lt': version}}).upsert().update_one({'$set': posting})
+    # a newer version of the posting is there already when its upsert is skipped
+    execute_unique(bulk)
+  db.searchpostings.remove({'itemid': itemid, 'version': {'$lt': version}})
+
+  current = db.searchdocs.find_one({'_id': itemid}, {'version': 1})
+  if current is None or current.get('version') != version:
+    db.searchpostings.remove({'itemid': itemid, 'version': version})
+
+
+def rebuild_index(mconnection):
+  """
+  Index all recipes from scratch.
+
+  :param mconnection: mongodb connection
+  """
+  db = mconnection['recsys']
+  db.searchterms.drop()
+  db.searchdocs.drop()
+  db.searchpostings.drop()
+  db.enginestate.remove({'_id': STATS})
+  # the unique index keeps one posting of term in recipe, see index_recipe
+  db.searchpostings.ensure_index([('term', 1), ('itemid', 1)], unique=True)
+  for recipe in db.recipes.find({}, {'title': 1, 'tags': 1, 'ingredients.ingredient': 1}):
+    index_recipe(mconnection, recipe)
+
+
+def search(mconnection, text, limit=20):
+  """
+  Recipes containing all tokens of text, the last token can be only
+  a prefix of word, so results show up while typing.
+  Only CANDIDATES recipes with the rarest token are considered, those with
+  the highest BM25 weight of that token.
+
+  :param mconnection: mongodb connection
+  :param text: query
+  :param limit: number of results
+  :return: list of (recipe id, score) sorted by score
+  """
+  db = mconnection['recsys']
+  tokens = tokenize(text)
+  if not tokens: return []
+  documents, avglength = average_length(db)
+  if documents <= 0: return []
+
+  # groups of index terms, every query token matches one term of its group
+  exact = set(tokens[:-1])
+  df = {}
+  if exact:
+    df.update((term['_id'], term['df']) for term in db.searchterms.find({'_id': {'$in': list(exact)}}))
+    if any(df.get(term, 0) <= 0 for term in exact): return []
+  query = {'_id': {'$regex': '^' + re.escape(tokens[-1])}, 'df': {'$gt': 0}}
+  prefix = dict((term['_id'], term['df']) for term in db.searchterms.find(query).limit(PREFIX_TERMS))
+  if not prefix: return []
+  df.update(prefix)
+  groups = [[term] for term in exact] + [list(prefix)]
+  # start from the rarest group, the others are read only for its recipes
+  groups.sort(key=lambda terms: sum(df[term] for term in terms))
+
+  first = db.searchpostings.find({'term': {'$in': groups[0]}}, {'term': 1, 'itemid': 1, 'tf': 1, 'length': 1})
+  matches = defaultdict(list)
+  add_postings(matches, first.sort('impact', -1).limit(CANDIDATES), df, documents)
+  for terms in groups[1:]:
+    if not matches: return []
+    group = defaultdict(list)
+    add_postings(group, db.searchpostings.find({'term': {'$in': terms}, 'itemid': {'$in': list(matches)}},
+                                               {'term': 1, 'itemid': 1, 'tf': 1, 'length': 1}), df, documents)
+    matches = dict((itemid, matches[itemid] + group[itemid]) for itemid in matches if itemid in group)
+
+  scores = []
+  for itemid, postings in matches.items():
+    score = sum(weight * bm25(tf, length, avglength) for tf, length, weight in postings)
+    scores.append((itemid, score))
+  scores.sort(key=lambda pair: (-pair[1], pair[0]))
+  return scores[:limit]
+
+
+def add_postings(group, postings, df, documents):
+  for posting in postings:
+    weight = idf(documents, df[posting['term']])
+    group[posting['itemid']].append((posting['tf'], posting['length'], weight))